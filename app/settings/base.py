@@ -77,11 +77,15 @@ if SIMPLE_SENDGRID_ENABLED:
     INSTALLED_APPS.append("simple_sendgrid")
 
 MIDDLEWARE = [
+    "core.sql_profiling.SQLProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    # Holds the SQLite write lock for unsafe requests, see core.sqlite
+    "core.sqlite.SerializedWritesMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "core.profiling.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -118,6 +122,10 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+        # Seconds to wait for a lock before raising "database is locked"
+        "OPTIONS": {"timeout": 20},
+        # Keep connections open between requests (PRAGMAs run once per connection)
+        "CONN_MAX_AGE": 0 if DEBUG else 600,
     }
 }
 
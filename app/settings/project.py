@@ -18,3 +18,77 @@ SUPPORT_EMAIL = "its@namgyu.io"
 ACCOUNT_LOGIN_ON_EMAIL_CONFIRMATION = True
 ACCOUNT_LOGIN_ON_PASSWORD_RESET = True
 ACCOUNT_EMAIL_VERIFICATION = fetch_env("ACCOUNT_EMAIL_VERIFICATION", "none")
+
+# Cache shared by all WSGI processes, e.g. memcached
+# (CACHE_BACKEND=django.core.cache.backends.memcached.MemcachedCache, CACHE_LOCATION=127.0.0.1:11211)
+# or a file-based cache directory writable by www-data
+# Cached pages are keyed by versions kept in the database (see core/versions.py)
+CACHES = {
+    "default": {
+        "BACKEND": fetch_env(
+            "CACHE_BACKEND", "django.core.cache.backends.filebased.FileBasedCache"
+        ),
+        "LOCATION": fetch_env("CACHE_LOCATION", "/var/tmp/fooddeuk_cache"),
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    }
+}
+PHOTO_LIST_CACHE_TIMEOUT = 60 * 60
+
+# Write-behind vote ingestion (see core/ingest.py)
+VOTE_WRITE_BEHIND = fetch_env("VOTE_WRITE_BEHIND", "FALSE").upper() == "TRUE"
+VOTE_FLUSH_INTERVAL = float(fetch_env("VOTE_FLUSH_INTERVAL", "2"))
+VOTE_FLUSH_SIZE = int(fetch_env("VOTE_FLUSH_SIZE", "500"))
+# Journal queued votes to disk so they survive a crash (memory only if unset)
+VOTE_JOURNAL_DIR = fetch_env("VOTE_JOURNAL_DIR")
+VOTE_JOURNAL_FSYNC = fetch_env("VOTE_JOURNAL_FSYNC", "TRUE").upper() == "TRUE"
+
+# Serve raters the most uncertain unvoted photo next (see core/scheduling.py)
+VOTE_SCHEDULING = fetch_env("VOTE_SCHEDULING", "FALSE").upper() == "TRUE"
+VOTE_SCHEDULING_TOP_N = int(fetch_env("VOTE_SCHEDULING_TOP_N", "10"))
+VOTE_SCHEDULING_REFRESH = float(fetch_env("VOTE_SCHEDULING_REFRESH", "60"))
+# Only ask raters to vote on the first photo of each near-duplicate cluster (see core/duplicates.py)
+VOTE_SKIP_DUPLICATES = fetch_env("VOTE_SKIP_DUPLICATES", "FALSE").upper() == "TRUE"
+
+# SQLite connection profile (see core/sqlite.py)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 20000,
+    "cache_size": -32000,  # KiB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+# Lock file used to serialize writers across processes (disabled if unset)
+SQLITE_WRITE_LOCK = fetch_env("SQLITE_WRITE_LOCK")
+
+# Memory-mapped users x photos vote matrix (see core/matrix.py)
+VOTE_MATRIX_PATH = fetch_env("VOTE_MATRIX_PATH", "/var/tmp/fooddeuk_vote_matrix.npy")
+
+# Photo derivatives (see core/derivatives.py)
+# Directory of the original photos (the static files of core/media/grad if unset)
+PHOTO_SOURCE_DIR = fetch_env("PHOTO_SOURCE_DIR")
+# Under MEDIA_ROOT
+PHOTO_DERIVATIVES_DIR = "photos"
+PHOTO_WIDTHS = [320, 640, 1280, 1920]
+PHOTO_FORMATS = ["avif", "webp", "jpeg"]
+# Thumbnail sprite atlases for the photo list (see core/atlases.py), under MEDIA_ROOT
+PHOTO_ATLAS_DIR = "atlases"
+PHOTO_ATLAS_TILE = (320, 213)
+PHOTO_ATLAS_GRID = (10, 10)
+# Maximum Hamming distance (of 64 bits) between the perceptual hashes of near-duplicates
+DUPLICATE_THRESHOLD = int(fetch_env("DUPLICATE_THRESHOLD", "6"))
+
+# Per-request query counts and timings (see core/sql_profiling.py)
+SQL_PROFILING = fetch_env("SQL_PROFILING", "FALSE").upper() == "TRUE"
+# Requests per view in the rolling summary
+SQL_PROFILING_WINDOW = int(fetch_env("SQL_PROFILING_WINDOW", "200"))
+# Slowest statements kept per view
+SQL_PROFILING_SLOWEST = 5
+
+# Request profiles (see core/profiling.py)
+PROFILING_DIR = fetch_env("PROFILING_DIR", "/var/tmp/fooddeuk_profiles")
+# Profile one in this many requests (0: only on demand)
+PROFILING_SAMPLE_RATE = int(fetch_env("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_INTERVAL = 0.005  # seconds between samples
+PROFILING_MAX_REPORTS = int(fetch_env("PROFILING_MAX_REPORTS", "100"))
+PROFILING_MAX_MB = int(fetch_env("PROFILING_MAX_MB", "100"))
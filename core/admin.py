@@ -1,6 +1,67 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.db.models import Count, F, OuterRef, Subquery
+from django.urls import reverse
+from django.utils.html import format_html
+
+from core import aggregates, versions
+from core.models import Counter, Photo, Vote
+
+
+class DuplicateFilter(admin.SimpleListFilter):
+    title = "duplicates"
+    parameter_name = "duplicates"
+
+    def lookups(self, request, model_admin):
+        return [("yes", "In a cluster"), ("first", "First of a cluster"), ("no", "No duplicates")]
+
+    def queryset(self, request, queryset):
+        if self.value() == "yes":
+            return queryset.exclude(cluster=None)
+        if self.value() == "first":
+            return queryset.filter(cluster=F("id"))
+        if self.value() == "no":
+            return queryset.filter(cluster=None)
+        return queryset
+
+
+@admin.register(Photo)
+class PhotoAdmin(admin.ModelAdmin):
+    list_display = ["id", "thumbnail", "name", "votes", "average", "cluster_link", "cluster_size"]
+    list_filter = [DuplicateFilter]
+    ordering = ["cluster", "id"]
+    readonly_fields = ["phash", "cluster"]
+    actions = ["recompute_aggregates"]
+
+    def get_queryset(self, request):
+        sizes = Photo.objects.filter(cluster=OuterRef("cluster")).order_by().values("cluster")
+        return super().get_queryset(request).annotate(
+            cluster_size=Subquery(sizes.annotate(count=Count("id")).values("count"))
+        )
+
+    def thumbnail(self, photo):
+        return format_html('<img src="{}" height="48" loading="lazy">', photo.thumb_src)
+
+    def cluster_link(self, photo):
+        if photo.cluster is None:
+            return "-"
+        url = reverse("admin:core_photo_changelist") + "?cluster={}".format(photo.cluster)
+        return format_html('<a href="{}">{}</a>', url, photo.cluster)
+
+    cluster_link.short_description = "cluster"
+    cluster_link.admin_order_field = "cluster"
+
+    def cluster_size(self, photo):
+        return photo.cluster_size
+
+    cluster_size.admin_order_field = "cluster_size"
+
+    def recompute_aggregates(self, request, queryset):
+        count = aggregates.recompute_in_batches(queryset.values_list("id", flat=True))
+        versions.bump_votes()
+        self.message_user(request, "Recomputed the vote aggregates of {} photos.".format(count), messages.SUCCESS)
+
+    recompute_aggregates.short_description = "Recompute vote aggregates of selected photos"
 
-from core.models import *
 
-admin.site.register(Photo)
 admin.site.register(Vote)
+admin.site.register(Counter)
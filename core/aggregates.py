@@ -0,0 +1,137 @@
+"""Recomputing Photo aggregates from the Vote table
+
+Regular votes update aggregates incrementally (see Photo.apply_vote). Bulk
+writes, which bypass Vote.save(), recompute the affected photos here with one
+grouped query instead.
+
+find_drift() and repair() check all photos at once (`manage.py
+recompute_aggregates`): the grouped vote counts and the stored aggregates are
+both streamed in photo id order and merged, so memory does not grow with the
+number of votes or photos. Photos are then fixed in batches that are each read
+again and written in one transaction under the SQLite write lock, so votes
+written since the scan are not overwritten.
+"""
+from django.db import transaction
+from django.db.models import Count
+
+from core import sqlite
+from core.models import Photo, Vote
+
+AGGREGATE_FIELDS = ["votes", "total", "average", "bad", "okay", "good"]
+
+
+EMPTY = dict(votes=0, total=0, average=0, bad=0, okay=0, good=0)
+CHUNK_SIZE = 2000
+# Photos recomputed per transaction
+BATCH_SIZE = 500
+# Stored averages are floats
+TOLERANCE = 1e-9
+
+
+def _iter_counts(photo_ids=None, ordered=False):
+    rows = Vote.objects.all()
+    if photo_ids is not None:
+        rows = rows.filter(photo_id__in=photo_ids)
+    rows = rows.values_list("photo_id", "selection").annotate(count=Count("id"))
+    return rows.order_by("photo_id") if ordered else rows.order_by()
+
+
+def _iter_aggregates(photo_ids=None):
+    """Yield (photo_id, {field: value}) in photo id order for photos with at least one vote"""
+    photo_id = values = None
+    for row_photo_id, selection, count in _iter_counts(photo_ids, ordered=True).iterator(chunk_size=CHUNK_SIZE):
+        if row_photo_id != photo_id:
+            if values:
+                yield photo_id, _finish(values)
+            photo_id, values = row_photo_id, dict(votes=0, total=0, bad=0, okay=0, good=0)
+        _add(values, selection, count)
+    if values:
+        yield photo_id, _finish(values)
+
+
+def _add(values, selection, count):
+    values["votes"] += count
+    values["total"] += Vote.selection_to_integer(selection) * count
+    values[Vote.selection_to_counter(selection)] = count
+
+
+def _finish(values):
+    values["average"] = values["total"] / values["votes"]
+    return values
+
+
+def compute(photo_ids=None):
+    """Return {photo_id: {field: value}} for photos with at least one vote"""
+    aggregates = {}
+    for photo_id, selection, count in _iter_counts(photo_ids).iterator():
+        _add(aggregates.setdefault(photo_id, dict(votes=0, total=0, bad=0, okay=0, good=0)), selection, count)
+    for values in aggregates.values():
+        _finish(values)
+    return aggregates
+
+
+def _differs(stored, actual):
+    return any(
+        abs(stored[field] - actual[field]) > TOLERANCE if field == "average" else stored[field] != actual[field]
+        for field in AGGREGATE_FIELDS
+    )
+
+
+def find_drift():
+    """Yield (photo_id, stored, actual) for every photo whose stored aggregates do not match its votes"""
+    photos = Photo.objects.order_by("id").values_list("id", *AGGREGATE_FIELDS).iterator(chunk_size=CHUNK_SIZE)
+    aggregates = _iter_aggregates()
+    next_id, next_values = next(aggregates, (None, None))
+    for photo_id, *values in photos:
+        # Votes of photos that no longer exist are skipped
+        while next_id is not None and next_id < photo_id:
+            next_id, next_values = next(aggregates, (None, None))
+        actual = next_values if next_id == photo_id else EMPTY
+        stored = dict(zip(AGGREGATE_FIELDS, values))
+        if _differs(stored, actual):
+            yield photo_id, stored, actual
+
+
+def repair(dry_run=False):
+    """Fix the aggregates of all drifted photos (unless dry_run) and return their
+    [(photo_id, stored, actual)]
+    """
+    drifted = list(find_drift())
+    if not dry_run:
+        recompute_in_batches([photo_id for photo_id, _, _ in drifted])
+    return drifted
+
+
+def recompute(photo_ids):
+    """Recompute and save the aggregates of the given photos
+
+    Photos are read BATCH_SIZE at a time to stay below SQLite's limit on query
+    parameters; call it in a transaction to write them all at once.
+    """
+    photo_ids = list(photo_ids)
+    photos = []
+    for start in range(0, len(photo_ids), BATCH_SIZE):
+        photos.extend(_recompute(photo_ids[start : start + BATCH_SIZE]))
+    return photos
+
+
+def _recompute(photo_ids):
+    aggregates = compute(photo_ids)
+    photos = list(Photo.objects.filter(id__in=photo_ids).only("id"))
+    for photo in photos:
+        for field, value in aggregates.get(photo.id, EMPTY).items():
+            setattr(photo, field, value)
+    Photo.objects.bulk_update(photos, AGGREGATE_FIELDS, batch_size=500)
+    return photos
+
+
+def recompute_in_batches(photo_ids):
+    """Recompute the given photos in batches, each read and written in one
+    transaction that holds the SQLite write lock. Returns the number of photos
+    """
+    photo_ids = list(photo_ids)
+    count = 0
+    for start in range(0, len(photo_ids), BATCH_SIZE):
+        with sqlite.serialized_writes(), transaction.atomic():
+            count += len(_recompute(photo_ids[start : start + BATCH_SIZE]))
+    return count
@@ -0,0 +1,94 @@
+"""Registry of the static files of each photo
+
+The original (core/media/grad/gradNNN.jpg) and thumbnail
+(core/media/grad_thumb/gradNNN.jpg) of every photo are found by listing the
+static files once per process, and their URLs are resolved with static() at
+the same time, so Photo.src and Photo.thumb_src are dict lookups instead of a
+manifest lookup per access. The registry is rebuilt when the staticfiles
+manifest changes (after collectstatic). Photos without files are reported by
+the core.W001 check.
+"""
+import os
+import re
+import threading
+import time
+
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.templatetags.static import static
+
+ORIGINAL = "src"
+THUMBNAIL = "thumb_src"
+PATTERNS = {
+    ORIGINAL: re.compile(r"^core/media/grad/grad(\d+)\.jpg$"),
+    THUMBNAIL: re.compile(r"^core/media/grad_thumb/grad(\d+)\.jpg$"),
+}
+# Seconds between checks of the staticfiles manifest
+RELOAD_INTERVAL = 5
+
+_lock = threading.Lock()
+_registry = None
+
+
+class Registry:
+    def __init__(self, manifest_mtime):
+        self.manifest_mtime = manifest_mtime
+        self.checked = time.monotonic()
+        self.urls = {kind: {} for kind in PATTERNS}
+        self.paths = {kind: {} for kind in PATTERNS}
+        seen = set()
+        for finder in finders.get_finders():
+            for path, storage in finder.list([]):
+                name = path.replace(os.sep, "/")
+                prefix = getattr(storage, "prefix", None)
+                if prefix:
+                    name = prefix + "/" + name
+                # Like collectstatic, the first finder wins
+                if name in seen:
+                    continue
+                seen.add(name)
+                for kind, pattern in PATTERNS.items():
+                    match = pattern.match(name)
+                    if match:
+                        photo_id = int(match.group(1))
+                        self.urls[kind][photo_id] = static(name)
+                        self.paths[kind][photo_id] = storage.path(path)
+
+
+def _manifest_mtime():
+    manifest_name = getattr(staticfiles_storage, "manifest_name", None)
+    if not manifest_name:
+        return None
+    try:
+        return os.stat(staticfiles_storage.path(manifest_name)).st_mtime
+    except (OSError, NotImplementedError):
+        return None
+
+
+def get_registry():
+    global _registry
+    registry = _registry
+    if registry is not None and time.monotonic() - registry.checked < RELOAD_INTERVAL:
+        return registry
+    with _lock:
+        mtime = _manifest_mtime()
+        if _registry is None or _registry.manifest_mtime != mtime:
+            _registry = Registry(mtime)
+        _registry.checked = time.monotonic()
+        return _registry
+
+
+def get_url(kind, photo_id):
+    """URL of the photo's original or thumbnail, "" if it has none"""
+    return get_registry().urls[kind].get(photo_id, "")
+
+
+def get_path(kind, photo_id):
+    """Filesystem path of the photo's original or thumbnail, None if it has none"""
+    return get_registry().paths[kind].get(photo_id)
+
+
+def missing(photo_ids):
+    """{kind: sorted ids of the given photos without that file}"""
+    registry = get_registry()
+    return {kind: sorted(set(photo_ids) - set(urls)) for kind, urls in registry.urls.items()}
@@ -0,0 +1,166 @@
+"""Sprite atlases of photo thumbnails for the photo list
+
+build() crops every photo to a PHOTO_ATLAS_TILE thumbnail and packs them, in id
+order, into atlases of PHOTO_ATLAS_GRID tiles, written as WebP and JPEG to
+PHOTO_ATLAS_DIR under MEDIA_ROOT with a process pool. Atlas files are named
+after the content hashes of their photos, so only atlases whose photos changed
+are rendered again.
+
+atlases.json maps each photo id to its atlas and tile, and atlases.css gives
+each atlas a class with its image (WebP where supported, JPEG otherwise). Cards
+position the atlas with percentages, so tiles scale with the card. Photos that
+are not in an atlas use their individual files (see core.derivatives).
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from core import derivatives
+
+MANIFEST = "atlases.json"
+STYLESHEET = "atlases.css"
+
+_manifest = (None, {})
+
+
+def output_dir():
+    return os.path.join(settings.MEDIA_ROOT, settings.PHOTO_ATLAS_DIR)
+
+
+def base_url():
+    return settings.MEDIA_URL + settings.PHOTO_ATLAS_DIR + "/"
+
+
+def render(name, photos, directory, tile, grid):
+    """Render one atlas from [(photo_id, source path)]"""
+    columns, rows = grid
+    atlas = Image.new("RGB", (tile[0] * columns, tile[1] * rows), (0, 0, 0))
+    for i, (_, path) in enumerate(photos):
+        with Image.open(path) as image:
+            thumbnail = ImageOps.fit(ImageOps.exif_transpose(image).convert("RGB"), tile, Image.LANCZOS)
+        atlas.paste(thumbnail, ((i % columns) * tile[0], (i // columns) * tile[1]))
+    for extension, pillow_format, options in [
+        ("webp", "WEBP", dict(quality=70, method=6)),
+        ("jpg", "JPEG", dict(quality=75, optimize=True, progressive=True)),
+    ]:
+        target = os.path.join(directory, "{}.{}".format(name, extension))
+        atlas.save(target + ".tmp", pillow_format, **options)
+        os.replace(target + ".tmp", target)
+    return name
+
+
+def load_manifest(directory=None):
+    try:
+        with open(os.path.join(directory or output_dir(), MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _stylesheet(manifest):
+    columns, rows = manifest["grid"]
+    tile_width, tile_height = manifest["tile"]
+    lines = [
+        ".atlas {{ background-size: {}% {}%; padding-top: {:.4f}%; }}".format(
+            columns * 100, rows * 100, tile_height / tile_width * 100
+        )
+    ]
+    for i, name in enumerate(manifest["atlases"]):
+        url = base_url() + name
+        image_set = 'image-set(url("{0}.webp") type("image/webp"), url("{0}.jpg") type("image/jpeg"))'.format(url)
+        lines.append('.atlas-{} {{ background-image: url("{}.jpg"); background-image: {}; }}'.format(i, url, image_set))
+    return "\n".join(lines) + "\n"
+
+
+def build(photos, workers=None, force=False):
+    """Pack [(photo_id, source)] into atlases. Returns (rendered, unchanged) atlas counts"""
+    directory = output_dir()
+    os.makedirs(directory, exist_ok=True)
+    previous = load_manifest(directory)
+    tile = list(settings.PHOTO_ATLAS_TILE)
+    grid = list(settings.PHOTO_ATLAS_GRID)
+    hashes = {photo_id: entry["hash"] for photo_id, entry in derivatives.get_manifest().items()}
+
+    paths = []
+    for photo_id, source in sorted(photos):
+        path = derivatives.source_path(photo_id, source)
+        if os.path.exists(path):
+            paths.append((photo_id, path))
+    per_atlas = grid[0] * grid[1]
+    chunks = [paths[i : i + per_atlas] for i in range(0, len(paths), per_atlas)]
+
+    names = []
+    jobs = []
+    for chunk in chunks:
+        digest = hashlib.sha256(json.dumps([tile, grid]).encode())
+        for photo_id, path in chunk:
+            digest.update("{}:{}".format(photo_id, hashes.get(photo_id) or derivatives.content_hash(path)).encode())
+        name = "atlas-" + digest.hexdigest()[: derivatives.HASH_LENGTH]
+        names.append(name)
+        if force or not all(os.path.exists(os.path.join(directory, name + ext)) for ext in [".webp", ".jpg"]):
+            jobs.append((name, chunk))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(render, name, chunk, directory, tile, grid) for name, chunk in jobs]:
+            future.result()
+
+    photo_map = {}
+    for atlas, chunk in enumerate(chunks):
+        for i, (photo_id, _) in enumerate(chunk):
+            photo_map[str(photo_id)] = [atlas, i % grid[0], i // grid[0]]
+    manifest = dict(tile=tile, grid=grid, atlases=names, photos=photo_map)
+
+    with open(os.path.join(directory, STYLESHEET + ".tmp"), "w") as f:
+        f.write(_stylesheet(manifest))
+    os.replace(os.path.join(directory, STYLESHEET + ".tmp"), os.path.join(directory, STYLESHEET))
+    with open(os.path.join(directory, MANIFEST + ".tmp"), "w") as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(directory, MANIFEST + ".tmp"), os.path.join(directory, MANIFEST))
+
+    for name in set(previous.get("atlases", [])) - set(names):
+        for ext in [".webp", ".jpg"]:
+            try:
+                os.remove(os.path.join(directory, name + ext))
+            except FileNotFoundError:
+                pass
+    return len(jobs), len(chunks) - len(jobs)
+
+
+def get_manifest():
+    """The manifest, reloaded in each process when the file changes"""
+    global _manifest
+    try:
+        mtime = os.stat(os.path.join(output_dir(), MANIFEST)).st_mtime
+    except FileNotFoundError:
+        return {}
+    if _manifest[0] != mtime:
+        _manifest = (mtime, load_manifest())
+    return _manifest[1]
+
+
+def get_stylesheet_url():
+    manifest = get_manifest()
+    if not manifest:
+        return None
+    # Versioned by the atlas names so browsers pick up rebuilt atlases
+    version = hashlib.md5("".join(manifest["atlases"]).encode()).hexdigest()[:8]
+    return base_url() + STYLESHEET + "?v=" + version
+
+
+def get_sprite(photo_id):
+    """{atlas, x, y} of the photo's tile (x/y as background-position percentages), None if not in an atlas"""
+    manifest = get_manifest()
+    tile = manifest.get("photos", {}).get(str(photo_id)) if manifest else None
+    if tile is None:
+        return None
+    atlas, column, row = tile
+    columns, rows = manifest["grid"]
+    return dict(
+        atlas=atlas,
+        x=column / (columns - 1) * 100 if columns > 1 else 0,
+        y=row / (rows - 1) * 100 if rows > 1 else 0,
+    )
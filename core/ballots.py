@@ -0,0 +1,94 @@
+"""Importing offline ballots from CSV
+
+A ballot file has a header row and one vote per row. Raters are given by a
+`user_id` or `username` column, photos by `photo_id`, and votes by a
+`selection` column with the Vote.selection_choices codes (GD, OK, BD) or a
+`score` column (5, 3, 1), so the vote exports of core.exports can be imported
+back. Rows are parsed as they are read, and valid rows are written with
+votes.bulk_upsert, which recomputes the affected photo aggregates once.
+"""
+import csv
+
+from django.contrib.auth import get_user_model
+
+from core import sqlite, votes
+from core.models import Photo, Vote
+
+# Report at most this many errors
+MAX_ERRORS = 1000
+
+
+class BallotError(ValueError):
+    pass
+
+
+class ImportResult:
+    def __init__(self):
+        self.rows = 0
+        self.votes = []
+        self.created = 0
+        self.errors = []
+        self.error_count = 0
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+
+def _selections():
+    """{code or score: code}"""
+    selections = {code: code for code, _ in Vote.selection_choices}
+    selections.update({str(Vote.selection_to_integer(code)): code for code in list(selections)})
+    return selections
+
+
+def parse(lines):
+    """Return an ImportResult of the CSV lines (any iterable of str) without writing anything"""
+    reader = csv.DictReader(lines)
+    columns = set(reader.fieldnames or [])
+    if not columns & {"user_id", "username"} or "photo_id" not in columns or not columns & {"selection", "score"}:
+        raise BallotError("Expected user_id or username, photo_id, and selection or score columns")
+
+    User = get_user_model()
+    user_ids = set(User.objects.values_list("id", flat=True))
+    usernames = dict(User.objects.values_list("username", "id")) if "username" in columns else {}
+    photo_ids = set(Photo.objects.values_list("id", flat=True))
+    selections = _selections()
+
+    result = ImportResult()
+    for row in reader:
+        result.rows += 1
+        # Line numbers count the header and quoted line breaks
+        line = reader.line_num
+        try:
+            if (row.get("user_id") or "").strip():
+                user_id = int(row["user_id"])
+                if user_id not in user_ids:
+                    raise BallotError("Unknown user id {}".format(user_id))
+            else:
+                username = (row.get("username") or "").strip()
+                if username not in usernames:
+                    raise BallotError("Unknown user {!r}".format(username))
+                user_id = usernames[username]
+            photo_id = int(row["photo_id"])
+            if photo_id not in photo_ids:
+                raise BallotError("Unknown photo {}".format(photo_id))
+            value = (row.get("selection") or row.get("score") or "").strip().upper()
+            if value not in selections:
+                raise BallotError("Invalid selection {!r}".format(value))
+        except (BallotError, ValueError, TypeError) as e:
+            message = str(e) if isinstance(e, BallotError) else "Invalid id in {}".format(dict(row))
+            result.error(line, message)
+            continue
+        result.votes.append((user_id, photo_id, selections[value]))
+    return result
+
+
+def import_ballots(lines, dry_run=False):
+    """Parse the CSV lines and upsert the valid votes (unless dry_run). Returns the ImportResult"""
+    result = parse(lines)
+    if result.votes and not dry_run:
+        with sqlite.serialized_writes():
+            result.created = votes.bulk_upsert(result.votes)
+    return result
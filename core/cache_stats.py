@@ -0,0 +1,45 @@
+"""Hit/miss counters for the page cache and conditional GETs
+
+Counters are kept in the shared cache so the rates cover all WSGI processes.
+"""
+from django.core.cache import cache
+
+HIT_KEY = "cache-stats:{}:hit"
+MISS_KEY = "cache-stats:{}:miss"
+NAMES_KEY = "cache-stats:names"
+
+
+def _incr(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def _register(name):
+    names = cache.get(NAMES_KEY, [])
+    if name not in names:
+        cache.set(NAMES_KEY, sorted(names + [name]), None)
+
+
+def record_hit(name):
+    _incr(HIT_KEY.format(name))
+
+
+def record_miss(name):
+    _incr(MISS_KEY.format(name))
+    _register(name)
+
+
+def get_hit_rates():
+    names = cache.get(NAMES_KEY, [])
+    keys = [key.format(name) for name in names for key in (HIT_KEY, MISS_KEY)]
+    values = cache.get_many(keys)
+    rates = {}
+    for name in names:
+        hits = values.get(HIT_KEY.format(name), 0)
+        misses = values.get(MISS_KEY.format(name), 0)
+        total = hits + misses
+        rates[name] = dict(hits=hits, misses=misses, rate=hits / total if total else None)
+    return rates
+
@@ -0,0 +1,42 @@
+"""Checks run explicitly, e.g. after collectstatic: manage.py check --deploy --tag photos"""
+from django.core.checks import Warning, register
+from django.db import DatabaseError, connection
+
+from core import assets
+
+MAX_LISTED = 10
+
+
+# Lists all static files, so it does not run with every management command
+@register("photos", deploy=True)
+def check_photo_assets(app_configs, **kwargs):
+    """Warn about photos whose original or thumbnail is neither a static file nor a derivative"""
+    from core.models import Photo
+
+    try:
+        if Photo._meta.db_table not in connection.introspection.table_names():
+            # Not migrated yet
+            return []
+        photos = list(Photo.objects.only("id", "source").order_by("id"))
+    except DatabaseError:
+        # No database
+        return []
+    errors = []
+    # The URLs pages use: static files, else derivatives; only derivatives for imported photos
+    for kind in [assets.ORIGINAL, assets.THUMBNAIL]:
+        ids = [photo.id for photo in photos if not getattr(photo, kind)]
+        if ids:
+            listed = ", ".join(str(photo_id) for photo_id in ids[:MAX_LISTED])
+            if len(ids) > MAX_LISTED:
+                listed += ", ..."
+            errors.append(
+                Warning(
+                    "{} photos have no {} file: {}".format(
+                        len(ids), "original" if kind == assets.ORIGINAL else "thumbnail", listed
+                    ),
+                    hint="Add them to core/static/core/media/, run build_photo_derivatives or delete the photos.",
+                    obj="core.Photo",
+                    id="core.W001",
+                )
+            )
+    return errors
@@ -0,0 +1,257 @@
+"""Multi-resolution photo derivatives in modern formats
+
+build() renders each source photo at every width in PHOTO_WIDTHS (never
+upscaled) and in every format in PHOTO_FORMATS that Pillow can encode, using a
+process pool. Files are written to PHOTO_DERIVATIVES_DIR under MEDIA_ROOT and
+named after the source's content hash, e.g. `3f2a9c0d1e6b7a85-640.webp`, so
+unchanged sources are skipped on the next run and changed ones get new URLs.
+
+manifest.json in the same directory maps each photo id to its hash, source size
+and widths. Photos missing from the manifest fall back to the hand-prepared
+JPEGs of Photo.src and Photo.thumb_src.
+
+build_placeholders() stores each photo's intrinsic size and a tiny blurred WebP
+data URI on Photo, which pages show while the real image loads.
+
+Photos that fail to render (e.g. a corrupt source) are logged and counted, and
+the results of the others are still saved.
+"""
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from PIL import Image, ImageFilter, ImageOps, features
+
+from core import assets
+
+MANIFEST = "manifest.json"
+HASH_LENGTH = 16
+# Width of the blurred placeholders stored on Photo; browsers scale them up smoothly
+PLACEHOLDER_WIDTH = 16
+
+# name: (Pillow format, MIME type, file extension, save options), in order of preference
+FORMATS = {
+    "avif": ("AVIF", "image/avif", "avif", dict(quality=50)),
+    "webp": ("WEBP", "image/webp", "webp", dict(quality=75, method=6)),
+    "jpeg": ("JPEG", "image/jpeg", "jpg", dict(quality=82, optimize=True, progressive=True)),
+}
+
+logger = logging.getLogger(__name__)
+
+_manifest = (None, {})
+
+
+def source_path(photo_id, source=""):
+    """Path of the photo's original: its imported source, else the file named after its id"""
+    if source:
+        return source
+    if settings.PHOTO_SOURCE_DIR:
+        return os.path.join(settings.PHOTO_SOURCE_DIR, "grad{:03d}.jpg".format(photo_id))
+    return assets.get_path(assets.ORIGINAL, photo_id) or ""
+
+
+def output_dir():
+    return os.path.join(settings.MEDIA_ROOT, settings.PHOTO_DERIVATIVES_DIR)
+
+
+def available_formats():
+    """PHOTO_FORMATS that this Pillow build can encode"""
+    return [name for name in settings.PHOTO_FORMATS if features.check(name if name != "jpeg" else "jpg")]
+
+
+def file_name(digest, width, name):
+    return "{}-{}.{}".format(digest, width, FORMATS[name][2])
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def _is_complete(entry, directory):
+    return all(
+        os.path.exists(os.path.join(directory, file_name(entry["hash"], width, name)))
+        for width in entry["widths"]
+        for name in entry["formats"]
+    )
+
+
+def render(photo_id, path, directory, widths, formats, previous=None, force=False):
+    """Render the derivatives of one photo. Returns (photo_id, manifest entry, rendered)"""
+    digest = content_hash(path)
+    if (
+        not force
+        and previous
+        and previous["hash"] == digest
+        and set(formats) <= set(previous["formats"])
+        and _is_complete(previous, directory)
+    ):
+        return photo_id, previous, False
+
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        source_width, source_height = image.size
+        sizes = sorted({min(width, source_width) for width in widths})
+        for width in sizes:
+            height = max(1, round(source_height * width / source_width))
+            resized = image if width == source_width else image.resize((width, height), Image.LANCZOS)
+            for name in formats:
+                pillow_format, _, _, options = FORMATS[name]
+                target = os.path.join(directory, file_name(digest, width, name))
+                resized.save(target + ".tmp", pillow_format, **options)
+                os.replace(target + ".tmp", target)
+    entry = dict(hash=digest, width=source_width, height=source_height, widths=sizes, formats=formats)
+    return photo_id, entry, True
+
+
+def render_placeholder(photo_id, path):
+    """Return (photo_id, width, height, placeholder data URI) of a source photo"""
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        width, height = image.size
+        image.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH * 4))
+    image = image.filter(ImageFilter.GaussianBlur(1))
+    data = io.BytesIO()
+    # A WebP this small is a few dozen bytes, a JPEG several hundred (mostly headers)
+    image.save(data, "WEBP", quality=50)
+    return photo_id, width, height, "data:image/webp;base64," + base64.b64encode(data.getvalue()).decode()
+
+
+def build_placeholders(photos, workers=None):
+    """Set width, height and placeholder of the given photos. Returns (updated, missing, failed) counts"""
+    from core.models import Photo
+
+    by_id = {photo.id: photo for photo in photos}
+    missing = failed = 0
+    updated = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for photo_id in by_id:
+                path = source_path(photo_id, by_id[photo_id].source)
+                if os.path.exists(path):
+                    futures.append((photo_id, executor.submit(render_placeholder, photo_id, path)))
+                else:
+                    missing += 1
+            for photo_id, future in futures:
+                try:
+                    _, width, height, placeholder = future.result()
+                except Exception:
+                    logger.exception("Failed to render the placeholder of photo %s", photo_id)
+                    failed += 1
+                    continue
+                photo = by_id[photo_id]
+                photo.width, photo.height, photo.placeholder = width, height, placeholder
+                updated.append(photo)
+    finally:
+        Photo.objects.bulk_update(updated, ["width", "height", "placeholder"], batch_size=500)
+    return len(updated), missing, failed
+
+
+def load_manifest(directory=None):
+    path = os.path.join(directory or output_dir(), MANIFEST)
+    try:
+        with open(path) as f:
+            return {int(photo_id): entry for photo_id, entry in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest, directory=None):
+    path = os.path.join(directory or output_dir(), MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump({str(photo_id): entry for photo_id, entry in sorted(manifest.items())}, f)
+    os.replace(path + ".tmp", path)
+
+
+def _remove(entry, directory):
+    for width in entry["widths"]:
+        for name in entry["formats"]:
+            try:
+                os.remove(os.path.join(directory, file_name(entry["hash"], width, name)))
+            except FileNotFoundError:
+                pass
+
+
+def build(photos, workers=None, force=False):
+    """Render the derivatives of [(photo_id, source)]. Returns (rendered, skipped, missing, failed) counts"""
+    directory = output_dir()
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_manifest(directory)
+    widths = sorted(settings.PHOTO_WIDTHS)
+    formats = available_formats()
+    rendered = skipped = missing = failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for photo_id, source in photos:
+                path = source_path(photo_id, source)
+                if not os.path.exists(path):
+                    missing += 1
+                    continue
+                args = (photo_id, path, directory, widths, formats, manifest.get(photo_id), force)
+                futures.append((photo_id, executor.submit(render, *args)))
+            for photo_id, future in futures:
+                try:
+                    _, entry, changed = future.result()
+                except Exception:
+                    # The previous entry and its files, if any, are kept
+                    logger.exception("Failed to render the derivatives of photo %s", photo_id)
+                    failed += 1
+                    continue
+                previous = manifest.get(photo_id)
+                if changed:
+                    rendered += 1
+                    if previous and previous["hash"] != entry["hash"]:
+                        _remove(previous, directory)
+                else:
+                    skipped += 1
+                manifest[photo_id] = entry
+    finally:
+        save_manifest(manifest, directory)
+    return rendered, skipped, missing, failed
+
+
+def get_manifest():
+    """The manifest, reloaded in each process when the file changes"""
+    global _manifest
+    try:
+        mtime = os.stat(os.path.join(output_dir(), MANIFEST)).st_mtime
+    except FileNotFoundError:
+        return {}
+    if _manifest[0] != mtime:
+        _manifest = (mtime, load_manifest())
+    return _manifest[1]
+
+
+def get_url(photo_id, largest=False):
+    """URL of the photo's smallest (or largest) JPEG derivative, "" if it has none"""
+    entry = get_manifest().get(photo_id)
+    if not entry or "jpeg" not in entry["formats"]:
+        return ""
+    width = entry["widths"][-1 if largest else 0]
+    return settings.MEDIA_URL + settings.PHOTO_DERIVATIVES_DIR + "/" + file_name(entry["hash"], width, "jpeg")
+
+
+def get_sources(photo_id):
+    """[{type, srcset}] of the photo's derivatives in order of preference, empty if there are none"""
+    entry = get_manifest().get(photo_id)
+    if not entry:
+        return []
+    base = settings.MEDIA_URL + settings.PHOTO_DERIVATIVES_DIR + "/"
+    sources = []
+    for name in FORMATS:
+        if name in entry["formats"]:
+            srcset = ", ".join(
+                "{}{} {}w".format(base, file_name(entry["hash"], width, name), width) for width in entry["widths"]
+            )
+            sources.append(dict(type=FORMATS[name][1], srcset=srcset))
+    return sources
@@ -0,0 +1,171 @@
+"""Near-duplicate photos by perceptual hash
+
+Each photo gets a 64-bit DCT perceptual hash (stored signed in Photo.phash),
+computed by a process pool. Hashes go into a multi-index hash (see HashIndex),
+which finds all hashes within a Hamming distance by looking up a few buckets
+instead of comparing every pair. Photos within DUPLICATE_THRESHOLD bits of
+each other are joined into clusters, and each photo of a cluster stores the
+id of the cluster's first photo in Photo.cluster.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from core import derivatives
+
+HASH_SIZE = 8
+IMAGE_SIZE = 32
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    return np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+
+
+DCT = _dct_matrix(IMAGE_SIZE)
+
+
+def phash(path):
+    """64-bit perceptual hash: low DCT frequencies of the grayscale image compared to their median"""
+    with Image.open(path) as image:
+        image.draft("L", (IMAGE_SIZE * 4, IMAGE_SIZE * 4))
+        image = ImageOps.exif_transpose(image).convert("L").resize((IMAGE_SIZE, IMAGE_SIZE), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.float64)
+    low = (DCT @ pixels @ DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    bits = (low > np.median(low)).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def to_signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def distance(a, b):
+    # int.bit_count() needs Python 3.10
+    return bin(a ^ b).count("1")
+
+
+class HashIndex:
+    """Multi-index hash of (hash, photo id) pairs for Hamming-distance queries
+
+    The 64 bits are split into CHUNKS chunks, each with its own table. Two hashes
+    within radius bits of each other differ by at most radius // CHUNKS bits in at
+    least one chunk, so a search only looks up the buckets of the query's chunks
+    with up to that many bits flipped and checks the full distance of what it finds.
+    """
+
+    CHUNKS = 4
+    BITS = 64 // CHUNKS
+
+    def __init__(self):
+        self.tables = [{} for _ in range(self.CHUNKS)]
+        self.size = 0
+
+    def _chunks(self, value):
+        mask = (1 << self.BITS) - 1
+        return [(value >> (i * self.BITS)) & mask for i in range(self.CHUNKS)]
+
+    def add(self, value, photo_id):
+        self.size += 1
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            table.setdefault(chunk, []).append((value, photo_id))
+
+    def _variants(self, chunk, flips):
+        variants = [chunk]
+        for _ in range(flips):
+            variants = {variant ^ (1 << bit) for variant in variants for bit in range(self.BITS)} | set(variants)
+        return variants
+
+    def search(self, value, radius):
+        """[(distance, photo id)] of all photos within radius of value"""
+        found = {}
+        flips = radius // self.CHUNKS
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            for variant in self._variants(chunk, flips):
+                for other, photo_id in table.get(variant, ()):
+                    d = distance(value, other)
+                    if d <= radius:
+                        found[photo_id] = d
+        return sorted((d, photo_id) for photo_id, d in found.items())
+
+
+def find_clusters(hashes, threshold):
+    """{photo_id: cluster id} for photos with a near-duplicate, from {photo_id: unsigned hash}"""
+    index = HashIndex()
+    for photo_id, value in hashes.items():
+        index.add(value, photo_id)
+
+    parents = {}
+
+    def find(photo_id):
+        root = photo_id
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while photo_id != root:
+            parents[photo_id], photo_id = root, parents.get(photo_id, photo_id)
+        return root
+
+    for photo_id, value in hashes.items():
+        for _, other in index.search(value, threshold):
+            if other != photo_id:
+                a, b = find(photo_id), find(other)
+                if a != b:
+                    # The lowest id becomes the cluster id
+                    parents[max(a, b)] = min(a, b)
+
+    roots = {photo_id: find(photo_id) for photo_id in hashes}
+    sizes = {}
+    for root in roots.values():
+        sizes[root] = sizes.get(root, 0) + 1
+    return {photo_id: root for photo_id, root in roots.items() if sizes[root] > 1}
+
+
+def _hash_file(photo_id, path):
+    try:
+        return photo_id, phash(path)
+    except (OSError, SyntaxError, ValueError):
+        return photo_id, None
+
+
+def build(workers=None, threshold=None, force=False):
+    """Hash photos that have no hash (all with force) and recompute the clusters.
+    Returns (hashed, clustered photos, clusters) counts.
+    """
+    from core.models import Photo
+
+    threshold = settings.DUPLICATE_THRESHOLD if threshold is None else threshold
+    photos = Photo.objects.only("id", "source", "phash", "cluster").order_by("id")
+    by_id = {photo.id: photo for photo in photos}
+    pending = [photo for photo in by_id.values() if force or photo.phash is None]
+
+    hashed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for photo in pending:
+            path = derivatives.source_path(photo.id, photo.source)
+            if os.path.exists(path):
+                futures.append(executor.submit(_hash_file, photo.id, path))
+        for future in futures:
+            photo_id, value = future.result()
+            if value is not None:
+                by_id[photo_id].phash = to_signed(value)
+                hashed.append(by_id[photo_id])
+    Photo.objects.bulk_update(hashed, ["phash"], batch_size=500)
+
+    hashes = {photo.id: to_unsigned(photo.phash) for photo in by_id.values() if photo.phash is not None}
+    clusters = find_clusters(hashes, threshold)
+    changed = []
+    for photo in by_id.values():
+        cluster = clusters.get(photo.id)
+        if photo.cluster != cluster:
+            photo.cluster = cluster
+            changed.append(photo)
+    Photo.objects.bulk_update(changed, ["cluster"], batch_size=500)
+    return len(hashed), len(clusters), len(set(clusters.values()))
@@ -0,0 +1,146 @@
+"""Streaming exports of the raw votes and of photo rankings
+
+Rows are read with chunked iterator() queries and rendered line by line
+(optionally gzip compressed on the fly), so exports can be written to a file
+or a StreamingHttpResponse with flat memory use however large the vote table
+is. Rankings come from core.ranking, which keeps one score per photo in
+memory; the photo rows themselves are read in chunks as well.
+"""
+import csv
+import json
+import zlib
+
+from core import ranking
+from core.models import Photo, Vote
+
+VOTES = "votes"
+RANKING = "ranking"
+KINDS = [VOTES, RANKING]
+
+CSV = "csv"
+JSONL = "jsonl"
+FORMATS = [CSV, JSONL]
+CONTENT_TYPES = {CSV: "text/csv", JSONL: "application/x-ndjson"}
+
+VOTE_COLUMNS = ["user_id", "username", "photo_id", "selection", "score"]
+RANKING_COLUMNS = ["rank", "photo_id", "name", "score", "low", "high", "votes", "average", "bad", "okay", "good"]
+
+DEFAULT_METHOD = ranking.BAYESIAN
+
+CHUNK_SIZE = 2000
+# Photos looked up per id__in query, below SQLite's limit of 999 query parameters
+PHOTO_CHUNK_SIZE = 900
+# Rendered output is compressed and yielded in blocks of about this size
+BLOCK_SIZE = 64 * 1024
+
+
+def _filter_range(queryset, field, low=None, high=None):
+    if low is not None:
+        queryset = queryset.filter(**{field + "__gte": low})
+    if high is not None:
+        queryset = queryset.filter(**{field + "__lte": high})
+    return queryset
+
+
+def iter_votes(user_min=None, user_max=None, photo_min=None, photo_max=None):
+    """Yield a row of VOTE_COLUMNS per vote, ordered by user and photo"""
+    rows = _filter_range(Vote.objects.all(), "user_id", user_min, user_max)
+    rows = _filter_range(rows, "photo_id", photo_min, photo_max)
+    rows = rows.order_by("user_id", "photo_id").values_list("user_id", "user__username", "photo_id", "selection")
+    for user_id, username, photo_id, selection in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield [user_id, username, photo_id, selection, Vote.selection_to_integer(selection)]
+
+
+def iter_ranking(method, version, photo_min=None, photo_max=None):
+    """Yield a row of RANKING_COLUMNS per photo in ranking order
+
+    Ranks are positions in the full ranking, also when photos are filtered out.
+    """
+    scored = ranking.get_ranking(method, version)
+    for start in range(0, len(scored), PHOTO_CHUNK_SIZE):
+        ids = [int(photo_id) for photo_id in scored.ids[start : start + PHOTO_CHUNK_SIZE]]
+        photos = _filter_range(Photo.objects.filter(id__in=ids), "id", photo_min, photo_max)
+        photos = photos.only("id", "source", "votes", "average", "bad", "okay", "good").in_bulk()
+        for i, photo_id in enumerate(ids, start):
+            photo = photos.get(photo_id)
+            if photo is None:
+                continue
+            yield [
+                i + 1,
+                photo.id,
+                photo.name,
+                float(scored.scores[i]),
+                float(scored.low[i]),
+                float(scored.high[i]),
+                photo.votes,
+                photo.average,
+                photo.bad,
+                photo.okay,
+                photo.good,
+            ]
+
+
+class _Line:
+    """File-like object for csv.writer that returns the line instead of writing it"""
+
+    def write(self, value):
+        return value
+
+
+def render(rows, columns, format):
+    """Yield the lines (str) of the rows in the given format, with a header line for CSV"""
+    if format == CSV:
+        writer = csv.writer(_Line())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow(row)
+    elif format == JSONL:
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+    else:
+        raise ValueError("Unknown export format {!r}".format(format))
+
+
+def encode(lines, compress=False):
+    """Yield the lines as blocks of UTF-8 bytes, gzip compressed if compress"""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= BLOCK_SIZE:
+            data = "".join(block).encode()
+            block, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = "".join(block).encode()
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def export(kind, format=CSV, compress=False, method=DEFAULT_METHOD, version=None, **filters):
+    """Yield the export as bytes blocks
+
+    filters are user_min/user_max (votes only) and photo_min/photo_max. Raises
+    ValueError for unknown kinds, formats and methods and for user filters on rankings.
+    """
+    if kind == VOTES:
+        rows, columns = iter_votes(**filters), VOTE_COLUMNS
+    elif kind == RANKING:
+        if method not in ranking.METHODS:
+            raise ValueError("Unknown ranking method {!r}".format(method))
+        if set(filters) - {"photo_min", "photo_max"}:
+            raise ValueError("Rankings can only be filtered by photo")
+        rows, columns = iter_ranking(method, version, **filters), RANKING_COLUMNS
+    else:
+        raise ValueError("Unknown export {!r}".format(kind))
+    return encode(render(rows, columns, format), compress)
+
+
+def file_name(kind, format, compress=False, method=None):
+    name = "{}-{}".format(kind, method) if kind == RANKING else kind
+    return "{}.{}{}".format(name, format, ".gz" if compress else "")
@@ -0,0 +1,119 @@
+"""Keyset (cursor) pagination over photos
+
+Index order pages on `id`, so each page costs the same regardless of how far
+the client has scrolled. Rank order (the average score) and the other scored
+orders (see core.ranking) page on `(-score, id)` over the in-memory ranking.
+Cursors are opaque to clients.
+"""
+import base64
+import json
+
+from django.urls import reverse
+
+from core import ranking, voted
+from core.models import Photo
+
+INDEX = "index"
+RANK = "rank"
+# Ranking method of each scored sort
+METHODS = {
+    RANK: ranking.AVERAGE,
+    ranking.BAYESIAN: ranking.BAYESIAN,
+    ranking.WILSON: ranking.WILSON,
+    ranking.NORMALIZED: ranking.NORMALIZED,
+}
+SCORED = list(METHODS)
+SORTS = [INDEX] + SCORED
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(photo_id, key, rank):
+    data = [photo_id, key, rank]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        photo_id, key, rank = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(photo_id), float(key), int(rank)
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+def _get_photos(cursor, limit):
+    photos = Photo.objects.order_by("id")
+    rank = 0
+    if cursor:
+        photo_id, _, rank = decode_cursor(cursor)
+        photos = photos.filter(id__gt=photo_id)
+
+    photos = list(photos[: limit + 1])
+    for photo in photos:
+        rank += 1
+        photo.rank = rank
+        photo.score = photo.average
+    return photos
+
+
+def _get_scored_photos(sort, cursor, limit, version):
+    scored = ranking.get_ranking(METHODS[sort], version)
+    start = 0
+    if cursor:
+        photo_id, score, _ = decode_cursor(cursor)
+        start = scored.index_after(score, photo_id)
+    ids = [int(photo_id) for photo_id in scored.ids[start : start + limit + 1]]
+    photos_by_id = Photo.objects.in_bulk(ids)
+    photos = [photos_by_id[photo_id] for photo_id in ids if photo_id in photos_by_id]
+    for photo in photos:
+        photo.rank = scored.rank(photo.id)
+        photo.score = scored.score(photo.id)
+    return photos
+
+
+def get_photo_page(user, sort, cursor=None, limit=48, version=None, user_version=None):
+    """Return (photos, next cursor or None)
+
+    Each photo is annotated with `rank` (its position in the given order),
+    `score` (the value it is sorted by) and `voted` (whether the user has voted
+    on it). Scored sorts need the current vote version.
+    """
+    if sort in SCORED:
+        photos = _get_scored_photos(sort, cursor, limit, version)
+    else:
+        photos = _get_photos(cursor, limit)
+    has_next = len(photos) > limit
+    photos = photos[:limit]
+
+    voted_bits = voted.get_voted(user.id, user_version)
+    for photo in photos:
+        photo.voted = voted.has_voted(voted_bits, photo.id)
+
+    next_cursor = None
+    if has_next:
+        last = photos[-1]
+        next_cursor = encode_cursor(last.id, last.score, last.rank)
+    return photos, next_cursor
+
+
+def serialize_photo(photo):
+    return dict(
+        id=photo.id,
+        url=reverse("core:photo-detail", args=[photo.id]),
+        thumb_src=photo.thumb_src,
+        sources=photo.sources,
+        sprite=photo.sprite,
+        width=photo.width,
+        height=photo.height,
+        placeholder=photo.placeholder,
+        rank=photo.rank,
+        voted=photo.voted,
+        average=photo.average,
+        score=photo.score,
+        votes=photo.votes,
+        bad=photo.bad,
+        okay=photo.okay,
+        good=photo.good,
+    )
@@ -4,15 +4,15 @@ from core.models import *
 
 
 class VoteForm(forms.ModelForm):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.fields["user"].disabled = True
-        self.fields["photo"].disabled = True
+    """Selection for a vote whose user and photo are set by the view"""
 
     class Meta:
         model = Vote
-        fields = ["user", "photo", "selection"]
-        widgets = {
-            "user": forms.HiddenInput(),
-            "photo": forms.HiddenInput(),
-        }
+        fields = ["selection"]
+
+
+class BallotImportForm(forms.Form):
+    """CSV ballot upload (see core.ballots)"""
+
+    file = forms.FileField(help_text="CSV with user_id or username, photo_id, and selection or score columns")
+    dry_run = forms.BooleanField(required=False, help_text="Only validate the file")
@@ -0,0 +1,131 @@
+"""Import photos from a directory (see the import_photos command)
+
+Files are hashed and read (size, EXIF date and camera, placeholder) by a
+process pool and inserted with bulk_create in batches, each in its own
+transaction. Files whose path is already imported are skipped before any
+work, so an interrupted import resumes where it stopped; files with the same
+content as an imported photo are skipped as duplicates, and files that cannot
+be read are logged and skipped.
+"""
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+
+from core import derivatives, sqlite, stats, versions
+from core.models import Photo
+
+EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+BATCH_SIZE = 500
+
+EXIF_IFD = 0x8769
+DATE_TIME_ORIGINAL = 36867
+DATE_TIME = 306
+MAKE = 271
+MODEL = 272
+ORIENTATION = 274
+# Orientations that swap width and height
+TRANSPOSED = {5, 6, 7, 8}
+
+logger = logging.getLogger(__name__)
+
+
+def find_files(directory):
+    """Paths of the images under directory, sorted"""
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                paths.append(os.path.abspath(os.path.join(root, name)))
+    return paths
+
+
+def _taken_at(exif):
+    value = exif.get_ifd(EXIF_IFD).get(DATE_TIME_ORIGINAL) or exif.get(DATE_TIME)
+    try:
+        taken_at = datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+    # EXIF times have no zone; read them in the current time zone
+    return timezone.make_aware(taken_at) if settings.USE_TZ else taken_at
+
+
+def read_file(path):
+    """Return the Photo fields of an image file, or None if it cannot be read"""
+    try:
+        return _read_file(path)
+    except Exception as e:
+        # Pillow raises many types for broken files (including DecompressionBombError,
+        # which is not an OSError); one file must not stop the import
+        logger.warning("Skipping unreadable image %s: %r", path, e)
+        return None
+
+
+def _read_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    with Image.open(path) as image:
+        width, height = image.size
+        exif = image.getexif()
+    if exif.get(ORIENTATION) in TRANSPOSED:
+        width, height = height, width
+    camera = " ".join(str(exif[tag]).strip("\x00 ") for tag in (MAKE, MODEL) if exif.get(tag))
+    _, _, _, placeholder = derivatives.render_placeholder(None, path)
+    return dict(
+        source=path,
+        content_hash=digest.hexdigest(),
+        width=width,
+        height=height,
+        taken_at=_taken_at(exif),
+        camera=camera[:100],
+        placeholder=placeholder,
+    )
+
+
+def _insert(batch):
+    with sqlite.serialized_writes(), transaction.atomic():
+        Photo.objects.bulk_create(batch)
+
+
+def import_directory(directory, workers=None, batch_size=BATCH_SIZE, progress=None):
+    """Import the new images under directory. Returns (imported, skipped, duplicates, unreadable) counts"""
+    paths = find_files(directory)
+    imported_paths = set(Photo.objects.exclude(source="").values_list("source", flat=True))
+    new_paths = [path for path in paths if path not in imported_paths]
+    hashes = set(Photo.objects.exclude(content_hash="").values_list("content_hash", flat=True))
+
+    imported = duplicates = unreadable = 0
+    batch = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for fields in executor.map(read_file, new_paths, chunksize=16):
+            if fields is None:
+                unreadable += 1
+                continue
+            if fields["content_hash"] in hashes:
+                duplicates += 1
+                continue
+            hashes.add(fields["content_hash"])
+            batch.append(Photo(**fields))
+            if len(batch) >= batch_size:
+                _insert(batch)
+                imported += len(batch)
+                batch = []
+                if progress:
+                    progress(imported, len(new_paths))
+    if batch:
+        _insert(batch)
+        imported += len(batch)
+    if imported:
+        # bulk_create does not send post_save
+        stats.rebuild()
+        versions.bump_photos()
+    return imported, len(paths) - len(new_paths), duplicates, unreadable
@@ -0,0 +1,285 @@
+"""Write-behind vote ingestion (enabled with VOTE_WRITE_BEHIND)
+
+Votes are queued in memory and written by a background thread every
+VOTE_FLUSH_INTERVAL seconds (or as soon as VOTE_FLUSH_SIZE votes are queued)
+with a single bulk upsert, so a burst of votes costs one write transaction
+instead of one per vote.
+
+Durability is controlled by VOTE_JOURNAL_DIR. Without it, queued votes only
+live in memory and are lost if the process dies before flushing. With it,
+each process appends queued votes to its own journal file (fsync'd if
+VOTE_JOURNAL_FSYNC), which is cleared after each flush. Journals left behind
+by dead processes are replayed by the next process that starts a buffer;
+each entry has the time of the vote, so entries older than the stored vote
+(e.g. voted again through another process since) are skipped.
+
+A flush that fails on a transient error (the database is locked) is retried
+with the next one. Votes for photos or users deleted since they were queued
+are dropped and logged, so they cannot block the rest of the queue.
+
+Each user's queued votes are also kept in the shared cache so that pages
+rendered by any process show them before they are flushed (see get_pending).
+"""
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import IntegrityError, InterfaceError, OperationalError, connection
+
+from core import sqlite, versions, voted, votes
+from core.models import Photo, Vote
+
+PENDING_KEY = "pending-votes:{}"
+
+logger = logging.getLogger(__name__)
+
+
+class VoteBuffer:
+    def __init__(self, interval, size, journal_dir=None, fsync=True):
+        self.interval = interval
+        self.size = size
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.journal = None
+        self.journal_path = None
+        self.thread = None
+
+    def start(self):
+        if self.journal_dir:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            # A unique name, so a journal left by a dead process with the same pid is
+            # recovered rather than reused. The journal is locked before it gets its
+            # .jsonl name, so recover() in other processes never sees it unlocked.
+            fd, tmp_path = tempfile.mkstemp(
+                prefix="votes-{}-".format(os.getpid()), suffix=".jsonl.tmp", dir=self.journal_dir
+            )
+            self.journal = os.fdopen(fd, "a+")
+            fcntl.flock(self.journal, fcntl.LOCK_EX)
+            self.journal_path = tmp_path[: -len(".tmp")]
+            os.rename(tmp_path, self.journal_path)
+            self.recover()
+        self.thread = threading.Thread(target=self.run, name="vote-buffer", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def recover(self):
+        """Queue the votes of journals whose process is gone, unless the stored vote is newer"""
+        for path in glob.glob(os.path.join(self.journal_dir, "votes-*.jsonl")):
+            if path == self.journal_path:
+                continue
+            try:
+                journal = open(path)
+            except FileNotFoundError:
+                # Recovered by another process
+                continue
+            with journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Owned by a live process
+                    continue
+                if os.fstat(journal.fileno()).st_nlink == 0:
+                    # Recovered and removed by another process while we waited
+                    continue
+                entries = [_parse_entry(line) for line in journal if line.strip()]
+                recovered = _newer_than_stored(entries)
+                for user_id, photo_id, selection, timestamp in recovered:
+                    self.add(user_id, photo_id, selection, timestamp)
+                # Removed while locked, after its votes are in our own journal
+                os.remove(path)
+            logger.info(
+                "Recovered %d queued votes from %s (%d older than the stored votes)",
+                len(recovered),
+                path,
+                len(entries) - len(recovered),
+            )
+
+    def add(self, user_id, photo_id, selection, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            self.pending[(user_id, photo_id)] = (selection, timestamp)
+            if self.journal:
+                self.journal.write(json.dumps([user_id, photo_id, selection, timestamp]) + "\n")
+                self.journal.flush()
+                if self.fsync:
+                    os.fsync(self.journal.fileno())
+            full = len(self.pending) >= self.size
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return 0
+            try:
+                written = _write(batch)
+            except (OperationalError, InterfaceError):
+                # e.g. the database is locked; retried with the next flush
+                logger.exception("Failed to flush %d votes, requeueing", len(batch))
+                with self.lock:
+                    batch.update(self.pending)
+                    self.pending = batch
+                return 0
+            except Exception:
+                # Requeueing would fail every later flush as well
+                logger.exception("Failed to flush %d votes, dropping %s", len(batch), json.dumps(_entries(batch)))
+                written = 0
+            with self.lock:
+                if self.journal:
+                    # Rewrite the journal with the votes queued during the flush
+                    self.journal.seek(0)
+                    self.journal.truncate()
+                    for entry in _entries(self.pending):
+                        self.journal.write(json.dumps(entry) + "\n")
+                    self.journal.flush()
+                    if self.fsync:
+                        os.fsync(self.journal.fileno())
+            _clear_pending(batch)
+            return written
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                connection.close()
+
+
+def _entries(pending):
+    """Journal entries [user_id, photo_id, selection, timestamp] of {(user_id, photo_id): (selection, timestamp)}"""
+    return [
+        [user_id, photo_id, selection, timestamp] for (user_id, photo_id), (selection, timestamp) in pending.items()
+    ]
+
+
+def _parse_entry(line):
+    entry = json.loads(line)
+    if len(entry) == 3:
+        # Written before entries had a timestamp
+        entry.append(None)
+    return entry
+
+
+def _newer_than_stored(entries):
+    """The entries whose vote is newer than the stored vote for the same user and photo
+
+    Entries without a timestamp and votes stored without one count as older.
+    """
+    keys = {(user_id, photo_id) for user_id, photo_id, _, _ in entries}
+    stored = {}
+    for chunk in votes._chunks(list(keys), votes.UPSERT_BATCH_SIZE):
+        found = Vote.objects.filter(
+            user_id__in={user_id for user_id, _ in chunk}, photo_id__in={photo_id for _, photo_id in chunk}
+        )
+        for user_id, photo_id, modified in found.values_list("user_id", "photo_id", "modified"):
+            stored[(user_id, photo_id)] = modified.timestamp() if modified else None
+    return [entry for entry in entries if _is_newer(entry[3], stored.get((entry[0], entry[1]), False))]
+
+
+def _is_newer(timestamp, stored):
+    """stored is the timestamp of the stored vote, None if it has none, False if there is no vote"""
+    if stored is False:
+        return True
+    if timestamp is None:
+        return False
+    return stored is None or timestamp >= stored
+
+
+def _existing_ids(model, ids):
+    existing = set()
+    for chunk in votes._chunks(list(ids), votes.UPSERT_BATCH_SIZE):
+        existing.update(model.objects.filter(id__in=chunk).values_list("id", flat=True))
+    return existing
+
+
+def _write(batch):
+    """Upsert the batch, returns the number of votes written"""
+    rows = [
+        (user_id, photo_id, selection, datetime.fromtimestamp(timestamp, timezone.utc))
+        for (user_id, photo_id), (selection, timestamp) in batch.items()
+    ]
+    with sqlite.serialized_writes():
+        try:
+            votes.bulk_upsert(rows)
+        except IntegrityError:
+            # Votes for photos or users deleted after the votes were queued
+            user_ids = _existing_ids(get_user_model(), {row[0] for row in rows})
+            photo_ids = _existing_ids(Photo, {row[1] for row in rows})
+            valid = [row for row in rows if row[0] in user_ids and row[1] in photo_ids]
+            logger.warning(
+                "Dropping %d queued votes of deleted users or photos: %s",
+                len(rows) - len(valid),
+                [row[:3] for row in rows if row[0] not in user_ids or row[1] not in photo_ids],
+            )
+            votes.bulk_upsert(valid)
+            return len(valid)
+    return len(rows)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                buffer = VoteBuffer(
+                    settings.VOTE_FLUSH_INTERVAL,
+                    settings.VOTE_FLUSH_SIZE,
+                    settings.VOTE_JOURNAL_DIR,
+                    settings.VOTE_JOURNAL_FSYNC,
+                )
+                buffer.start()
+                _buffer = buffer
+    return _buffer
+
+
+def enqueue(user_id, photo_id, selection):
+    get_buffer().add(user_id, photo_id, selection)
+    key = PENDING_KEY.format(user_id)
+    pending = cache.get(key, {})
+    pending[photo_id] = selection
+    cache.set(key, pending, None)
+    voted.mark(user_id, versions.bump_votes(user_id), [photo_id])
+
+
+def _clear_pending(batch):
+    by_user = {}
+    for (user_id, photo_id), (selection, _) in batch.items():
+        by_user.setdefault(user_id, {})[photo_id] = selection
+    for user_id, flushed in by_user.items():
+        key = PENDING_KEY.format(user_id)
+        pending = cache.get(key, {})
+        # Keep votes that were changed again after this batch was taken
+        pending = {k: v for k, v in pending.items() if flushed.get(k) != v}
+        if pending:
+            cache.set(key, pending, None)
+        else:
+            cache.delete(key)
+
+
+def get_pending(user_id):
+    """Return {photo_id: selection} of the user's votes that are not flushed yet"""
+    if not settings.VOTE_WRITE_BEHIND:
+        return {}
+    return cache.get(PENDING_KEY.format(user_id), {})
@@ -0,0 +1,63 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from core import ranking
+from core.scheduling import PriorityQueue
+
+
+class Command(BaseCommand):
+    help = "Simulate raters and compare how fast sequential and uncertainty-driven scheduling find the top photos"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--photos", type=int, default=982)
+        parser.add_argument("--users", type=int, default=30)
+        parser.add_argument("--top", type=int, default=10)
+        parser.add_argument("--rebuild-every", type=int, default=500, help="Votes between full queue rebuilds")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def simulate(self, strategy, probabilities, options, checkpoints):
+        random = np.random.RandomState(options["seed"])
+        photos, users, top_n = options["photos"], options["users"], options["top"]
+        ids = np.arange(1, photos + 1)
+        truth = set(ids[np.argsort(-(probabilities @ ranking.SCORES), kind="stable")[:top_n]].tolist())
+        counts = np.zeros((photos, 3))
+        voted = [0] * users
+        positions = [0] * users
+        queue = PriorityQueue(ids, counts, top_n)
+        results = []
+        for vote in range(1, checkpoints[-1] + 1):
+            user = vote % users
+            if strategy == "sequential":
+                if positions[user] >= photos:
+                    break
+                photo_id = int(ids[positions[user]])
+                positions[user] += 1
+            else:
+                photo_id = queue.next_photo(voted[user])
+                if photo_id is None:
+                    break
+            voted[user] |= 1 << photo_id
+            counts[photo_id - 1, random.choice(3, p=probabilities[photo_id - 1])] += 1
+            if strategy == "scheduled":
+                if vote % options["rebuild_every"] == 0:
+                    queue = PriorityQueue(ids, counts, top_n)
+                else:
+                    queue.update(np.array([photo_id]), counts[photo_id - 1 : photo_id])
+            if vote in checkpoints:
+                found = set(ranking.compute(ranking.BAYESIAN, ids, counts).ids[:top_n].tolist())
+                results.append(len(found & truth))
+        return results
+
+    def handle(self, *args, **options):
+        random = np.random.RandomState(options["seed"])
+        # Each photo has its own chances of getting a bad/okay/good vote
+        probabilities = random.dirichlet([1, 1, 1], size=options["photos"])
+        total = options["photos"] * options["users"]
+        checkpoints = sorted({int(total * fraction) for fraction in [0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0]})
+        print("{photos} photos, {users} users, true top {top} found by Bayesian ranking:".format(**options))
+        print("{:>8s} {:>12s} {:>12s}".format("votes", "sequential", "scheduled"))
+        sequential = self.simulate("sequential", probabilities, options, checkpoints)
+        scheduled = self.simulate("scheduled", probabilities, options, checkpoints)
+        for votes, a, b in zip(checkpoints, sequential, scheduled):
+            found = ["{}/{}".format(count, options["top"]) for count in (a, b)]
+            print("{:8d} {:>12s} {:>12s}".format(votes, *found))
@@ -0,0 +1,145 @@
+import fcntl
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.test.utils import override_settings
+
+PHOTOS = 982
+USERS = 50
+
+SCHEMA = """
+CREATE TABLE photo (id INTEGER PRIMARY KEY, votes INTEGER, total REAL, average REAL);
+CREATE TABLE vote (id INTEGER PRIMARY KEY, user_id INTEGER, photo_id INTEGER, selection TEXT,
+                   UNIQUE (user_id, photo_id));
+"""
+
+
+def connect(path, profile):
+    """A connection to path configured like the default database, or with Django's defaults"""
+    default = connections[DEFAULT_DB_ALIAS]
+    settings_dict = dict(default.settings_dict, NAME=path)
+    if profile == "default":
+        # Django's defaults: rollback journal, 5 second timeout
+        settings_dict["OPTIONS"] = {}
+        with override_settings(SQLITE_PRAGMAS={}):
+            connection = default.__class__(settings_dict, alias="bench")
+            connection.ensure_connection()
+        return connection
+    # OPTIONS and SQLITE_PRAGMAS (through the connection_created signal) of the default database
+    connection = default.__class__(settings_dict, alias="bench")
+    connection.ensure_connection()
+    return connection
+
+
+def vote(connection):
+    """Read-then-write transaction like a vote POST"""
+    user_id = random.randint(1, USERS)
+    photo_id = random.randint(1, PHOTOS)
+    with connection.cursor() as cursor:
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("SELECT * FROM photo WHERE id = %s", [photo_id])
+            cursor.fetchone()
+            cursor.execute("SELECT * FROM vote WHERE user_id = %s AND photo_id = %s", [user_id, photo_id])
+            cursor.fetchone()
+            cursor.execute(
+                "INSERT INTO vote (user_id, photo_id, selection) VALUES (%s, %s, 'GD') "
+                "ON CONFLICT (user_id, photo_id) DO UPDATE SET selection = excluded.selection",
+                [user_id, photo_id],
+            )
+            cursor.execute("UPDATE photo SET votes = votes + 1, total = total + 5 WHERE id = %s", [photo_id])
+            cursor.execute("COMMIT")
+        except OperationalError:
+            cursor.execute("ROLLBACK")
+            raise
+
+
+def read(connection):
+    """Photo list queries"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT * FROM photo ORDER BY average DESC, id LIMIT 48")
+        cursor.fetchall()
+        cursor.execute("SELECT photo_id, selection FROM vote WHERE user_id = %s", [random.randint(1, USERS)])
+        cursor.fetchall()
+
+
+def worker(path, profile, kind, duration, lock_path, results):
+    connection = connect(path, profile)
+    lock = open(lock_path, "a") if lock_path else None
+    done = errors = 0
+    end = time.time() + duration
+    while time.time() < end:
+        try:
+            if kind == "write":
+                if lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    vote(connection)
+                finally:
+                    if lock:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+            else:
+                read(connection)
+            done += 1
+        except OperationalError:
+            errors += 1
+    connection.close()
+    results.put((kind, done, errors))
+
+
+class Command(BaseCommand):
+    help = "Compare SQLite read/write throughput of the default and the production profile under concurrent load"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--readers", type=int, default=8)
+        parser.add_argument("--writers", type=int, default=8)
+        parser.add_argument("--duration", type=float, default=5, help="Seconds per profile")
+
+    def run_profile(self, profile, options):
+        with tempfile.TemporaryDirectory() as directory:
+            self.run_in_directory(directory, profile, options)
+
+    def run_in_directory(self, directory, profile, options):
+        path = os.path.join(directory, "bench.sqlite3")
+        setup = connect(path, profile)
+        with setup.cursor() as cursor:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    cursor.execute(statement)
+            cursor.executemany("INSERT INTO photo VALUES (%s, 0, 0, 0)", [(i,) for i in range(1, PHOTOS + 1)])
+        setup.close()
+        lock_path = os.path.join(directory, "bench.lock") if profile == "production" else None
+
+        results = multiprocessing.Queue()
+        kinds = ["read"] * options["readers"] + ["write"] * options["writers"]
+        processes = [
+            multiprocessing.Process(target=worker, args=(path, profile, kind, options["duration"], lock_path, results))
+            for kind in kinds
+        ]
+        for process in processes:
+            process.start()
+        totals = {"read": [0, 0], "write": [0, 0]}
+        for _ in processes:
+            kind, done, errors = results.get()
+            totals[kind][0] += done
+            totals[kind][1] += errors
+        for process in processes:
+            process.join()
+
+        for kind in ["read", "write"]:
+            done, errors = totals[kind]
+            print(
+                "{:10s} {:5s}: {:8.1f} ops/s, {} errors".format(
+                    profile, kind, done / options["duration"], errors
+                )
+            )
+
+    def handle(self, *args, **options):
+        print("{readers} readers, {writers} writers, {duration}s per profile".format(**options))
+        for profile in ["default", "production"]:
+            self.run_profile(profile, options)
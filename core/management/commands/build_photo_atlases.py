@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from core import atlases, versions
+from core.models import Photo
+
+
+class Command(BaseCommand):
+    help = "Pack photo thumbnails into sprite atlases for the photo list"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=None, help="Worker processes (CPU count by default)")
+        parser.add_argument("--force", action="store_true", help="Render unchanged atlases again")
+
+    def handle(self, *args, **options):
+        photos = list(Photo.objects.order_by("id").values_list("id", "source"))
+        rendered, unchanged = atlases.build(photos, options["workers"], options["force"])
+        # Cached pages embed the atlas positions
+        versions.bump_photos()
+        manifest = atlases.load_manifest()
+        print("Rendered {} atlases, unchanged {}.".format(rendered, unchanged))
+        print("{} of {} photos in atlases at {}".format(len(manifest["photos"]), len(photos), atlases.output_dir()))
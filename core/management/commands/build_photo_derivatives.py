@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core import derivatives, versions
+from core.models import Photo
+
+
+class Command(BaseCommand):
+    help = "Render every photo at several widths in AVIF/WebP/JPEG, skipping sources that did not change"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, help="Photo ids (all photos if omitted)")
+        parser.add_argument("--workers", type=int, default=None, help="Worker processes (CPU count by default)")
+        parser.add_argument("--force", action="store_true", help="Render unchanged sources again")
+
+    def handle(self, *args, **options):
+        photos = Photo.objects.order_by("id")
+        if options["ids"]:
+            photos = photos.filter(id__in=options["ids"])
+        print("Formats: {}".format(", ".join(derivatives.available_formats())))
+        rendered, skipped, missing, failed = derivatives.build(
+            list(photos.values_list("id", "source")), options["workers"], options["force"]
+        )
+        if rendered:
+            # Cached pages and ETags embed the srcsets
+            versions.bump_photos()
+        print("Rendered {}, unchanged {}, missing source {}, failed {}.".format(rendered, skipped, missing, failed))
+        print("Derivatives written to {}".format(derivatives.output_dir()))
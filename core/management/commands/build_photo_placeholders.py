@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from core import derivatives, versions
+from core.models import Photo
+
+
+class Command(BaseCommand):
+    help = "Store the size and a tiny blurred placeholder of every photo"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=None, help="Worker processes (CPU count by default)")
+        parser.add_argument("--force", action="store_true", help="Also redo photos that already have a placeholder")
+
+    def handle(self, *args, **options):
+        photos = Photo.objects.only("id", "source", "width", "height", "placeholder").order_by("id")
+        if not options["force"]:
+            photos = photos.filter(placeholder="")
+        updated, missing, failed = derivatives.build_placeholders(list(photos), options["workers"])
+        if updated:
+            versions.bump_photos()
+        print("Updated {} photos, missing source {}, failed {}.".format(updated, missing, failed))
@@ -0,0 +1,45 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import exports, ranking, versions
+
+
+class Command(BaseCommand):
+    help = "Stream the votes or a photo ranking to a CSV or JSON lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=exports.KINDS)
+        parser.add_argument("--output", "-o", help="File to write (standard output by default)")
+        parser.add_argument("--format", choices=exports.FORMATS, default=exports.CSV)
+        parser.add_argument("--gzip", action="store_true", help="Compress the output")
+        parser.add_argument("--method", choices=ranking.METHODS, default=exports.DEFAULT_METHOD)
+        parser.add_argument("--user-min", type=int)
+        parser.add_argument("--user-max", type=int)
+        parser.add_argument("--photo-min", type=int)
+        parser.add_argument("--photo-max", type=int)
+
+    def handle(self, *args, **options):
+        filters = {
+            name: options[name]
+            for name in ["user_min", "user_max", "photo_min", "photo_max"]
+            if options[name] is not None
+        }
+        try:
+            content = exports.export(
+                options["kind"],
+                options["format"],
+                options["gzip"],
+                options["method"],
+                versions.get_versions().votes,
+                **filters
+            )
+        except ValueError as e:
+            raise CommandError(e)
+        output = open(options["output"], "wb") if options["output"] else sys.stdout.buffer
+        try:
+            for block in content:
+                output.write(block)
+        finally:
+            if options["output"]:
+                output.close()
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core import duplicates, versions
+
+
+class Command(BaseCommand):
+    help = "Hash every photo perceptually and group near-duplicate photos into clusters"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=None, help="Worker processes (CPU count by default)")
+        parser.add_argument(
+            "--threshold", type=int, default=None, help="Maximum differing hash bits (DUPLICATE_THRESHOLD by default)"
+        )
+        parser.add_argument("--force", action="store_true", help="Also rehash photos that already have a hash")
+
+    def handle(self, *args, **options):
+        hashed, clustered, clusters = duplicates.build(options["workers"], options["threshold"], options["force"])
+        versions.bump_photos()
+        print("Hashed {} photos. {} photos in {} duplicate clusters.".format(hashed, clustered, clusters))
@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import importer
+
+
+class Command(BaseCommand):
+    help = "Import the images under a directory as photos; run again to resume an interrupted import"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory")
+        parser.add_argument("--workers", type=int, default=None, help="Worker processes (CPU count by default)")
+        parser.add_argument("--batch-size", type=int, default=importer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options["directory"]):
+            raise CommandError("{} is not a directory".format(options["directory"]))
+
+        def progress(imported, total):
+            print("Imported {}/{}".format(imported, total))
+
+        imported, skipped, duplicates, unreadable = importer.import_directory(
+            options["directory"], options["workers"], options["batch_size"], progress
+        )
+        print(
+            "Imported {} photos, {} already imported, {} duplicates, {} unreadable (skipped).".format(
+                imported, skipped, duplicates, unreadable
+            )
+        )
+        if imported:
+            # Imported photos are only served from their derivatives
+            print("Run build_photo_derivatives to render the new photos.")
@@ -0,0 +1,38 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import ballots
+
+
+class Command(BaseCommand):
+    help = "Import votes from a CSV ballot file (see core/ballots.py for the columns)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="CSV file, - for standard input")
+        parser.add_argument("--dry-run", action="store_true", help="Only validate the file")
+
+    def handle(self, *args, **options):
+        try:
+            f = sys.stdin if options["file"] == "-" else open(options["file"], newline="", encoding="utf-8-sig")
+        except OSError as e:
+            raise CommandError(e)
+        try:
+            result = ballots.import_ballots(f, options["dry_run"])
+        except ballots.BallotError as e:
+            raise CommandError(e)
+        finally:
+            f.close()
+        for line, message in result.errors:
+            print("Line {}: {}".format(line, message))
+        if result.error_count > len(result.errors):
+            print("... {} more errors".format(result.error_count - len(result.errors)))
+        print(
+            "{} rows, {} valid votes ({} new), {} errors{}.".format(
+                result.rows,
+                len(result.votes),
+                result.created,
+                result.error_count,
+                ", nothing imported (dry run)" if options["dry_run"] else "",
+            )
+        )
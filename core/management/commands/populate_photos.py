@@ -1,12 +1,18 @@
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand
 
+from core import stats, versions
 from core.models import Photo
 
+# Bundled photos, served from the static files named after their id (core/media/grad/gradNNN.jpg)
+BUNDLED_PHOTOS = 982
+
 
 class Command(BaseCommand):
+    help = "Create the bundled photos; see import_photos for other sets"
+
     def handle(self, *args, **options):
         count = Photo.objects.all().count()
-        if count == 982:
+        if count == BUNDLED_PHOTOS:
             print("Photos already populated")
             return
         elif count != 0:
@@ -15,7 +21,10 @@ class Command(BaseCommand):
             return
 
         photos = []
-        for i in range(982):
+        for i in range(BUNDLED_PHOTOS):
             photos.append(Photo())
         Photo.objects.bulk_create(photos)
+        # bulk_create does not send post_save
+        stats.rebuild()
+        versions.bump_photos()
         print("Photos successfully populated.")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core import stats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the progress counters from the vote, photo and user tables"
+
+    def handle(self, *args, **options):
+        counters = stats.rebuild()
+        print("Rebuilt {} counters.".format(len(counters)))
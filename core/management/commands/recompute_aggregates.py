@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from core import aggregates, versions
+
+
+class Command(BaseCommand):
+    help = "Recompute the vote aggregates of all photos from the vote table and fix the ones that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--verify", action="store_true", help="Only report drifted photos, do not fix them")
+        parser.add_argument("--show", type=int, default=20, help="Number of drifted photos to list")
+
+    def handle(self, *args, **options):
+        drifted = aggregates.repair(dry_run=options["verify"])
+        for photo_id, stored, actual in drifted[: options["show"]]:
+            changes = [
+                "{} {} -> {}".format(field, stored[field], actual[field])
+                for field in aggregates.AGGREGATE_FIELDS
+                if stored[field] != actual[field]
+            ]
+            print("Photo {}: {}".format(photo_id, ", ".join(changes)))
+        if len(drifted) > options["show"]:
+            print("...")
+        if options["verify"]:
+            print("{} photos drifted.".format(len(drifted)))
+        else:
+            if drifted:
+                versions.bump_votes()
+            print("Fixed {} drifted photos.".format(len(drifted)))
@@ -0,0 +1,33 @@
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from core import matrix
+
+
+class Command(BaseCommand):
+    help = "Build the vote matrix and report rater agreement and bias"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="Rebuild the matrix from the Vote table")
+        parser.add_argument("--top", type=int, default=10, help="Photos to show from the normalized ranking")
+
+    def handle(self, *args, **options):
+        vote_matrix = matrix.build() if options["rebuild"] else matrix.get_matrix()
+        users, photos = vote_matrix.values.shape
+        print("Vote matrix: {} users x {} photos ({})".format(users, photos, vote_matrix.path))
+
+        alpha = vote_matrix.krippendorff_alpha()
+        print("Krippendorff's alpha (interval): {}".format("n/a" if alpha is None else "{:.3f}".format(alpha)))
+
+        names = dict(get_user_model().objects.values_list("id", "email"))
+        counts = (np.asarray(vote_matrix.values) > 0).sum(axis=1)
+        print("\nRater bias (mean score minus overall mean):")
+        for user_id, bias, count in zip(vote_matrix.user_ids, vote_matrix.user_bias(), counts):
+            if count:
+                print("  {:40s} {:+.2f} ({} votes)".format(names.get(int(user_id), str(user_id)), bias, count))
+
+        ranking = vote_matrix.normalized_ranking()
+        print("\nTop {} by rater-normalized score:".format(options["top"]))
+        for i in range(min(options["top"], len(ranking))):
+            print("  #{} Photo {} ({:+.3f})".format(i + 1, ranking.ids[i], ranking.scores[i]))
@@ -0,0 +1,314 @@
+"""Dense users x photos vote matrix for analytics
+
+The matrix holds one int8 per (user, photo): 0 for no vote, otherwise the score
+(1, 3 or 5). It is built from the Vote table in one streaming pass, stored as a
+memory-mapped .npy file (with the row/column ids in a JSON file next to it)
+that VOTE_MATRIX_PATH links to, and updated in place by core.signals when votes are written.
+A vote by a user or on a photo that is not in the matrix yet starts a rebuild
+in a background thread, and the current matrix is used until the new one
+replaces it.
+
+Each build writes the matrix and its ids under a new versioned name and then
+replaces the link, so readers never pair the ids of one build with the matrix
+of another. Builds finally apply the votes written while the table was read.
+
+Analytics on top of the matrix are vectorized over all raters and photos.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.utils import timezone
+
+from core.models import Photo, Vote
+
+CHUNK_SIZE = 20000
+SCORES = {Vote.BAD: 1, Vote.OKAY: 3, Vote.GOOD: 5}
+# Votes modified up to this long before a build started are read again after it
+CATCH_UP = timedelta(seconds=60)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# Held while a background rebuild runs
+_rebuild_lock = threading.Lock()
+_matrix = None
+
+
+def _index_path(path):
+    return path + ".ids.json"
+
+
+class VoteMatrix:
+    def __init__(self, path):
+        self.path = path
+        # A version replaced by another process may be removed between resolving the link and opening it
+        for attempt in range(3):
+            version_path = os.path.realpath(path)
+            try:
+                with open(_index_path(version_path)) as f:
+                    index = json.load(f)
+                self.values = np.load(version_path, mmap_mode="r+")
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+        self.user_ids = np.array(index["user_ids"], dtype=np.int64)
+        self.photo_ids = np.array(index["photo_ids"], dtype=np.int64)
+        self.inode = os.stat(version_path).st_ino
+        if self.values.shape != (len(self.user_ids), len(self.photo_ids)):
+            raise ValueError("Vote matrix does not match its ids")
+
+    def row(self, user_id):
+        i = np.searchsorted(self.user_ids, user_id)
+        return i if i < len(self.user_ids) and self.user_ids[i] == user_id else None
+
+    def column(self, photo_id):
+        j = np.searchsorted(self.photo_ids, photo_id)
+        return j if j < len(self.photo_ids) and self.photo_ids[j] == photo_id else None
+
+    def set(self, user_id, photo_id, selection):
+        """Store a vote (selection None for no vote). Returns False if the cell does not exist"""
+        i, j = self.row(user_id), self.column(photo_id)
+        if i is None or j is None:
+            return False
+        self.values[i, j] = SCORES[selection] if selection else 0
+        return True
+
+    def flush(self):
+        self.values.flush()
+
+    # Analytics
+
+    def _masked(self):
+        values = np.asarray(self.values, dtype=np.float64)
+        voted = values > 0
+        return values, voted
+
+    def user_means(self):
+        """Mean score of each user (nan for users without votes)"""
+        values, voted = self._masked()
+        n = voted.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return values.sum(axis=1) / n
+
+    def user_bias(self):
+        """How much higher than the overall mean each user scores (nan without votes)"""
+        values, voted = self._masked()
+        return self.user_means() - values[voted].mean() if voted.any() else self.user_means()
+
+    def normalized(self):
+        """Scores as z-scores within each user's own votes (nan where there is no vote)"""
+        values, voted = self._masked()
+        n = np.maximum(voted.sum(axis=1, keepdims=True), 1)
+        means = values.sum(axis=1, keepdims=True) / n
+        variances = (((values - means) ** 2) * voted).sum(axis=1, keepdims=True) / n
+        # Users who always give the same score only carry their bias
+        stds = np.where(variances > 0, np.sqrt(variances), 1)
+        return np.where(voted, (values - means) / stds, np.nan)
+
+    def normalized_scores(self):
+        """(mean, standard error, number of votes) of the normalized scores of each photo"""
+        normalized = self.normalized()
+        voted = ~np.isnan(normalized)
+        n = voted.sum(axis=0)
+        filled = np.where(voted, normalized, 0)
+        means = filled.sum(axis=0) / np.maximum(n, 1)
+        variances = (((filled - means) ** 2) * voted).sum(axis=0) / np.maximum(n, 1)
+        errors = np.where(n > 1, np.sqrt(variances / np.maximum(n, 1)), np.inf)
+        return np.where(n > 0, means, np.nan), errors, n
+
+    def krippendorff_alpha(self):
+        """Krippendorff's alpha (interval metric) over all photos with at least two votes"""
+        values = np.asarray(self.values)
+        levels = np.array(sorted(SCORES.values()))
+        # counts[u, c]: votes with score levels[c] on photo u
+        counts = np.stack([(values == level).sum(axis=0) for level in levels], axis=1).astype(np.float64)
+        m = counts.sum(axis=1)
+        counts = counts[m >= 2]
+        m = m[m >= 2]
+        if not len(m):
+            return None
+        # Coincidence matrix
+        weights = 1 / (m - 1)
+        coincidences = np.einsum("u,uc,uk->ck", weights, counts, counts)
+        coincidences -= np.diag((counts * weights[:, None]).sum(axis=0))
+        totals = coincidences.sum(axis=1)
+        n = totals.sum()
+        distances = (levels[:, None] - levels[None, :]) ** 2
+        expected = (np.outer(totals, totals) * distances).sum()
+        if expected == 0:
+            return None
+        return 1 - (n - 1) * (coincidences * distances).sum() / expected
+
+    def normalized_ranking(self):
+        """Ranking of photos by the mean of rater-normalized scores"""
+        from core.ranking import NORMALIZED, Ranking, Z
+
+        means, errors, n = self.normalized_scores()
+        voted = n > 0
+        # Photos without votes go last, with a finite score so it can be serialized
+        floor = means[voted].min() - 1 if voted.any() else 0.0
+        scores = np.where(voted, means, floor)
+        margins = np.where(n > 1, Z * errors, 0)
+        return Ranking(NORMALIZED, self.photo_ids.copy(), scores, scores - margins, scores + margins)
+
+
+def build(path=None):
+    """Build the matrix from the Vote table in one streaming pass"""
+    path = path or settings.VOTE_MATRIX_PATH
+    started = timezone.now()
+    user_ids = np.array(sorted(get_user_model().objects.values_list("id", flat=True)), dtype=np.int64)
+    photo_ids = np.array(sorted(Photo.objects.values_list("id", flat=True)), dtype=np.int64)
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # The matrix and its ids are written under one versioned name, which the symlink at path then points to
+    fd, version_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".npy", dir=directory)
+    os.close(fd)
+    link_path = version_path + ".link"
+    try:
+        values = np.lib.format.open_memmap(
+            version_path, mode="w+", dtype=np.int8, shape=(len(user_ids), len(photo_ids))
+        )
+        values[:] = 0
+
+        rows = Vote.objects.values_list("user_id", "photo_id", "selection").order_by()
+        chunk = []
+        for row in rows.iterator(chunk_size=CHUNK_SIZE):
+            chunk.append(row)
+            if len(chunk) >= CHUNK_SIZE:
+                _fill(values, user_ids, photo_ids, chunk)
+                chunk = []
+        _fill(values, user_ids, photo_ids, chunk)
+        values.flush()
+        del values
+
+        with open(_index_path(version_path), "w") as f:
+            json.dump(dict(user_ids=user_ids.tolist(), photo_ids=photo_ids.tolist()), f)
+        previous_path = os.path.realpath(path) if os.path.islink(path) else None
+        os.symlink(os.path.basename(version_path), link_path)
+        os.replace(link_path, path)
+    except BaseException:
+        for tmp_path in [version_path, _index_path(version_path), link_path]:
+            _remove(tmp_path)
+        raise
+    if previous_path:
+        _remove_version(previous_path)
+    # Matrices from before versioning kept their ids next to path
+    _remove(_index_path(path))
+
+    matrix = VoteMatrix(path)
+    _catch_up(matrix, started - CATCH_UP)
+    return matrix
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_version(version_path):
+    """Remove a replaced version; processes that have it open keep their mapping"""
+    _remove(version_path)
+    _remove(_index_path(version_path))
+
+
+def _catch_up(matrix, since):
+    """Apply the votes modified since then, which the streamed pass may have missed"""
+    rows = Vote.objects.filter(modified__gte=since).values_list("user_id", "photo_id", "selection")
+    for user_id, photo_id, selection in rows.iterator(chunk_size=CHUNK_SIZE):
+        matrix.set(user_id, photo_id, selection)
+    matrix.flush()
+
+
+def _fill(values, user_ids, photo_ids, chunk):
+    if not chunk:
+        return
+    users, photos, selections = zip(*chunk)
+    users = np.array(users, dtype=np.int64)
+    photos = np.array(photos, dtype=np.int64)
+    rows = np.searchsorted(user_ids, users)
+    columns = np.searchsorted(photo_ids, photos)
+    # Votes by users or on photos created after the ids were read are not in the matrix; _catch_up skips them too
+    found = (rows < len(user_ids)) & (columns < len(photo_ids))
+    found[found] = (user_ids[rows[found]] == users[found]) & (photo_ids[columns[found]] == photos[found])
+    scores = np.array([SCORES[selection] for selection in selections], dtype=np.int8)
+    values[rows[found], columns[found]] = scores[found]
+
+
+def get_matrix():
+    """Return the vote matrix, building it if it does not exist"""
+    global _matrix
+    path = settings.VOTE_MATRIX_PATH
+    with _lock:
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            _matrix = build(path)
+            return _matrix
+        if _matrix is None or _matrix.inode != inode:
+            try:
+                _matrix = VoteMatrix(path)
+            except (OSError, ValueError):
+                _matrix = build(path)
+        return _matrix
+
+
+def invalidate():
+    global _matrix
+    with _lock:
+        _matrix = None
+        path = settings.VOTE_MATRIX_PATH
+        if os.path.islink(path):
+            _remove_version(os.path.realpath(path))
+        _remove(path)
+        _remove(_index_path(path))
+
+
+def rebuild_in_background():
+    """Rebuild the matrix in a thread, unless this process is rebuilding it already"""
+    if not _rebuild_lock.acquire(blocking=False):
+        return
+
+    def run():
+        global _matrix
+        try:
+            matrix = build()
+            with _lock:
+                _matrix = matrix
+        except Exception:
+            logger.exception("Failed to rebuild the vote matrix")
+        finally:
+            _rebuild_lock.release()
+            connection.close()
+
+    threading.Thread(target=run, name="vote-matrix", daemon=True).start()
+
+
+def update(votes):
+    """Apply [(user_id, photo_id, selection or None)] to the matrix if it has been built"""
+    if not os.path.exists(settings.VOTE_MATRIX_PATH):
+        return
+    try:
+        matrix = get_matrix()
+    except (OSError, ValueError):
+        invalidate()
+        return
+    missing = False
+    for user_id, photo_id, selection in votes:
+        if not matrix.set(user_id, photo_id, selection):
+            # e.g. the first vote of a new user
+            missing = True
+    matrix.flush()
+    if missing:
+        rebuild_in_background()
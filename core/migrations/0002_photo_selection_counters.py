@@ -0,0 +1,47 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+SELECTION_COUNTERS = {"BD": "bad", "OK": "okay", "GD": "good"}
+
+
+def backfill_counters(apps, schema_editor):
+    Photo = apps.get_model("core", "Photo")
+    Vote = apps.get_model("core", "Vote")
+    counts = {}
+    rows = Vote.objects.values("photo_id", "selection").annotate(count=models.Count("id"))
+    for row in rows.iterator():
+        photo_counts = counts.setdefault(row["photo_id"], {})
+        photo_counts[SELECTION_COUNTERS[row["selection"]]] = row["count"]
+    photos = list(Photo.objects.filter(id__in=counts.keys()))
+    for photo in photos:
+        for field, count in counts[photo.id].items():
+            setattr(photo, field, count)
+    Photo.objects.bulk_update(photos, ["bad", "okay", "good"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='bad',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='good',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='okay',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
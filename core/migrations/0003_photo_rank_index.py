@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_photo_selection_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['-average', 'id'], name='photo_rank_idx'),
+        ),
+    ]
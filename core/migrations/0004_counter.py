@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_counters(apps, schema_editor):
+    Counter = apps.get_model("core", "Counter")
+    Photo = apps.get_model("core", "Photo")
+    Vote = apps.get_model("core", "Vote")
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    counters = [
+        Counter(name="votes", value=Vote.objects.count()),
+        Counter(name="photos", value=Photo.objects.count()),
+        Counter(name="users", value=User.objects.count()),
+    ]
+    for user_id, count in User.objects.annotate(models.Count("vote")).values_list("id", "vote__count"):
+        counters.append(Counter(name="votes", user_id=user_id, value=count))
+    Counter.objects.bulk_create(counters, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0003_photo_rank_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Counter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=16)),
+                ('value', models.IntegerField(default=0)),
+                (
+                    'user',
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='counter',
+            constraint=models.UniqueConstraint(fields=('name', 'user'), name='counter_name_user_unique'),
+        ),
+        migrations.RunPython(build_counters, migrations.RunPython.noop),
+    ]
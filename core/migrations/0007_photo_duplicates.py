@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_photo_source'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='cluster',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='phash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_photo_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
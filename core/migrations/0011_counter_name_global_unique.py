@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def merge_global_counters(apps, schema_editor):
+    """Recount the global counters that were duplicated"""
+    Counter = apps.get_model("core", "Counter")
+    sources = {
+        "votes": apps.get_model("core", "Vote"),
+        "photos": apps.get_model("core", "Photo"),
+        "users": apps.get_model(*settings.AUTH_USER_MODEL.split(".")),
+    }
+    names = Counter.objects.filter(user=None).values("name").annotate(count=models.Count("id"))
+    for name in [row["name"] for row in names if row["count"] > 1]:
+        Counter.objects.filter(name=name, user=None).delete()
+        if name in sources:
+            Counter.objects.create(name=name, value=sources[name].objects.count())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0010_remove_photo_rank_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_global_counters, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='counter',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(user=None), fields=('name',), name='counter_name_global_unique'
+            ),
+        ),
+    ]
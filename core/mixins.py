@@ -0,0 +1,57 @@
+import hashlib
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from core import cache_stats, versions
+
+
+class VersionsMixin:
+    """Fetch the current user's versions (see core.versions) once per request"""
+
+    def get_versions(self):
+        if not hasattr(self, "_versions"):
+            self._versions = versions.get_versions(self.request.user.id)
+        return self._versions
+
+
+class ConditionalGetMixin(VersionsMixin):
+    """Answer If-None-Match / If-Modified-Since with 304 before the view does any work
+
+    Place after LoginRequiredMixin. Views define get_etag_parts() and may override
+    get_last_modified(); both are computed from the versions (one query), not from the
+    photos and votes.
+    """
+
+    conditional_name = None
+
+    def get_etag(self):
+        versions = self.get_versions()
+        parts = [versions.user, self.request.user.id] + list(self.get_etag_parts())
+        # Pages with forms embed a CSRF token derived from this cookie
+        parts.append(self.request.COOKIES.get(settings.CSRF_COOKIE_NAME, ""))
+        key = "-".join(str(part) for part in parts)
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+    def get_last_modified(self):
+        return self.get_versions().modified
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return super().dispatch(request, *args, **kwargs)
+
+        name = self.conditional_name or self.__class__.__name__
+        etag = self.get_etag()
+        last_modified = self.get_last_modified()
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            cache_stats.record_hit(name)
+        else:
+            cache_stats.record_miss(name)
+            response = super().dispatch(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response["ETag"] = etag
+            response["Last-Modified"] = http_date(last_modified)
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
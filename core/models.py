@@ -1,6 +1,10 @@
+import os
+
 from django.contrib.auth import get_user_model
-from django.db import models
-from django.templatetags.static import static
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, ExpressionWrapper, F, Q, Value, When
+
+from core import assets, atlases, derivatives, sqlite
 
 User = get_user_model()
 
@@ -9,6 +13,22 @@ class Photo(models.Model):
     votes = models.IntegerField(default=0)
     average = models.FloatField(default=0)
     total = models.FloatField(default=0)
+    bad = models.IntegerField(default=0)
+    okay = models.IntegerField(default=0)
+    good = models.IntegerField(default=0)
+    # Intrinsic size of the original and a tiny blurred data URI shown while it loads
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+    placeholder = models.TextField(blank=True)
+    # Set by the import_photos command; photos without a source use the static files named after their id
+    source = models.CharField(max_length=500, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    taken_at = models.DateTimeField(null=True, blank=True)
+    camera = models.CharField(max_length=100, blank=True)
+    # Set by the find_duplicates command (see core.duplicates)
+    phash = models.BigIntegerField(null=True, blank=True)
+    # Id of the first photo of this photo's near-duplicate cluster, None if it has no duplicates
+    cluster = models.IntegerField(null=True, blank=True, db_index=True)
 
     def update(self):
         selections = self.vote_set.values("selection").annotate(models.Count("user")).all()
@@ -19,25 +39,75 @@ class Photo(models.Model):
             total += Vote.selection_to_integer(s["selection"]) * s["user__count"]
         self.votes = votes
         self.total = total
-        self.average = total /votes
+        self.average = total / votes if votes else 0
+        self.bad = self.okay = self.good = 0
+        for s in selections:
+            setattr(self, Vote.selection_to_counter(s["selection"]), s["user__count"])
         self.save()
 
+    @classmethod
+    def apply_vote(cls, photo_id, old_selection, new_selection):
+        """Apply the change from old_selection to new_selection (either may be None)
+        to the aggregates of a photo using a single database-side UPDATE.
+        """
+        if old_selection == new_selection:
+            return
+        delta_votes = 0
+        delta_total = 0
+        fields = {}
+        if old_selection:
+            counter = Vote.selection_to_counter(old_selection)
+            fields[counter] = F(counter) - 1
+            delta_votes -= 1
+            delta_total -= Vote.selection_to_integer(old_selection)
+        if new_selection:
+            counter = Vote.selection_to_counter(new_selection)
+            fields[counter] = F(counter) + 1
+            delta_votes += 1
+            delta_total += Vote.selection_to_integer(new_selection)
+
+        votes = F("votes") + delta_votes
+        total = F("total") + delta_total
+        fields["votes"] = votes
+        fields["total"] = total
+        # All columns in SET refer to the values before the update
+        fields["average"] = Case(
+            When(votes=-delta_votes, then=Value(0.0)),
+            default=ExpressionWrapper(total / votes, output_field=models.FloatField()),
+            output_field=models.FloatField(),
+        )
+        cls.objects.filter(pk=photo_id).update(**fields)
+
+    def static_url(self, kind):
+        """URL of the static file named after the id; imported photos (with a source) have none"""
+        return "" if self.source else assets.get_url(kind, self.id)
+
     @property
     def src(self):
-        if self.id > 982:
-            return ""
-        else:
-            return static("core/media/grad/grad{:03d}.jpg".format(self.id))
+        return self.static_url(assets.ORIGINAL) or derivatives.get_url(self.id, largest=True)
 
     @property
     def thumb_src(self):
-        if self.id > 982:
-            return ""
-        else:
-            return static("core/media/grad_thumb/grad{:03d}.jpg".format(self.id))
+        return self.static_url(assets.THUMBNAIL) or derivatives.get_url(self.id)
+
+    @property
+    def sources(self):
+        """srcset of each derivative format (see core.derivatives), best format first
+
+        Derivatives and atlases are rendered from derivatives.source_path(), i.e.
+        from the imported source if the photo has one.
+        """
+        return derivatives.get_sources(self.id)
+
+    @property
+    def sprite(self):
+        """Position of the thumbnail in its sprite atlas (see core.atlases), None if it has none"""
+        return atlases.get_sprite(self.id)
 
     @property
     def name(self):
+        if self.source:
+            return os.path.basename(self.source)
         return "서강대단체{}.jpg".format(self.id)
 
 
@@ -54,6 +124,8 @@ class Vote(models.Model):
         (BAD, 'Bad (1)'),
     ]
     selection = models.CharField(max_length=2, choices=selection_choices)
+    # When the vote was cast; null for votes stored before it was recorded
+    modified = models.DateTimeField(auto_now=True, null=True)
 
     @classmethod
     def selection_to_integer(cls, selection):
@@ -66,7 +138,98 @@ class Vote(models.Model):
         else:
             raise AssertionError()
 
+    @classmethod
+    def selection_to_counter(cls, selection):
+        """Name of the Photo field counting votes with this selection"""
+        if selection == cls.GOOD:
+            return "good"
+        elif selection == cls.OKAY:
+            return "okay"
+        elif selection == cls.BAD:
+            return "bad"
+        else:
+            raise AssertionError()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Selection currently stored in the database, used to compute deltas
+        self._saved_selection = self.selection if self.pk else None
+
+    def _read_stored(self):
+        """Re-read the stored (pk, selection) of this user's vote on the photo inside the write
+        transaction: _saved_selection may be stale when requests change the same vote at once.
+        """
+        stored = Vote.objects.select_for_update().filter(user_id=self.user_id, photo_id=self.photo_id)
+        stored = stored.values_list("pk", "selection").first()
+        if stored and self.pk is None:
+            # Created by a concurrent request since this instance was made
+            self.pk = stored[0]
+        self._saved_selection = stored[1] if stored else None
+
+    def _save_with_delta(self, *args, **kwargs):
+        with sqlite.serialized_writes(), transaction.atomic():
+            self._read_stored()
+            super().save(*args, **kwargs)
+            Photo.apply_vote(self.photo_id, self._saved_selection, self.selection)
+        self._saved_selection = self.selection
+
+    def save(self, *args, **kwargs):
+        try:
+            self._save_with_delta(*args, **kwargs)
+        except IntegrityError:
+            # Another request inserted the vote between the read and the insert; update it instead
+            self._save_with_delta(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # The aggregates are updated by the post_delete handler in core.signals (also sent for
+        # cascades), from the selection read here
+        with sqlite.serialized_writes(), transaction.atomic():
+            self._read_stored()
+            if self._saved_selection is None:
+                # Already deleted by a concurrent request
+                return 0, {}
+            result = super().delete(*args, **kwargs)
+        self._saved_selection = None
+        return result
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=["user", "photo"], name="user_photo_unique")
         ]
+
+
+class Counter(models.Model):
+    """Maintained count used by the progress panel (see core.stats)
+
+    Global counters have no user. Per-user counters are named after the
+    global counter they contribute to.
+    """
+    VOTES = "votes"
+    PHOTOS = "photos"
+    USERS = "users"
+
+    name = models.CharField(max_length=16)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
+    value = models.IntegerField(default=0)
+
+    def __str__(self):
+        if self.user_id:
+            return "{} ({}): {}".format(self.name, self.user, self.value)
+        return "{}: {}".format(self.name, self.value)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["name", "user"], name="counter_name_user_unique"),
+            # NULLs are distinct in the constraint above, so global counters need their own
+            models.UniqueConstraint(fields=["name"], condition=Q(user=None), name="counter_name_global_unique"),
+        ]
+
+
+class Version(models.Model):
+    """Version counter used to key cached pages and HTTP validators (see core.versions)"""
+    name = models.CharField(max_length=32, unique=True)
+    value = models.BigIntegerField()
+    modified = models.DateTimeField()
+
+    def __str__(self):
+        return "{}: {}".format(self.name, self.value)
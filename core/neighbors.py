@@ -0,0 +1,40 @@
+"""Process-level sorted index of photo ids for next/previous navigation
+
+The index is rebuilt whenever the photo version (see core.versions) differs
+from the one it was built at, which happens when photos are added or removed
+in any process.
+"""
+import bisect
+import threading
+
+from core.models import Photo
+
+_lock = threading.Lock()
+_ids = []
+_version = None
+
+
+def get_ids(version):
+    """Sorted ids of all photos"""
+    global _ids, _version
+    if version != _version:
+        with _lock:
+            if version != _version:
+                _ids = list(Photo.objects.order_by("id").values_list("id", flat=True))
+                _version = version
+    return _ids
+
+
+def invalidate():
+    global _version
+    _version = None
+
+
+def get_neighbors(photo_id, version):
+    """Return (previous id, next id) of the photo, either may be None"""
+    ids = get_ids(version)
+    left = bisect.bisect_left(ids, photo_id)
+    right = bisect.bisect_right(ids, photo_id)
+    previous_id = ids[left - 1] if left > 0 else None
+    next_id = ids[right] if right < len(ids) else None
+    return previous_id, next_id
@@ -0,0 +1,205 @@
+"""On-demand and sampled request profiling
+
+Superusers profile a single request by adding `profile=cprofile` or
+`profile=sample` to its query string: the response is replaced by the
+profile as text (pstats output, or collapsed stacks for the sampler) and the
+report is also stored.
+
+With PROFILING_SAMPLE_RATE = N, one in N requests of each process is
+profiled with the sampler and only stored. The sampler is a background
+thread that records the request thread's stack every PROFILING_INTERVAL
+seconds, so the overhead does not depend on the number of function calls.
+
+Reports are kept in PROFILING_DIR as a ring buffer: .prof files (load with
+pstats or snakeviz) and .folded files (collapsed stacks for flamegraph.pl or
+speedscope). The oldest reports are removed once there are more than
+PROFILING_MAX_REPORTS or they take more than PROFILING_MAX_MB.
+"""
+import cProfile
+import io
+import itertools
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.http import HttpResponse
+
+CPROFILE = "cprofile"
+SAMPLE = "sample"
+MODES = [CPROFILE, SAMPLE]
+EXTENSIONS = {CPROFILE: ".prof", SAMPLE: ".folded"}
+
+# Lines of pstats output returned for cProfile
+STATS_LINES = 60
+
+logger = logging.getLogger(__name__)
+
+_requests = itertools.count(1)
+_store_lock = threading.Lock()
+_name_re = re.compile(r"^[\w.-]+\.(prof|folded)$")
+
+
+class Sampler:
+    """Samples the stack of one thread from a background thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        """Collapsed stacks, one "frame;frame;... count" line per distinct stack"""
+        return "".join("{} {}\n".format(stack, count) for stack, count in self.stacks.most_common())
+
+
+def _report_name(request, mode, duration):
+    path = re.sub(r"[^\w-]+", "_", request.path_info).strip("_") or "root"
+    return "{}-{}-{}-{}ms{}".format(
+        time.strftime("%Y%m%d-%H%M%S"), os.getpid(), path[:60], int(duration * 1000), EXTENSIONS[mode]
+    )
+
+
+def _trim(directory):
+    reports = []
+    for entry in os.scandir(directory):
+        if _name_re.match(entry.name):
+            stat = entry.stat()
+            reports.append((stat.st_mtime, entry.name, stat.st_size))
+    reports.sort()
+    total = sum(size for _, _, size in reports)
+    max_bytes = settings.PROFILING_MAX_MB * 1024 * 1024
+    while reports and (len(reports) > settings.PROFILING_MAX_REPORTS or total > max_bytes):
+        _, name, size = reports.pop(0)
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def store(name, write):
+    """Write a report with write(path) and drop the oldest reports beyond the limits.
+    Returns the report name, None if it could not be written.
+    """
+    directory = settings.PROFILING_DIR
+    try:
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, ".{}.tmp".format(name))
+        write(tmp_path)
+        os.replace(tmp_path, os.path.join(directory, name))
+        with _store_lock:
+            _trim(directory)
+    except OSError:
+        # Profiling must not fail the request
+        logger.exception("Failed to store request profile %s", name)
+        return None
+    return name
+
+
+def list_reports():
+    """[{name, size, modified}] of the stored reports, newest first"""
+    try:
+        entries = [entry for entry in os.scandir(settings.PROFILING_DIR) if _name_re.match(entry.name)]
+    except FileNotFoundError:
+        return []
+    reports = [dict(name=entry.name, size=entry.stat().st_size, modified=entry.stat().st_mtime) for entry in entries]
+    return sorted(reports, key=lambda report: report["modified"], reverse=True)
+
+
+def get_report_path(name):
+    """Path of a stored report, None if there is no such report"""
+    if not _name_re.match(name):
+        return None
+    path = os.path.join(settings.PROFILING_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def _write_text(text):
+    def write(path):
+        with open(path, "w") as f:
+            f.write(text)
+
+    return write
+
+
+def profile_cprofile(request, get_response):
+    """Return (response, pstats text, report name)"""
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        response = get_response(request)
+    finally:
+        profiler.disable()
+    duration = time.perf_counter() - start
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(STATS_LINES)
+    name = store(_report_name(request, CPROFILE, duration), profiler.dump_stats)
+    return response, output.getvalue(), name
+
+
+def profile_sample(request, get_response):
+    """Return (response, collapsed stacks, report name); requests too short for a sample are not stored"""
+    sampler = Sampler(threading.get_ident(), settings.PROFILING_INTERVAL)
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        response = get_response(request)
+    finally:
+        sampler.stop()
+    duration = time.perf_counter() - start
+    folded = sampler.folded()
+    name = store(_report_name(request, SAMPLE, duration), _write_text(folded)) if folded else None
+    return response, folded, name
+
+
+PROFILERS = {CPROFILE: profile_cprofile, SAMPLE: profile_sample}
+
+
+class ProfilingMiddleware:
+    """Place after AuthenticationMiddleware"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = request.GET.get("profile")
+        if mode in MODES and request.user.is_active and request.user.is_superuser:
+            response, text, name = PROFILERS[mode](request, self.get_response)
+            profiled = HttpResponse(text, content_type="text/plain; charset=utf-8")
+            if name:
+                profiled["X-Profile-Report"] = name
+            profiled["X-Profiled-Status"] = str(response.status_code)
+            return profiled
+
+        rate = settings.PROFILING_SAMPLE_RATE
+        if rate and next(_requests) % rate == 0:
+            response, _, _ = profile_sample(request, self.get_response)
+            return response
+        return self.get_response(request)
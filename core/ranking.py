@@ -0,0 +1,131 @@
+"""Vectorized photo ranking
+
+Loads the per-selection vote counts of all photos into NumPy arrays (one query
+over the photo table) and scores every photo in one pass:
+
+- average: the raw mean score, as stored on Photo
+- bayesian: the mean shrunk towards the global mean by PRIOR_WEIGHT pseudo-votes,
+  so photos with few votes do not outrank well-established ones
+- wilson: the lower bound of the Wilson score interval of the mean, after mapping
+  scores from 1..5 onto 0..1, i.e. the score we are ~95% confident the photo
+  reaches
+- normalized: the mean of each rater's scores normalized against that rater's
+  own mean and spread, which needs the full vote matrix (see core.matrix)
+
+Each ranking also carries the Wilson interval (low, high) of every photo. Rankings
+are cached per process until the vote version (see core.versions) changes.
+"""
+import threading
+
+import numpy as np
+
+from core.models import Photo
+
+AVERAGE = "average"
+BAYESIAN = "bayesian"
+WILSON = "wilson"
+NORMALIZED = "normalized"
+METHODS = [AVERAGE, BAYESIAN, WILSON, NORMALIZED]
+
+# Pseudo-votes at the global mean added to every photo (None: mean votes per voted photo)
+PRIOR_WEIGHT = None
+# z-score of the confidence interval (1.96 for 95%)
+Z = 1.96
+
+SCORES = np.array([1.0, 3.0, 5.0])
+
+_lock = threading.Lock()
+_cache = {}
+
+
+class Ranking:
+    """Photos ordered by score (descending, ties by id)"""
+
+    def __init__(self, method, ids, scores, low, high):
+        order = np.lexsort((ids, -scores))
+        self.method = method
+        self.ids = ids[order]
+        self.scores = scores[order]
+        self.low = low[order]
+        self.high = high[order]
+        self.positions = {int(photo_id): i for i, photo_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rank(self, photo_id):
+        """1-based rank of the photo"""
+        return self.positions[photo_id] + 1
+
+    def score(self, photo_id):
+        return float(self.scores[self.positions[photo_id]])
+
+    def index_after(self, score, photo_id):
+        """Index of the first photo that comes after (score, photo_id)"""
+        after = (self.scores < score) | ((self.scores == score) & (self.ids > photo_id))
+        indices = np.flatnonzero(after)
+        return int(indices[0]) if len(indices) else len(self.ids)
+
+
+def load_counts(photo_ids=None):
+    """Return (ids, counts) where counts[i] holds the bad/okay/good votes of photo ids[i]"""
+    photos = Photo.objects.order_by("id")
+    if photo_ids is not None:
+        photos = photos.filter(id__in=photo_ids)
+    rows = list(photos.values_list("id", "bad", "okay", "good"))
+    data = np.array(rows, dtype=np.int64).reshape(-1, 4)
+    return data[:, 0], data[:, 1:].astype(np.float64)
+
+
+def wilson_interval(counts, z=Z):
+    """Wilson score interval of the mean score, in the 1..5 scale"""
+    n = counts.sum(axis=1)
+    # Scores 1/3/5 as fractions of a "success"
+    p = np.divide(counts @ ((SCORES - 1) / 4), n, out=np.zeros_like(n), where=n > 0)
+    z2 = z * z
+    denominator = 1 + z2 / np.maximum(n, 1)
+    center = (p + z2 / (2 * np.maximum(n, 1))) / denominator
+    margin = z * np.sqrt(p * (1 - p) / np.maximum(n, 1) + z2 / (4 * np.maximum(n, 1) ** 2)) / denominator
+    low = np.where(n > 0, center - margin, 0)
+    high = np.where(n > 0, center + margin, 1)
+    return 1 + 4 * low, 1 + 4 * high
+
+
+def compute(method, ids, counts, prior_weight=PRIOR_WEIGHT):
+    n = counts.sum(axis=1)
+    totals = counts @ SCORES
+    low, high = wilson_interval(counts)
+
+    if method == AVERAGE:
+        scores = np.divide(totals, n, out=np.zeros_like(n), where=n > 0)
+    elif method == BAYESIAN:
+        voted = n > 0
+        global_mean = totals.sum() / n.sum() if n.sum() else SCORES.mean()
+        if prior_weight is None:
+            prior_weight = n[voted].mean() if voted.any() else 1.0
+        scores = (prior_weight * global_mean + totals) / (prior_weight + n)
+    elif method == WILSON:
+        scores = low
+    else:
+        raise ValueError("Unknown ranking method {!r}".format(method))
+    return Ranking(method, ids, scores, low, high)
+
+
+def get_ranking(method, version):
+    """Return the ranking for the given vote version, computing it at most once per version"""
+    cached = _cache.get(method)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _lock:
+        cached = _cache.get(method)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        if method == NORMALIZED:
+            from core import matrix
+
+            ranking = matrix.get_matrix().normalized_ranking()
+        else:
+            ids, counts = load_counts()
+            ranking = compute(method, ids, counts)
+        _cache[method] = (version, ranking)
+        return ranking
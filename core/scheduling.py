@@ -0,0 +1,95 @@
+"""Uncertainty-driven photo scheduling (enabled with VOTE_SCHEDULING)
+
+Instead of going through photos in order, raters are served the photo whose
+rank is least settled among those they have not voted on. Photos are split
+into the current top VOTE_SCHEDULING_TOP_N (by Bayesian score, see
+core.ranking) and the rest, each with the Wilson interval of its mean score.
+A top photo's priority is how far the highest upper bound outside the top
+reaches above its lower bound; any other photo's priority is how far its upper
+bound reaches above the lowest lower bound in the top. Photos whose intervals
+no longer overlap the other side of the boundary drop to the back, and photos
+without votes (the widest interval) come first.
+
+Priorities are kept per process in a list sorted by priority. Votes written by
+this process update the priorities of their photos in place; the whole queue
+(and the top-N split) is recomputed in one vectorized pass when photos are
+added or removed or when it is older than VOTE_SCHEDULING_REFRESH seconds,
+which picks up votes written by other processes.
+"""
+import bisect
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from core import ranking
+
+_lock = threading.Lock()
+_queue = None
+
+
+class PriorityQueue:
+    def __init__(self, ids, counts, top_n):
+        scored = ranking.compute(ranking.BAYESIAN, ids, counts)
+        self.top = set(scored.ids[:top_n].tolist())
+        in_top = np.isin(ids, list(self.top))
+        low, high = ranking.wilson_interval(counts)
+        # Weakest plausible score in the top and strongest plausible score outside it
+        self.top_low = low[in_top].min() if in_top.any() else 1.0
+        self.rest_high = high[~in_top].max() if (~in_top).any() else 5.0
+        priorities = self._priorities(ids, low, high)
+        # Ties go to the photo with fewer votes
+        self.entries = sorted(zip((-priorities).tolist(), counts.sum(axis=1).tolist(), ids.tolist()))
+        self.by_id = {photo_id: (key, n) for key, n, photo_id in self.entries}
+
+    def _priorities(self, ids, low, high):
+        """How far each photo's interval reaches across the top-N boundary"""
+        in_top = np.isin(ids, list(self.top))
+        return np.where(in_top, self.rest_high - low, high - self.top_low)
+
+    def update(self, ids, counts):
+        """Recompute the priorities of the given photos"""
+        low, high = ranking.wilson_interval(counts)
+        priorities = self._priorities(ids, low, high)
+        for photo_id, priority, n in zip(ids.tolist(), priorities.tolist(), counts.sum(axis=1).tolist()):
+            old = self.by_id.get(photo_id)
+            if old is not None:
+                del self.entries[bisect.bisect_left(self.entries, old + (photo_id,))]
+            self.by_id[photo_id] = (-priority, n)
+            bisect.insort(self.entries, (-priority, n, photo_id))
+
+    def next_photo(self, voted_bits, exclude=None):
+        """Id of the highest priority photo not in voted_bits, None if there is none"""
+        for _, _, photo_id in self.entries:
+            if photo_id != exclude and not voted_bits >> photo_id & 1:
+                return photo_id
+        return None
+
+
+def get_queue(photo_version):
+    global _queue
+    with _lock:
+        if (
+            _queue is None
+            or _queue[0] != photo_version
+            or time.time() - _queue[1] > settings.VOTE_SCHEDULING_REFRESH
+        ):
+            ids, counts = ranking.load_counts()
+            _queue = (photo_version, time.time(), PriorityQueue(ids, counts, settings.VOTE_SCHEDULING_TOP_N))
+        return _queue[2]
+
+
+def refresh(photo_ids):
+    """Update the priorities of photos whose votes changed in this process"""
+    if _queue is None:
+        return
+    ids, counts = ranking.load_counts(photo_ids)
+    with _lock:
+        if _queue is not None:
+            _queue[2].update(ids, counts)
+
+
+def next_photo(voted_bits, photo_version, exclude=None):
+    """Id of the most uncertain photo the user has not voted on"""
+    return get_queue(photo_version).next_photo(voted_bits, exclude)
@@ -0,0 +1,99 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from core import matrix, neighbors, scheduling, sqlite, stats, versions, voted
+from core.models import Counter, Photo, Vote
+from core.votes import votes_bulk_saved
+
+User = get_user_model()
+# Shown in the progress panel
+USER_NAME_FIELDS = ["first_name", "last_name"]
+
+connection_created.connect(sqlite.configure_connection)
+
+
+def votes_written(user_id, photo_ids, removed=False):
+    voted.mark(user_id, versions.bump_votes(user_id), photo_ids, voted=not removed)
+    scheduling.refresh(photo_ids)
+
+
+@receiver(post_save, sender=Vote)
+def vote_saved(sender, instance, created, **kwargs):
+    transaction.on_commit(lambda: votes_written(instance.user_id, [instance.photo_id]))
+    vote = (instance.user_id, instance.photo_id, instance.selection)
+    transaction.on_commit(lambda: matrix.update([vote]))
+    if created:
+        stats.increment(Counter.VOTES)
+        stats.increment(Counter.VOTES, user_id=instance.user_id)
+
+
+@receiver(post_delete, sender=Vote)
+def vote_deleted(sender, instance, **kwargs):
+    # Also sent for votes removed by cascade, which bypass Vote.delete()
+    Photo.apply_vote(instance.photo_id, instance._saved_selection, None)
+    transaction.on_commit(lambda: votes_written(instance.user_id, [instance.photo_id], removed=True))
+    transaction.on_commit(lambda: matrix.update([(instance.user_id, instance.photo_id, None)]))
+    stats.increment(Counter.VOTES, -1)
+    stats.increment(Counter.VOTES, -1, user_id=instance.user_id)
+
+
+@receiver(votes_bulk_saved, sender=Vote)
+def votes_bulk_saved_handler(sender, votes, created, **kwargs):
+    photos_by_user = {}
+    for user_id, photo_id, _ in votes:
+        photos_by_user.setdefault(user_id, []).append(photo_id)
+    for user_id, photo_ids in photos_by_user.items():
+        transaction.on_commit(lambda user_id=user_id, photo_ids=photo_ids: votes_written(user_id, photo_ids))
+    transaction.on_commit(lambda: matrix.update(votes))
+    if created:
+        stats.increment(Counter.VOTES, len(created))
+        created_by_user = {}
+        for user_id, _ in created:
+            created_by_user[user_id] = created_by_user.get(user_id, 0) + 1
+        for user_id, count in created_by_user.items():
+            stats.increment(Counter.VOTES, count, user_id=user_id)
+
+
+@receiver(post_save, sender=Photo)
+def photo_saved(sender, instance, created, **kwargs):
+    if created:
+        stats.increment(Counter.PHOTOS)
+        transaction.on_commit(versions.bump_photos)
+        transaction.on_commit(neighbors.invalidate)
+    else:
+        transaction.on_commit(versions.bump_votes)
+
+
+@receiver(post_delete, sender=Photo)
+def photo_deleted(sender, instance, **kwargs):
+    stats.increment(Counter.PHOTOS, -1)
+    transaction.on_commit(versions.bump_photos)
+    transaction.on_commit(neighbors.invalidate)
+
+
+@receiver(post_init, sender=User)
+def user_loaded(sender, instance, **kwargs):
+    # Deferred fields are not loaded, so they count as changed on save
+    instance._saved_names = [instance.__dict__.get(field) for field in USER_NAME_FIELDS]
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        stats.add_user(instance.id)
+    if update_fields is not None and not set(update_fields) & set(USER_NAME_FIELDS):
+        # e.g. last_login on every login
+        return
+    names = [instance.__dict__.get(field) for field in USER_NAME_FIELDS]
+    if created or names != instance._saved_names:
+        transaction.on_commit(versions.bump_votes)
+    instance._saved_names = names
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    stats.increment(Counter.USERS, -1)
+    transaction.on_commit(versions.bump_votes)
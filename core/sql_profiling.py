@@ -0,0 +1,136 @@
+"""Per-request SQL profiling (enabled with SQL_PROFILING)
+
+SQLProfilingMiddleware times every query of a request with a database
+execute wrapper, so it works without DEBUG. Staff get the query count, the
+total SQL time and the slowest statement in X-SQL-* response headers. Every
+request is also added to an in-process rolling summary per view (the last
+SQL_PROFILING_WINDOW requests, plus the slowest statements seen), served as
+JSON by SQLStatsView.
+
+Streaming responses (e.g. ExportView) run most of their queries while the body
+is sent, after the middleware has returned, so they are not recorded.
+"""
+import heapq
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+# Longer statements are truncated in headers and summaries
+MAX_SQL_LENGTH = 300
+
+_lock = threading.Lock()
+_views = {}
+
+
+class QueryRecorder:
+    """Execute wrapper that keeps (duration in seconds, sql) of each query"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((time.perf_counter() - start, sql))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total(self):
+        return sum(duration for duration, _ in self.queries)
+
+    def slowest(self, n):
+        return heapq.nlargest(n, self.queries, key=lambda query: query[0])
+
+
+class ViewStats:
+    def __init__(self, window, slowest):
+        self.requests = 0
+        self.recent = deque(maxlen=window)
+        self.slowest = []
+        self.slowest_size = slowest
+
+    def add(self, recorder):
+        self.requests += 1
+        self.recent.append((recorder.count, recorder.total))
+        for duration, sql in recorder.slowest(self.slowest_size):
+            entry = (duration, sql[:MAX_SQL_LENGTH])
+            if len(self.slowest) < self.slowest_size:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def summary(self):
+        counts = [count for count, _ in self.recent]
+        times = sorted(total for _, total in self.recent)
+        return dict(
+            requests=self.requests,
+            window=len(self.recent),
+            queries_mean=sum(counts) / len(counts),
+            queries_max=max(counts),
+            time_mean_ms=1000 * sum(times) / len(times),
+            time_p95_ms=1000 * times[min(len(times) - 1, int(len(times) * 0.95))],
+            slowest=[dict(time_ms=1000 * duration, sql=sql) for duration, sql in sorted(self.slowest, reverse=True)],
+        )
+
+
+def record(view, recorder):
+    with _lock:
+        stats = _views.get(view)
+        if stats is None:
+            stats = _views[view] = ViewStats(settings.SQL_PROFILING_WINDOW, settings.SQL_PROFILING_SLOWEST)
+        stats.add(recorder)
+
+
+def get_summary():
+    """{view name: summary} of the requests profiled by this process"""
+    with _lock:
+        return {view: stats.summary() for view, stats in sorted(_views.items())}
+
+
+def reset():
+    with _lock:
+        _views.clear()
+
+
+def _header_value(sql):
+    return " ".join(sql.split())[:MAX_SQL_LENGTH]
+
+
+class SQLProfilingMiddleware:
+    """Place first so the queries of the other middleware are included"""
+
+    def __init__(self, get_response):
+        if not settings.SQL_PROFILING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+            user = getattr(request, "user", None)
+            # Loading the user may be the request's last query
+            is_staff = bool(user and user.is_active and user.is_staff)
+
+        if response.streaming:
+            # The queries of the body are still to come
+            return response
+        match = request.resolver_match
+        record(match.view_name if match else request.path_info, recorder)
+        if is_staff:
+            response["X-SQL-Queries"] = str(recorder.count)
+            response["X-SQL-Time"] = "{:.1f}ms".format(1000 * recorder.total)
+            slowest = recorder.slowest(1)
+            if slowest:
+                duration, sql = slowest[0]
+                response["X-SQL-Slowest"] = "{:.1f}ms {}".format(1000 * duration, _header_value(sql))
+        return response
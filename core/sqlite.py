@@ -0,0 +1,76 @@
+"""Production profile for the SQLite database
+
+configure_connection() applies SQLITE_PRAGMAS (WAL journal, busy timeout,
+cache and mmap sizes) to every new SQLite connection.
+
+SQLite allows one writer at a time. Even with a busy timeout, a transaction
+that reads and then writes fails immediately with "database is locked" when
+another process committed in between, so writers are serialized with an
+exclusive lock on the SQLITE_WRITE_LOCK file: requests with unsafe methods
+hold it through SerializedWritesMiddleware, and other writers (e.g. the vote
+buffer) use serialized_writes() directly.
+"""
+import fcntl
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_thread_lock = threading.RLock()
+_local = threading.local()
+_lock_file = None
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
+
+
+def _get_lock_file():
+    global _lock_file
+    if _lock_file is None:
+        _lock_file = open(settings.SQLITE_WRITE_LOCK, "a")
+    return _lock_file
+
+
+@contextmanager
+def serialized_writes():
+    """Hold the process-shared write lock (re-entrant within a thread)"""
+    if not settings.SQLITE_WRITE_LOCK:
+        yield
+        return
+    with _thread_lock:
+        depth = getattr(_local, "depth", 0)
+        if depth == 0:
+            fcntl.flock(_get_lock_file(), fcntl.LOCK_EX)
+        _local.depth = depth + 1
+        try:
+            yield
+        finally:
+            _local.depth = depth
+            if depth == 0:
+                fcntl.flock(_get_lock_file(), fcntl.LOCK_UN)
+
+
+class SerializedWritesMiddleware:
+    """Serialize the writes of unsafe requests
+
+    Place right after SessionMiddleware: the lock then covers the
+    authentication, messages and the view (e.g. login updating last_login),
+    but not the session save on the way out, whose transaction starts with a
+    write, so the busy timeout is enough for it.
+    """
+
+    safe_methods = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in self.safe_methods:
+            return self.get_response(request)
+        with serialized_writes():
+            return self.get_response(request)
@@ -0,0 +1,70 @@
+"""Maintained progress counters
+
+Total votes, photos and users, as well as each user's vote count, are kept in
+the Counter table so the photo list can read them in a single query instead of
+counting the source tables on every request. The counters are kept up to date
+by core.signals and can be rebuilt with `manage.py rebuild_stats`.
+"""
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from core.models import Counter, Photo, Vote
+
+
+def _count(name, user_id=None):
+    if name == Counter.VOTES:
+        votes = Vote.objects.all()
+        return votes.filter(user_id=user_id).count() if user_id else votes.count()
+    if name == Counter.PHOTOS:
+        return Photo.objects.count()
+    return get_user_model().objects.count()
+
+
+def increment(name, delta=1, user_id=None):
+    """Add delta to a counter. Call it in the transaction of the change: a missing
+    counter is then created from the source tables, which already include it.
+    """
+    updated = Counter.objects.filter(name=name, user_id=user_id).update(value=F("value") + delta)
+    # A missing counter is recounted on the next increment, so decrements of one
+    # (e.g. of the votes of a user being deleted, whose counters may be gone) are dropped
+    if updated or delta < 0:
+        return
+    try:
+        with transaction.atomic():
+            Counter.objects.create(name=name, user_id=user_id, value=_count(name, user_id))
+    except IntegrityError:
+        # Created by a concurrent write since the update
+        Counter.objects.filter(name=name, user_id=user_id).update(value=F("value") + delta)
+
+
+def add_user(user_id):
+    increment(Counter.USERS)
+    Counter.objects.get_or_create(name=Counter.VOTES, user_id=user_id)
+
+
+def get_progress():
+    """Return the global counters and the per-user vote counters (highest first)"""
+    progress = {Counter.VOTES: 0, Counter.PHOTOS: 0, Counter.USERS: 0, "user_counters": []}
+    for counter in Counter.objects.select_related("user").order_by("-value"):
+        if counter.user_id:
+            progress["user_counters"].append(counter)
+        else:
+            progress[counter.name] = counter.value
+    return progress
+
+
+def rebuild():
+    """Recompute all counters from the source tables"""
+    User = get_user_model()
+    counters = [
+        Counter(name=Counter.VOTES, value=Vote.objects.count()),
+        Counter(name=Counter.PHOTOS, value=Photo.objects.count()),
+        Counter(name=Counter.USERS, value=User.objects.count()),
+    ]
+    for user_id, count in User.objects.annotate(Count("vote")).values_list("id", "vote__count"):
+        counters.append(Counter(name=Counter.VOTES, user_id=user_id, value=count))
+    with transaction.atomic():
+        Counter.objects.all().delete()
+        Counter.objects.bulk_create(counters, batch_size=500)
+    return counters
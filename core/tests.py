@@ -1,3 +1,1368 @@
-from django.test import TestCase
+import base64
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.checks import run_checks
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from core import (
+    aggregates,
+    assets,
+    atlases,
+    ballots,
+    checks,
+    derivatives,
+    duplicates,
+    exports,
+    feed,
+    importer,
+    ingest,
+    matrix,
+    neighbors,
+    profiling,
+    ranking,
+    scheduling,
+    sql_profiling,
+    stats,
+    versions,
+    voted,
+    votes,
+)
+from core.models import Counter, Photo, Vote
+
+TEST_SETTINGS = dict(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    VOTE_WRITE_BEHIND=False,
+    VOTE_SCHEDULING=False,
+    SQL_PROFILING=False,
+)
+
+
+class FixturesMixin:
+    """Clear the cache and give each test its own VOTE_MATRIX_PATH, with helpers for the raters and photos"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        override = self.settings(VOTE_MATRIX_PATH=os.path.join(self.create_directory(), "votes.npy"))
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(matrix.invalidate)
+
+    def create_directory(self):
+        """Temporary directory removed after the test"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+    def create_static_files(self, photo_ids):
+        """Static directory with the original and thumbnail of each photo, used until the end of the test"""
+        static_dir = self.create_directory()
+        for folder in ["grad", "grad_thumb"]:
+            os.makedirs(os.path.join(static_dir, "core", "media", folder))
+            for photo_id in photo_ids:
+                open(os.path.join(static_dir, "core", "media", folder, "grad{:03d}.jpg".format(photo_id)), "w").close()
+        override = self.settings(STATICFILES_DIRS=[static_dir])
+        override.enable()
+        self.addCleanup(override.disable)
+        registry = mock.patch.object(assets, "_registry", None)
+        registry.start()
+        self.addCleanup(registry.stop)
+        return static_dir
+
+    def create_user(self, username="rater", **extra_fields):
+        return User.objects.create_user(username, "{}@example.com".format(username), "password", **extra_fields)
+
+    def create_users(self, count):
+        return [self.create_user("rater{}".format(i)) for i in range(count)]
+
+    def create_photos(self, count):
+        """Create count photos and return all photos in id order"""
+        Photo.objects.bulk_create([Photo() for _ in range(count)])
+        return list(Photo.objects.order_by("id"))
+
+
+@override_settings(**TEST_SETTINGS)
+class QueryBudgetTests(FixturesMixin, TestCase):
+    """Pin the number of queries of the main pages so N+1 regressions fail here
+
+    Each budget is checked with few and with many photos and votes, so a query
+    per photo or per vote shows up as a changed count.
+    """
+
+    PHOTOS = 30
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.other = self.create_user("other")
+        self.add_photos(self.PHOTOS)
+        self.photo = Photo.objects.order_by("id").first()
+        self.client.force_login(self.user)
+        # Versions are created by the first request that reads them
+        versions.get_versions(self.user.id)
+
+    def add_photos(self, count):
+        Photo.objects.bulk_create([Photo() for _ in range(count)])
+        for photo in Photo.objects.order_by("-id")[: count // 2]:
+            Vote.objects.create(user=self.other, photo=photo, selection=Vote.GOOD)
+        # on_commit does not run in TestCase
+        versions.bump_photos()
+        cache.clear()
+
+    def assertBudget(self, budget, request):
+        with self.assertNumQueries(budget):
+            response = request()
+        self.add_photos(self.PHOTOS * 3)
+        with self.assertNumQueries(budget):
+            request()
+        return response
+
+    def test_photo_list(self):
+        # Session, user, versions, counters, photo page, the user's votes
+        response = self.assertBudget(6, lambda: self.client.get(reverse("core:photo-list")))
+        self.assertEqual(response.status_code, 200)
+
+    def test_photo_list_cached(self):
+        self.client.get(reverse("core:photo-list"))
+        # Session, user and versions; the page comes from the cache
+        with self.assertNumQueries(3):
+            self.client.get(reverse("core:photo-list"))
+
+    def test_photo_list_ranked(self):
+        self.client.get(reverse("core:photo-list"))
+        response = self.client.get(reverse("core:photo-list") + "?sort=rank")
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(3):
+            self.client.get(reverse("core:photo-list") + "?sort=rank")
+
+    def test_photo_detail(self):
+        url = reverse("core:photo-detail", args=[self.photo.id])
+        # Session, user, versions, photo, the user's vote, photo ids (neighbors), the user's voted photos
+        response = self.assertBudget(7, lambda: self.client.get(url, HTTP_IF_NONE_MATCH=""))
+        self.assertEqual(response.status_code, 200)
+
+    def test_photo_detail_post(self):
+        url = reverse("core:photo-detail", args=[self.photo.id])
+        self.client.get(url)
+        # Session, user, versions, photo, vote, savepoint, stored vote, insert, two counters, aggregates, release
+        with self.assertNumQueries(12):
+            response = self.client.post(url, {"selection": Vote.OKAY})
+        self.assertEqual(response.status_code, 302)
+        # Changing the vote does not touch the counters
+        with self.assertNumQueries(10):
+            self.client.post(url, {"selection": Vote.GOOD})
+        self.assertEqual(Vote.objects.get(user=self.user, photo=self.photo).selection, Vote.GOOD)
+
+
+@override_settings(**TEST_SETTINGS)
+class SignupQueryBudgetTests(FixturesMixin, TestCase):
+    def test_signup_page(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("account_signup"))
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch("core.account.forms.SignupForm.clean_secret", lambda form: form.cleaned_data["secret"])
+    def test_signup(self):
+        data = dict(
+            email="new@example.com",
+            password1="A-long-enough-password-1",
+            first_name="New",
+            last_name="Rater",
+            secret="secret",
+        )
+        with self.assertNumQueries(21):
+            response = self.client.post(reverse("account_signup"), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(User.objects.filter(email="new@example.com").exists())
+
+
+@override_settings(**dict(TEST_SETTINGS, SQL_PROFILING=True))
+class SQLProfilingTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        sql_profiling.reset()
+        self.create_photos(3)
+        self.user = self.create_user()
+        self.staff = self.create_user("staff", is_staff=True)
+        for user in [self.user, self.staff]:
+            versions.get_versions(user.id)
+
+    def test_headers_for_staff_only(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("core:photo-list"))
+        self.assertNotIn("X-SQL-Queries", response)
+
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("core:photo-list"))
+        self.assertEqual(response["X-SQL-Queries"], "6")
+        self.assertTrue(response["X-SQL-Time"].endswith("ms"))
+        self.assertIn("SELECT", response["X-SQL-Slowest"])
+
+    def test_summary(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse("core:photo-list"))
+        self.client.get(reverse("core:photo-list"))
+        self.assertEqual(self.client.get(reverse("core:sql-stats")).status_code, 403)
+
+        self.client.force_login(self.staff)
+        summary = self.client.get(reverse("core:sql-stats")).json()
+        photo_list = summary["core:photo-list"]
+        self.assertEqual(photo_list["requests"], 2)
+        self.assertEqual(photo_list["queries_max"], 6)
+        self.assertEqual(photo_list["queries_mean"], 4.5)
+        self.assertLessEqual(len(photo_list["slowest"]), 5)
+
+    def test_streaming_responses_are_not_recorded(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("core:export", args=["votes"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-SQL-Queries", response)
+        self.assertNotIn("core:export", sql_profiling.get_summary())
+
+
+@override_settings(**TEST_SETTINGS)
+class ProfilingTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = self.create_directory()
+        self.superuser = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.staff = self.create_user("staff", is_staff=True)
+
+    def test_profile_request(self):
+        with self.settings(PROFILING_DIR=self.directory):
+            self.client.force_login(self.staff)
+            response = self.client.get(reverse("core:photo-list") + "?profile=cprofile")
+            self.assertNotIn("X-Profile-Report", response)
+
+            self.client.force_login(self.superuser)
+            response = self.client.get(reverse("core:photo-list") + "?profile=cprofile")
+            self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+            self.assertIn("function calls", response.content.decode())
+            name = response["X-Profile-Report"]
+            self.assertEqual([report["name"] for report in profiling.list_reports()], [name])
+            download = self.client.get(reverse("core:profile-report", args=[name]))
+            self.assertEqual(download.status_code, 200)
+
+    def test_sampled_reports_are_bounded(self):
+        with self.settings(PROFILING_DIR=self.directory, PROFILING_MAX_REPORTS=3):
+            for i in range(5):
+                profiling.store("report-{}.folded".format(i), lambda path: open(path, "w").close())
+            reports = sorted(os.listdir(self.directory))
+            self.assertEqual(reports, ["report-2.folded", "report-3.folded", "report-4.folded"])
+
+
+def run_on_commit(func, using=None):
+    func()
+
+
+@override_settings(**TEST_SETTINGS)
+class UserVersionTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+
+    @mock.patch("django.db.transaction.on_commit", run_on_commit)
+    def test_only_name_changes_bump_votes(self):
+        with mock.patch("core.versions.bump_votes") as bump_votes:
+            self.assertTrue(self.client.login(username="rater", password="password"))
+            user = User.objects.get(id=self.user.id)
+            user.save()
+            self.assertFalse(bump_votes.called)
+
+            user.first_name = "Rater"
+            user.save()
+            self.assertEqual(bump_votes.call_count, 1)
+
+    def test_bumps_are_counted_in_the_database(self):
+        initial = versions.get_versions(self.user.id)
+        self.assertEqual(versions.bump_votes(self.user.id), initial.user + 1)
+        self.assertEqual(versions.bump_votes(self.user.id), initial.user + 2)
+        self.assertEqual(versions.get_versions(self.user.id).votes, initial.votes + 2)
+        self.assertEqual(versions.get_versions().user, None)
+
+    @mock.patch("django.db.transaction.on_commit", run_on_commit)
+    def test_votes_invalidate_the_cached_photo_list(self):
+        photo = self.create_photos(1)[0]
+        self.client.force_login(self.user)
+        url = reverse("core:photo-list")
+        self.assertContains(self.client.get(url), "0 Votes")
+        with self.assertNumQueries(3):
+            # Cached
+            self.assertContains(self.client.get(url), "0 Votes")
+        Vote.objects.create(user=self.create_user("other"), photo=photo, selection=Vote.GOOD)
+        self.assertContains(self.client.get(url), "1 Votes")
+
+
+@override_settings(**TEST_SETTINGS)
+class StatsTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = self.create_users(2)
+        self.photos = self.create_photos(3)
+
+    def assertCounters(self, user_ids=None):
+        """Check the global counters and the vote counters of the given users (default all)"""
+        progress = stats.get_progress()
+        self.assertEqual(progress[Counter.VOTES], Vote.objects.count())
+        self.assertEqual(progress[Counter.PHOTOS], Photo.objects.count())
+        self.assertEqual(progress[Counter.USERS], User.objects.count())
+        user_ids = User.objects.values_list("id", flat=True) if user_ids is None else user_ids
+        user_votes = {counter.user_id: counter.value for counter in progress["user_counters"]}
+        self.assertEqual(user_votes, {user_id: Vote.objects.filter(user_id=user_id).count() for user_id in user_ids})
+
+    def test_counters_follow_writes(self):
+        # Photos created with bulk_create are counted by a rebuild
+        stats.rebuild()
+        vote = Vote.objects.create(user=self.users[0], photo=self.photos[0], selection=Vote.GOOD)
+        Vote.objects.create(user=self.users[1], photo=self.photos[0], selection=Vote.BAD)
+        votes.bulk_upsert([(self.users[0].id, photo.id, Vote.OKAY) for photo in self.photos])
+        self.assertCounters()
+        vote.delete()
+        Photo.objects.get(id=self.photos[2].id).delete()
+        self.users[1].delete()
+        self.create_user("new")
+        self.assertCounters()
+
+    def test_missing_counters_are_recounted(self):
+        Counter.objects.all().delete()
+        Photo.objects.create()
+        Vote.objects.create(user=self.users[0], photo=self.photos[0], selection=Vote.GOOD)
+        user = self.create_user("new")
+        # Users only get a counter again when they vote or are created
+        self.assertCounters([self.users[0].id, user.id])
+        self.assertEqual(Counter.objects.filter(user=None).count(), 3)
+
+    def test_global_counters_are_unique(self):
+        stats.rebuild()
+        with self.assertRaises(IntegrityError):
+            Counter.objects.create(name=Counter.VOTES, value=0)
+
+    def test_rebuild_stats(self):
+        Vote.objects.create(user=self.users[0], photo=self.photos[0], selection=Vote.GOOD)
+        Counter.objects.update(value=42)
+        with redirect_stdout(io.StringIO()) as output:
+            call_command("rebuild_stats")
+        self.assertEqual(output.getvalue(), "Rebuilt 5 counters.\n")
+        self.assertCounters()
+
+
+@override_settings(**TEST_SETTINGS)
+class NeighborTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.photos = self.create_photos(4)
+        self.ids = [photo.id for photo in self.photos]
+        self.addCleanup(neighbors.invalidate)
+
+    @mock.patch("django.db.transaction.on_commit", run_on_commit)
+    def test_neighbors(self):
+        version = versions.get_versions().photos
+        self.assertEqual(neighbors.get_neighbors(self.ids[0], version), (None, self.ids[1]))
+        self.assertEqual(neighbors.get_neighbors(self.ids[2], version), (self.ids[1], self.ids[3]))
+        self.assertEqual(neighbors.get_neighbors(self.ids[3], version), (self.ids[2], None))
+
+        Photo.objects.filter(id=self.ids[1]).delete()
+        version = versions.get_versions().photos
+        self.assertEqual(neighbors.get_neighbors(self.ids[2], version), (self.ids[0], self.ids[3]))
+        # A deleted photo still has neighbors on both sides
+        self.assertEqual(neighbors.get_neighbors(self.ids[1], version), (self.ids[0], self.ids[2]))
+
+    @mock.patch("django.db.transaction.on_commit", run_on_commit)
+    def test_index_is_rebuilt_when_the_photo_version_changes(self):
+        version = versions.get_versions().photos
+        with self.assertNumQueries(1):
+            neighbors.get_ids(version)
+            neighbors.get_ids(version)
+        photo = Photo.objects.create()
+        self.assertEqual(neighbors.get_ids(versions.get_versions().photos), self.ids + [photo.id])
+
+
+@override_settings(**TEST_SETTINGS)
+class PhotoDetailETagTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.photo = self.create_photos(3)[0]
+        self.user = self.create_user()
+        self.other = self.create_user("other")
+        self.client.force_login(self.user)
+
+    def get_etag_after_other_vote(self):
+        url = reverse("core:photo-detail", args=[self.photo.id])
+        # The first response sets the CSRF cookie, which is part of the ETag
+        self.client.get(url)
+        etag = self.client.get(url)["ETag"]
+        Vote.objects.create(user=self.other, photo=Photo.objects.order_by("id").last(), selection=Vote.GOOD)
+        versions.bump_votes(self.other.id)
+        return etag, self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_other_votes_keep_etag(self):
+        _, response = self.get_etag_after_other_vote()
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(VOTE_SCHEDULING=True)
+    def test_other_votes_change_etag_with_scheduling(self):
+        etag, response = self.get_etag_after_other_vote()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+@override_settings(**TEST_SETTINGS)
+class FeedTests(FixturesMixin, TestCase):
+    # (bad, okay, good) votes, with tied averages so rank order falls back to the id
+    COUNTS = [
+        (0, 0, 1),
+        (0, 1, 0),
+        (1, 0, 0),
+        (0, 1, 0),
+        (0, 0, 2),
+        (1, 0, 1),
+        (0, 0, 0),
+        (1, 0, 0),
+        (0, 0, 1),
+        (0, 2, 0),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        photos = []
+        for bad, okay, good in self.COUNTS:
+            votes = bad + okay + good
+            total = bad + 3 * okay + 5 * good
+            photos.append(Photo(bad=bad, okay=okay, good=good, votes=votes, total=total, average=total / max(votes, 1)))
+        Photo.objects.bulk_create(photos)
+        self.version = versions.get_versions(self.user.id).votes
+
+    def walk(self, sort, limit):
+        ids, cursor = [], None
+        while True:
+            photos, cursor = feed.get_photo_page(self.user, sort, cursor, limit, self.version)
+            ids.extend(photo.id for photo in photos)
+            if cursor is None:
+                return ids
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(feed.decode_cursor(feed.encode_cursor(12, 4.5, 3)), (12, 4.5, 3))
+
+    def test_pages_cover_every_photo_once(self):
+        by_id = list(Photo.objects.order_by("id").values_list("id", flat=True))
+        by_rank = list(Photo.objects.order_by("-average", "id").values_list("id", flat=True))
+        for limit in [1, 3, 4, 10, 11]:
+            self.assertEqual(self.walk(feed.INDEX, limit), by_id)
+            self.assertEqual(self.walk(feed.RANK, limit), by_rank)
+
+    def test_ranks_continue_across_pages(self):
+        first, cursor = feed.get_photo_page(self.user, feed.RANK, None, 4, self.version)
+        second, _ = feed.get_photo_page(self.user, feed.RANK, cursor, 4, self.version)
+        self.assertEqual([photo.rank for photo in first + second], list(range(1, 9)))
+
+    def test_tampered_cursors(self):
+        for cursor in ["", "not base64!", "bm90IGpzb24=", feed.encode_cursor(1, 2, 3)[:-4], "WzEsMl0=", "e30="]:
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(feed.InvalidCursor):
+                    feed.decode_cursor(cursor)
+
+    def test_invalid_cursor_response(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("core:photo-feed"), {"cursor": "not base64!"})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(**TEST_SETTINGS)
+class ApplyVoteTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.photo = Photo.objects.create()
+        self.users = self.create_users(3)
+
+    def assertAggregates(self, votes, total, bad=0, okay=0, good=0):
+        photo = Photo.objects.get(id=self.photo.id)
+        self.assertEqual((photo.votes, photo.total, photo.bad, photo.okay, photo.good), (votes, total, bad, okay, good))
+        self.assertEqual(photo.average, total / votes if votes else 0)
+        # The deltas agree with a full recount
+        photo.update()
+        self.assertEqual((photo.votes, photo.total, photo.bad, photo.okay, photo.good), (votes, total, bad, okay, good))
+
+    def test_deltas(self):
+        vote = Vote.objects.create(user=self.users[0], photo=self.photo, selection=Vote.GOOD)
+        self.assertAggregates(1, 5, good=1)
+        Vote.objects.create(user=self.users[1], photo=self.photo, selection=Vote.BAD)
+        self.assertAggregates(2, 6, bad=1, good=1)
+
+        vote.selection = Vote.OKAY
+        vote.save()
+        self.assertAggregates(2, 4, bad=1, okay=1)
+        # Saving the same selection again is not a change
+        vote.save()
+        self.assertAggregates(2, 4, bad=1, okay=1)
+
+        vote.delete()
+        self.assertAggregates(1, 1, bad=1)
+        Vote.objects.filter(photo=self.photo).delete()
+        self.assertAggregates(0, 0)
+
+    def test_stale_instances(self):
+        # A double-clicked change: both requests loaded the vote before either saved
+        vote = Vote.objects.create(user=self.users[0], photo=self.photo, selection=Vote.BAD)
+        first, second = Vote.objects.get(pk=vote.pk), Vote.objects.get(pk=vote.pk)
+        for stale in [first, second]:
+            stale.selection = Vote.GOOD
+            stale.save()
+        self.assertAggregates(1, 5, good=1)
+
+        # Both requests created the user's first vote on the photo
+        first = Vote(user=self.users[1], photo=self.photo, selection=Vote.OKAY)
+        second = Vote(user=self.users[1], photo=self.photo, selection=Vote.BAD)
+        first.save()
+        second.save()
+        self.assertEqual(second.pk, first.pk)
+        self.assertAggregates(2, 6, bad=1, good=1)
+
+        # Deleted twice
+        first.delete()
+        second.delete()
+        self.assertAggregates(1, 5, good=1)
+
+    def test_apply_vote(self):
+        Photo.apply_vote(self.photo.id, None, Vote.OKAY)
+        photo = Photo.objects.get(id=self.photo.id)
+        self.assertEqual((photo.votes, photo.total, photo.okay, photo.average), (1, 3, 1, 3.0))
+        Photo.apply_vote(self.photo.id, Vote.OKAY, Vote.GOOD)
+        photo = Photo.objects.get(id=self.photo.id)
+        self.assertEqual((photo.votes, photo.total, photo.okay, photo.good, photo.average), (1, 5, 0, 1, 5.0))
+        # The last vote removed resets the average instead of dividing by zero
+        Photo.apply_vote(self.photo.id, Vote.GOOD, None)
+        photo = Photo.objects.get(id=self.photo.id)
+        self.assertEqual((photo.votes, photo.total, photo.good, photo.average), (0, 0, 0, 0.0))
+
+
+class ParseVotesTests(TestCase):
+    def test_votes(self):
+        self.assertEqual(votes.parse_votes({"photo": "3", "selection": Vote.GOOD}), [(3, Vote.GOOD)])
+        data = {"votes": [{"photo": 1, "selection": Vote.BAD}, {"photo": 2, "selection": Vote.OKAY}]}
+        self.assertEqual(votes.parse_votes(data), [(1, Vote.BAD), (2, Vote.OKAY)])
+
+    def test_invalid_votes(self):
+        for data in [
+            [],
+            {"votes": []},
+            {"votes": {}},
+            {"photo": "x", "selection": Vote.GOOD},
+            {"photo": 1},
+            {"photo": 1, "selection": "XX"},
+            {"photo": 1, "selection": ["GD"]},
+            {"photo": 1, "selection": {"GD": 1}},
+            {"votes": [{"photo": 1, "selection": [Vote.GOOD]}]},
+        ]:
+            with self.subTest(data=data):
+                with self.assertRaises(votes.VoteError):
+                    votes.parse_votes(data)
+
+
+@override_settings(**TEST_SETTINGS)
+class VoteApiTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.photos = self.create_photos(2)
+        self.url = reverse("core:vote-api")
+
+    def post(self, data):
+        return self.client.post(self.url, json.dumps(data), content_type="application/json")
+
+    def test_login_required(self):
+        self.assertEqual(self.post({"photo": self.photos[0].id, "selection": Vote.GOOD}).status_code, 403)
+        self.assertFalse(Vote.objects.exists())
+
+    def test_batch(self):
+        self.client.force_login(self.user)
+        p0, p1 = self.photos
+        data = {"votes": [{"photo": p0.id, "selection": Vote.GOOD}, {"photo": p1.id, "selection": Vote.BAD}]}
+        response = self.post(data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(photo["id"], photo["votes"], photo["average"]) for photo in response.json()["photos"]],
+            [(p0.id, 1, 5.0), (p1.id, 1, 1.0)],
+        )
+        # Later votes for the same photo win
+        data = {"votes": [{"photo": p0.id, "selection": Vote.BAD}, {"photo": p0.id, "selection": Vote.OKAY}]}
+        self.assertEqual(self.post(data).json()["photos"][0]["average"], 3.0)
+        self.assertEqual(Vote.objects.get(user=self.user, photo=p0).selection, Vote.OKAY)
+
+    def test_invalid_requests(self):
+        self.client.force_login(self.user)
+        response = self.client.post(self.url, "{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post({"photo": self.photos[0].id, "selection": "XX"}).status_code, 400)
+        # A batch with an unknown photo is rejected as a whole
+        data = {"votes": [{"photo": self.photos[0].id, "selection": Vote.GOOD}, {"photo": 0, "selection": Vote.GOOD}]}
+        response = self.post(data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Unknown photos [0]"})
+        self.assertFalse(Vote.objects.exists())
+
+    def test_batches_are_atomic(self):
+        rows = [(self.photos[0].id, Vote.GOOD), (self.photos[1].id, Vote.GOOD)]
+        with mock.patch("core.models.Photo.apply_vote", side_effect=[None, OperationalError("database is locked")]):
+            with self.assertRaises(OperationalError):
+                votes.submit_votes(self.user, rows)
+        self.assertFalse(Vote.objects.exists())
+
+
+@override_settings(**TEST_SETTINGS)
+class VoteBufferTests(FixturesMixin, TransactionTestCase):
+    # Foreign keys are only checked on commit, so the flushes have to commit
+
+    def setUp(self):
+        super().setUp()
+        self.directory = self.create_directory()
+        self.user = self.create_user()
+        self.photos = self.create_photos(3)
+
+    def start_buffer(self):
+        buffer = ingest.VoteBuffer(3600, 1000, self.directory, fsync=False)
+        buffer.start()
+        return buffer
+
+    def read_journal(self, buffer):
+        with open(buffer.journal_path) as journal:
+            return [json.loads(line) for line in journal]
+
+    def test_invalid_votes_are_dropped(self):
+        buffer = self.start_buffer()
+        buffer.add(self.user.id, self.photos[0].id, Vote.GOOD)
+        buffer.add(self.user.id, self.photos[-1].id + 1, Vote.BAD)
+        buffer.add(self.user.id + 1, self.photos[1].id, Vote.BAD)
+        buffer.add(self.user.id, self.photos[1].id, Vote.OKAY)
+        self.assertEqual(buffer.flush(), 2)
+        selections = dict(Vote.objects.values_list("photo_id", "selection"))
+        self.assertEqual(selections, {self.photos[0].id: Vote.GOOD, self.photos[1].id: Vote.OKAY})
+        self.assertEqual(buffer.pending, {})
+        self.assertEqual(self.read_journal(buffer), [])
+
+    def test_transient_errors_requeue(self):
+        buffer = self.start_buffer()
+        buffer.add(self.user.id, self.photos[0].id, Vote.GOOD)
+        with mock.patch("core.votes.bulk_upsert", side_effect=OperationalError("database is locked")):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(list(buffer.pending), [(self.user.id, self.photos[0].id)])
+        self.assertEqual(len(self.read_journal(buffer)), 1)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertTrue(Vote.objects.filter(user=self.user, photo=self.photos[0]).exists())
+
+    def test_recover_skips_older_votes(self):
+        Vote.objects.create(user=self.user, photo=self.photos[0], selection=Vote.GOOD)
+        # Left by a dead process with our pid, in the format without timestamps as well
+        path = os.path.join(self.directory, "votes-{}.jsonl".format(os.getpid()))
+        with open(path, "w") as journal:
+            journal.write(json.dumps([self.user.id, self.photos[0].id, Vote.BAD, time.time() - 3600]) + "\n")
+            journal.write(json.dumps([self.user.id, self.photos[1].id, Vote.BAD, time.time() - 3600]) + "\n")
+            journal.write(json.dumps([self.user.id, self.photos[2].id, Vote.OKAY]) + "\n")
+
+        buffer = self.start_buffer()
+        self.assertNotEqual(buffer.journal_path, path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(
+            {photo_id: selection for (_, photo_id), (selection, _) in buffer.pending.items()},
+            {self.photos[1].id: Vote.BAD, self.photos[2].id: Vote.OKAY},
+        )
+        self.assertEqual(len(self.read_journal(buffer)), 2)
+        buffer.flush()
+        self.assertEqual(Vote.objects.get(user=self.user, photo=self.photos[0]).selection, Vote.GOOD)
+        self.assertEqual(Vote.objects.get(user=self.user, photo=self.photos[1]).selection, Vote.BAD)
+
+
+class RankingTests(TestCase):
+    def assertScores(self, scores, expected):
+        for score, value in zip(scores, expected):
+            self.assertAlmostEqual(float(score), value, places=3)
+
+    def test_bayesian(self):
+        ids = np.array([1, 2, 3])
+        counts = np.array([[0, 0, 2], [2, 0, 0], [0, 0, 0]], dtype=float)
+        # Global mean 3, two pseudo-votes (the mean votes per voted photo)
+        scored = ranking.compute(ranking.BAYESIAN, ids, counts)
+        self.assertEqual(list(scored.ids), [1, 3, 2])
+        self.assertScores(scored.scores, [4.0, 3.0, 2.0])
+        scored = ranking.compute(ranking.BAYESIAN, ids, counts, prior_weight=6)
+        self.assertScores(scored.scores, [3.5, 3.0, 2.5])
+
+    def test_wilson(self):
+        # 8 of 10 successes: the textbook 95% interval is (0.4902, 0.9433); 1 of 1: (0.2065, 1)
+        counts = np.array([[2, 0, 8], [0, 0, 1], [0, 0, 0]], dtype=float)
+        low, high = ranking.wilson_interval(counts)
+        self.assertScores(low, [1 + 4 * 0.4902, 1 + 4 * 0.2065, 1])
+        self.assertScores(high, [1 + 4 * 0.9433, 5, 5])
+
+        scored = ranking.compute(ranking.WILSON, np.array([1, 2, 3]), counts)
+        self.assertEqual(list(scored.ids), [1, 2, 3])
+        self.assertEqual(scored.rank(3), 3)
+
+
+class PriorityQueueTests(TestCase):
+    def setUp(self):
+        # Photos 1 and 2 are the top 2: 1 and 4 are settled, 5 has no votes
+        self.ids = np.array([1, 2, 3, 4, 5])
+        counts = np.array([[0, 0, 40], [0, 1, 2], [0, 2, 1], [40, 0, 0], [0, 0, 0]], dtype=float)
+        self.queue = scheduling.PriorityQueue(self.ids, counts, 2)
+
+    def test_order(self):
+        self.assertEqual(self.queue.top, {1, 2})
+        # 5 ties with 2 and goes first with fewer votes
+        self.assertEqual([photo_id for _, _, photo_id in self.queue.entries], [5, 2, 3, 1, 4])
+
+    def test_next_photo(self):
+        self.assertEqual(self.queue.next_photo(0), 5)
+        self.assertEqual(self.queue.next_photo(0, exclude=5), 2)
+        self.assertEqual(self.queue.next_photo(voted.to_bits([2, 5])), 3)
+        self.assertIsNone(self.queue.next_photo(voted.to_bits(self.ids)))
+
+    def test_update(self):
+        self.queue.update(np.array([5]), np.array([[30, 0, 0]], dtype=float))
+        self.assertEqual([photo_id for _, _, photo_id in self.queue.entries], [2, 3, 1, 5, 4])
+        self.assertEqual(len(self.queue.by_id), 5)
+
+
+@override_settings(**TEST_SETTINGS)
+class SchedulingTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.photos = self.create_photos(3)
+        self.addCleanup(setattr, scheduling, "_queue", None)
+        scheduling._queue = None
+
+    def vote(self, photo, selection):
+        """Vote and run the on_commit callbacks after the vote, as a commit would"""
+        callbacks = []
+        with mock.patch("django.db.transaction.on_commit", lambda func, using=None: callbacks.append(func)):
+            Vote.objects.create(user=self.user, photo=photo, selection=selection)
+        for func in callbacks:
+            func()
+
+    def test_votes_refresh_the_queue(self):
+        # Without a queue there is nothing to refresh
+        self.vote(self.photos[2], Vote.OKAY)
+        self.assertIsNone(scheduling._queue)
+        version = versions.get_versions().photos
+        self.assertEqual(scheduling.next_photo(0, version), self.photos[0].id)
+        self.vote(self.photos[0], Vote.BAD)
+        queue = scheduling.get_queue(version)
+        self.assertEqual(queue.by_id[self.photos[0].id][1], 1)
+        self.assertEqual(scheduling.next_photo(0, version), self.photos[1].id)
+
+    def test_queue_is_rebuilt(self):
+        version = versions.get_versions().photos
+        queue = scheduling.get_queue(version)
+        self.assertIs(scheduling.get_queue(version), queue)
+        self.assertIsNot(scheduling.get_queue(version + 1), queue)
+        queue = scheduling.get_queue(version + 1)
+        with self.settings(VOTE_SCHEDULING_REFRESH=0):
+            self.assertIsNot(scheduling.get_queue(version + 1), queue)
+
+
+@override_settings(**TEST_SETTINGS)
+class VoteMatrixTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = settings.VOTE_MATRIX_PATH
+        self.users = self.create_users(2)
+        self.photos = self.create_photos(10)
+
+    def test_krippendorff_alpha(self):
+        # Krippendorff's binary example for two coders and ten units (alpha = 0.095), with 0/1 as 1/5
+        coded = [[0, 1, 0, 0, 0, 0, 0, 0, 1, 0], [1, 1, 1, 0, 0, 1, 0, 0, 0, 0]]
+        for user, values in zip(self.users, coded):
+            for photo, value in zip(self.photos, values):
+                Vote.objects.create(user=user, photo=photo, selection=Vote.GOOD if value else Vote.BAD)
+        vote_matrix = matrix.build(self.path)
+        self.assertAlmostEqual(vote_matrix.krippendorff_alpha(), 0.095, places=3)
+        self.assertEqual([name for name in os.listdir(os.path.dirname(self.path)) if name.startswith(".")], [])
+
+    def test_votes_outside_the_ids_are_skipped(self):
+        # Users 2 and 4 and photo 30 were created after the build read the ids
+        values = np.zeros((2, 2), dtype=np.int8)
+        chunk = [(2, 10, Vote.GOOD), (4, 10, Vote.GOOD), (1, 30, Vote.GOOD), (1, 20, Vote.OKAY), (3, 10, Vote.BAD)]
+        matrix._fill(values, np.array([1, 3]), np.array([10, 20]), chunk)
+        self.assertEqual(values.tolist(), [[0, 3], [1, 0]])
+
+    def test_rebuild_replaces_matrix_and_ids_together(self):
+        Vote.objects.create(user=self.users[0], photo=self.photos[0], selection=Vote.GOOD)
+        old = matrix.build(self.path)
+        user = User.objects.create_user("new", password="password")
+        Vote.objects.create(user=user, photo=self.photos[1], selection=Vote.BAD)
+        new = matrix.build(self.path)
+        # Both are versions of their own; the replaced one stays mapped for readers that have it open
+        self.assertEqual(old.values.shape, (len(old.user_ids), len(old.photo_ids)))
+        self.assertEqual(old.row(user.id), None)
+        self.assertEqual(new.values[new.row(user.id), new.column(self.photos[1].id)], 1)
+        directory = os.path.dirname(self.path)
+        version = os.path.basename(os.path.realpath(self.path))
+        self.assertEqual(sorted(os.listdir(directory)), sorted(["votes.npy", version, version + ".ids.json"]))
+
+        matrix.invalidate()
+        self.assertEqual(os.listdir(directory), [])
+
+    @mock.patch("django.db.transaction.on_commit", run_on_commit)
+    def test_new_user_rebuilds_in_background(self):
+        matrix.build()
+        user = User.objects.create_user("new", password="password")
+        with mock.patch("core.matrix.rebuild_in_background") as rebuild_in_background:
+            Vote.objects.create(user=user, photo=self.photos[0], selection=Vote.GOOD)
+            Vote.objects.create(user=self.users[0], photo=self.photos[1], selection=Vote.OKAY)
+        self.assertTrue(rebuild_in_background.called)
+        vote_matrix = matrix.get_matrix()
+        self.assertIsNone(vote_matrix.row(user.id))
+        self.assertEqual(vote_matrix.values[vote_matrix.row(self.users[0].id), 1], 3)
+
+        vote_matrix = matrix.build()
+        self.assertEqual(vote_matrix.values[vote_matrix.row(user.id), 0], 5)
+
+
+@override_settings(**TEST_SETTINGS)
+class VotedTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.photos = self.create_photos(5)
+
+    def test_bits(self):
+        bits = voted.to_bits([1, 3, 9])
+        self.assertEqual(bits, 0b1000001010)
+        self.assertEqual([voted.has_voted(bits, i) for i in range(11)], [i in [1, 3, 9] for i in range(11)])
+        photos = voted.to_bits(range(1, 11))
+        self.assertEqual(voted.remaining(bits, photos), 7)
+        self.assertEqual(voted.next_unvoted(bits, photos, 3), 4)
+        self.assertEqual(voted.next_unvoted(bits, photos, 8), 10)
+        # Wraps around to the lowest unvoted photo
+        self.assertEqual(voted.next_unvoted(bits, photos, 10), 2)
+        self.assertIsNone(voted.next_unvoted(photos, photos, 5))
+        self.assertEqual(voted.to_bits([]), 0)
+
+    def test_mark(self):
+        version = versions.get_versions(self.user.id).user
+        self.assertEqual(voted.get_voted(self.user.id, version), 0)
+        voted.mark(self.user.id, version + 1, [self.photos[0].id])
+        self.assertEqual(voted.get_voted(self.user.id, version + 1), voted.to_bits([self.photos[0].id]))
+        voted.mark(self.user.id, version + 2, [self.photos[0].id], voted=False)
+        self.assertEqual(voted.get_voted(self.user.id, version + 2), 0)
+
+    def test_mark_after_a_missed_version(self):
+        version = versions.get_versions(self.user.id).user
+        voted.get_voted(self.user.id, version)
+        # The vote of version + 1 has not been marked yet, so version + 2 is rebuilt from the votes
+        Vote.objects.create(user=self.user, photo=self.photos[0], selection=Vote.GOOD)
+        Vote.objects.create(user=self.user, photo=self.photos[1], selection=Vote.GOOD)
+        voted.mark(self.user.id, version + 2, [self.photos[1].id])
+        with self.assertNumQueries(1):
+            bits = voted.get_voted(self.user.id, version + 2)
+        self.assertEqual(bits, voted.to_bits([self.photos[0].id, self.photos[1].id]))
+        # A late mark of version + 1 does not replace it
+        voted.mark(self.user.id, version + 1, [self.photos[0].id])
+        with self.assertNumQueries(0):
+            self.assertEqual(voted.get_voted(self.user.id, version + 2), bits)
+
+
+def derivative_url(photo_id, largest=False):
+    return "/media/derivatives/{}.jpg".format(photo_id)
+
+
+class PhotoURLTests(TestCase):
+    @mock.patch("core.derivatives.get_url", derivative_url)
+    @mock.patch("core.assets.get_url", lambda kind, photo_id: "/static/core/media/grad{}.jpg".format(photo_id))
+    def test_imported_photos_ignore_static_files(self):
+        self.assertEqual(Photo(id=7).src, "/static/core/media/grad7.jpg")
+        self.assertEqual(Photo(id=7, source="/photos/a.jpg").src, "/media/derivatives/7.jpg")
+        self.assertEqual(Photo(id=7, source="/photos/a.jpg").thumb_src, "/media/derivatives/7.jpg")
+
+
+@override_settings(**TEST_SETTINGS)
+class DerivativeTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = self.create_directory()
+        self.sources = self.create_directory()
+        override = self.settings(
+            MEDIA_ROOT=self.media_root, PHOTO_SOURCE_DIR=None, PHOTO_WIDTHS=[32, 8], PHOTO_FORMATS=["webp", "jpeg"]
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(setattr, derivatives, "_manifest", (None, {}))
+
+    def create_source(self, name, size=(20, 10), color="red"):
+        path = os.path.join(self.sources, name)
+        Image.new("RGB", size, color).save(path, "JPEG")
+        return path
+
+    def create_corrupt_source(self):
+        path = os.path.join(self.sources, "corrupt.jpg")
+        with open(path, "w") as f:
+            f.write("not a photo")
+        return path
+
+    def list_files(self):
+        return sorted(name for name in os.listdir(derivatives.output_dir()) if name != derivatives.MANIFEST)
+
+    def test_build(self):
+        corrupt = self.create_corrupt_source()
+        photos = [(1, self.create_source("a.jpg")), (2, corrupt), (3, os.path.join(self.sources, "missing.jpg"))]
+        with self.assertLogs("core.derivatives", "ERROR"):
+            self.assertEqual(derivatives.build(photos, workers=1), (1, 0, 1, 1))
+        entry = derivatives.load_manifest()[1]
+        # Never upscaled past the source width
+        self.assertEqual((entry["width"], entry["height"], entry["widths"]), (20, 10, [8, 20]))
+        digest = entry["hash"]
+        self.assertEqual(
+            self.list_files(),
+            sorted(derivatives.file_name(digest, width, name) for width in [8, 20] for name in ["webp", "jpeg"]),
+        )
+        self.assertEqual(derivatives.get_url(1), "/media/photos/{}-8.jpg".format(digest))
+        self.assertEqual(derivatives.get_url(1, largest=True), "/media/photos/{}-20.jpg".format(digest))
+        self.assertEqual(derivatives.get_url(2), "")
+        self.assertEqual([source["type"] for source in derivatives.get_sources(1)], ["image/webp", "image/jpeg"])
+        self.assertEqual(
+            derivatives.get_sources(1)[0]["srcset"],
+            "/media/photos/{0}-8.webp 8w, /media/photos/{0}-20.webp 20w".format(digest),
+        )
+
+    def test_rebuild(self):
+        photos = [(1, self.create_source("a.jpg"))]
+        derivatives.build(photos, workers=1)
+        old = derivatives.load_manifest()[1]["hash"]
+        self.assertEqual(derivatives.build(photos, workers=1), (0, 1, 0, 0))
+        self.assertEqual(derivatives.build(photos, workers=1, force=True), (1, 0, 0, 0))
+
+        # A changed source gets new files and the old ones are removed
+        self.create_source("a.jpg", color="blue")
+        self.assertEqual(derivatives.build(photos, workers=1), (1, 0, 0, 0))
+        new = derivatives.load_manifest()[1]["hash"]
+        self.assertNotEqual(new, old)
+        self.assertTrue(all(name.startswith(new) for name in self.list_files()))
+
+        # Missing files are rendered again
+        os.remove(os.path.join(derivatives.output_dir(), derivatives.file_name(new, 8, "jpeg")))
+        self.assertEqual(derivatives.build(photos, workers=1), (1, 0, 0, 0))
+        self.assertEqual(len(self.list_files()), 4)
+
+    def test_placeholders(self):
+        corrupt = self.create_corrupt_source()
+        sources = [self.create_source("a.jpg", size=(100, 50)), corrupt, os.path.join(self.sources, "missing.jpg")]
+        photos = [Photo.objects.create(source=source) for source in sources]
+        with self.assertLogs("core.derivatives", "ERROR"):
+            self.assertEqual(derivatives.build_placeholders(photos, workers=1), (1, 1, 1))
+        photo = Photo.objects.get(id=photos[0].id)
+        self.assertEqual((photo.width, photo.height), (100, 50))
+        prefix = "data:image/webp;base64,"
+        self.assertTrue(photo.placeholder.startswith(prefix))
+        with Image.open(io.BytesIO(base64.b64decode(photo.placeholder[len(prefix) :]))) as image:
+            self.assertEqual((image.format, image.size), ("WEBP", (derivatives.PLACEHOLDER_WIDTH, 8)))
+        self.assertEqual(Photo.objects.filter(placeholder="").count(), 2)
+
+    def test_placeholder_command(self):
+        photo = Photo.objects.create(source=self.create_source("a.jpg"))
+        output = io.StringIO()
+        with redirect_stdout(output):
+            call_command("build_photo_placeholders", workers=1)
+            # Photos that have a placeholder are only redone with --force
+            call_command("build_photo_placeholders", workers=1)
+            self.create_source("a.jpg", size=(10, 20))
+            call_command("build_photo_placeholders", workers=1, force=True)
+        self.assertEqual(
+            output.getvalue().splitlines(),
+            [
+                "Updated 1 photos, missing source 0, failed 0.",
+                "Updated 0 photos, missing source 0, failed 0.",
+                "Updated 1 photos, missing source 0, failed 0.",
+            ],
+        )
+        photo.refresh_from_db()
+        self.assertEqual((photo.width, photo.height), (10, 20))
+
+
+@override_settings(**TEST_SETTINGS)
+class AtlasTests(FixturesMixin, TestCase):
+    COLORS = ["red", "green", "blue", "yellow", "purple", "orange", "white"]
+
+    def setUp(self):
+        super().setUp()
+        sources = self.create_directory()
+        override = self.settings(
+            MEDIA_ROOT=self.create_directory(), PHOTO_SOURCE_DIR=None, PHOTO_ATLAS_TILE=(4, 3), PHOTO_ATLAS_GRID=(3, 2)
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(setattr, atlases, "_manifest", (None, {}))
+        self.photos = []
+        for photo_id, color in enumerate(self.COLORS, 1):
+            path = os.path.join(sources, "{}.png".format(photo_id))
+            Image.new("RGB", (8, 6), color).save(path)
+            self.photos.append((photo_id, path))
+
+    def distance(self, pixel, color):
+        return sum((a - b) ** 2 for a, b in zip(pixel, Image.new("RGB", (1, 1), color).getpixel((0, 0))))
+
+    def test_sprites(self):
+        self.assertEqual(atlases.build(self.photos, workers=1), (2, 0))
+        self.assertEqual(atlases.get_sprite(1), dict(atlas=0, x=0, y=0))
+        self.assertEqual(atlases.get_sprite(5), dict(atlas=0, x=50, y=100))
+        self.assertEqual(atlases.get_sprite(6), dict(atlas=0, x=100, y=100))
+        self.assertEqual(atlases.get_sprite(7), dict(atlas=1, x=0, y=0))
+        self.assertIsNone(atlases.get_sprite(8))
+
+        # Background positions of x% and y% show the tile at column x% * (columns - 1), row y% * (rows - 1)
+        names = atlases.get_manifest()["atlases"]
+        for photo_id, color in enumerate(self.COLORS, 1):
+            sprite = atlases.get_sprite(photo_id)
+            column, row = round(sprite["x"] / 100 * 2), round(sprite["y"] / 100)
+            with Image.open(os.path.join(atlases.output_dir(), names[sprite["atlas"]] + ".webp")) as atlas:
+                pixel = atlas.convert("RGB").getpixel((column * 4 + 2, row * 3 + 1))
+            # The nearest of the colors, as the lossy WebP shifts them a little
+            self.assertEqual(min(self.COLORS, key=lambda name: self.distance(pixel, name)), color)
+
+        with open(os.path.join(atlases.output_dir(), atlases.STYLESHEET)) as f:
+            stylesheet = f.read()
+        self.assertIn(".atlas { background-size: 300% 200%; padding-top: 75.0000%; }", stylesheet)
+        self.assertIn('.atlas-1 {{ background-image: url("/media/atlases/{}.jpg");'.format(names[1]), stylesheet)
+
+    def test_rebuild(self):
+        atlases.build(self.photos, workers=1)
+        url = atlases.get_stylesheet_url()
+        self.assertEqual(atlases.build(self.photos, workers=1), (0, 2))
+        self.assertEqual(atlases.get_stylesheet_url(), url)
+        # The first atlas keeps its photos, the second is dropped
+        self.assertEqual(atlases.build(self.photos[:-1], workers=1), (0, 1))
+        self.assertNotEqual(atlases.get_stylesheet_url(), url)
+        # Every tile of the first atlas moves
+        self.assertEqual(atlases.build(self.photos[1:], workers=1), (1, 0))
+        self.assertEqual(len(os.listdir(atlases.output_dir())), 2 + 2)
+
+    def test_single_tile_grid(self):
+        with self.settings(PHOTO_ATLAS_GRID=(1, 1)):
+            atlases.build(self.photos[:2], workers=1)
+        self.assertEqual(atlases.get_sprite(2), dict(atlas=1, x=0, y=0))
+
+
+@override_settings(**TEST_SETTINGS)
+class PopulatePhotosTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_static_files([1, 2])
+        self.client.force_login(self.create_user())
+
+    def test_bundled_photos_use_the_static_files(self):
+        with redirect_stdout(io.StringIO()):
+            call_command("populate_photos")
+        self.assertEqual(Photo.objects.count(), 982)
+        response = self.client.get(reverse("core:photo-list"))
+        self.assertContains(response, 'src="/static/core/media/grad_thumb/grad001.jpg"')
+        self.assertContains(response, 'src="/static/core/media/grad_thumb/grad002.jpg"')
+
+        photo = Photo.objects.order_by("id").first()
+        response = self.client.get(reverse("core:photo-data", args=[photo.id]))
+        self.assertEqual(response.json()["src"], "/static/core/media/grad/grad001.jpg")
+        self.assertEqual(response.json()["name"], "서강대단체{}.jpg".format(photo.id))
+
+
+@override_settings(**TEST_SETTINGS)
+class ImportPhotosTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = self.create_directory()
+        os.makedirs(os.path.join(self.directory, "trip"))
+        exif = Image.Exif()
+        exif[importer.ORIENTATION] = 6
+        exif[importer.MAKE] = "Canon"
+        exif[importer.MODEL] = "EOS 5D"
+        exif.get_ifd(importer.EXIF_IFD)[importer.DATE_TIME_ORIGINAL] = "2019:05:04 12:30:00"
+        Image.new("RGB", (40, 20), "red").save(self.path("trip", "a.jpg"), exif=exif)
+        shutil.copy(self.path("trip", "a.jpg"), self.path("copy of a.JPG"))
+        Image.new("RGB", (10, 10), "blue").save(self.path("b.png"))
+        for name in ["broken.jpg", "notes.txt"]:
+            with open(self.path(name), "w") as f:
+                f.write("not a photo")
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def import_photos(self, *args):
+        output = io.StringIO()
+        # The unreadable file is logged by the worker process
+        with redirect_stdout(output):
+            call_command("import_photos", self.directory, "--workers=1", *args)
+        return output.getvalue().splitlines()
+
+    def test_import(self):
+        self.assertEqual(
+            importer.find_files(self.directory),
+            [self.path(name) for name in ["b.png", "broken.jpg", "copy of a.JPG", os.path.join("trip", "a.jpg")]],
+        )
+        self.assertEqual(
+            self.import_photos("--batch-size=1"),
+            [
+                "Imported 1/4",
+                "Imported 2/4",
+                "Imported 2 photos, 0 already imported, 1 duplicates, 1 unreadable (skipped).",
+                "Run build_photo_derivatives to render the new photos.",
+            ],
+        )
+        # The copy comes first in file order, so it is the one imported
+        copy, png = Photo.objects.get(source=self.path("copy of a.JPG")), Photo.objects.get(source=self.path("b.png"))
+        # Rotated by the EXIF orientation
+        self.assertEqual((copy.width, copy.height), (20, 40))
+        self.assertEqual(copy.taken_at, timezone.make_aware(timezone.datetime(2019, 5, 4, 12, 30)))
+        self.assertEqual(copy.camera, "Canon EOS 5D")
+        self.assertTrue(copy.placeholder.startswith("data:image/webp;base64,"))
+        self.assertEqual((png.width, png.height, png.taken_at, png.camera), (10, 10, None, ""))
+        with self.assertLogs("core.importer", "WARNING"):
+            self.assertIsNone(importer.read_file(self.path("broken.jpg")))
+        self.assertEqual(stats.get_progress()[Counter.PHOTOS], 2)
+
+    def test_resume(self):
+        self.import_photos()
+        Image.new("RGB", (10, 10), "green").save(self.path("trip", "c.png"))
+        version = versions.get_versions().photos
+        self.assertEqual(
+            self.import_photos()[0], "Imported 1 photos, 2 already imported, 1 duplicates, 1 unreadable (skipped)."
+        )
+        self.assertEqual(Photo.objects.count(), 3)
+        self.assertGreater(versions.get_versions().photos, version)
+
+    def test_not_a_directory(self):
+        with self.assertRaises(CommandError):
+            call_command("import_photos", self.path("b.png"))
+
+
+@override_settings(**TEST_SETTINGS)
+class AssetTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.static_dir = self.create_static_files([1, 2])
+        override = self.settings(MEDIA_ROOT=self.create_directory())
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def original_path(self, static_dir, photo_id):
+        return os.path.join(static_dir, "core", "media", "grad", "grad{:03d}.jpg".format(photo_id))
+
+    def test_registry(self):
+        self.assertEqual(assets.get_url(assets.ORIGINAL, 1), "/static/core/media/grad/grad001.jpg")
+        self.assertEqual(assets.get_url(assets.THUMBNAIL, 2), "/static/core/media/grad_thumb/grad002.jpg")
+        self.assertEqual(assets.get_url(assets.ORIGINAL, 3), "")
+        self.assertEqual(assets.get_path(assets.ORIGINAL, 1), self.original_path(self.static_dir, 1))
+        self.assertIsNone(assets.get_path(assets.THUMBNAIL, 3))
+        self.assertEqual(assets.missing([1, 2, 3]), {assets.ORIGINAL: [3], assets.THUMBNAIL: [3]})
+        # Read once, then reused until RELOAD_INTERVAL has passed and the manifest changed
+        registry = assets.get_registry()
+        with self.assertNumQueries(0):
+            self.assertIs(assets.get_registry(), registry)
+
+    def test_first_directory_wins(self):
+        other = self.create_directory()
+        os.makedirs(os.path.dirname(self.original_path(other, 1)))
+        for photo_id in [1, 3]:
+            open(self.original_path(other, photo_id), "w").close()
+        with self.settings(STATICFILES_DIRS=[self.static_dir, other]), mock.patch.object(assets, "_registry", None):
+            self.assertEqual(assets.get_path(assets.ORIGINAL, 1), self.original_path(self.static_dir, 1))
+            self.assertEqual(assets.get_path(assets.ORIGINAL, 3), self.original_path(other, 3))
+
+    def test_deploy_check(self):
+        self.create_photos(13)
+        # Only run with --deploy
+        self.assertEqual(run_checks(tags=["photos"]), [])
+        self.assertEqual(run_checks(tags=["photos"], include_deployment_checks=True), checks.check_photo_assets(None))
+        warnings = checks.check_photo_assets(None)
+        self.assertEqual([warning.id for warning in warnings], ["core.W001", "core.W001"])
+        self.assertEqual(warnings[0].msg, "11 photos have no original file: 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, ...")
+        self.assertEqual(warnings[1].msg, "11 photos have no thumbnail file: 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, ...")
+
+        # Derivatives count for the originals and thumbnails
+        with mock.patch("core.derivatives.get_url", derivative_url):
+            self.assertEqual(checks.check_photo_assets(None), [])
+        Photo.objects.filter(id__gt=2).delete()
+        self.assertEqual(checks.check_photo_assets(None), [])
+
+
+class DuplicateTests(TestCase):
+    def test_distance(self):
+        self.assertEqual(duplicates.distance(0, 0), 0)
+        self.assertEqual(duplicates.distance(0b1011, 0b0110), 3)
+        self.assertEqual(duplicates.distance(0, (1 << 64) - 1), 64)
+
+    def test_search_and_clusters(self):
+        base = 0x0123456789ABCDEF
+        hashes = {1: base, 2: base ^ 0b111, 3: base ^ (1 << 63) ^ (1 << 20), 4: ~base & ((1 << 64) - 1)}
+        index = duplicates.HashIndex()
+        for photo_id, value in hashes.items():
+            index.add(value, photo_id)
+        self.assertEqual(index.search(base, 6), [(0, 1), (2, 3), (3, 2)])
+        self.assertEqual(duplicates.find_clusters(hashes, 6), {1: 1, 2: 1, 3: 1})
+
+
+@override_settings(**TEST_SETTINGS)
+class AggregateRepairTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        users = self.create_users(2)
+        self.photos = self.create_photos(3)
+        for user in users:
+            Vote.objects.create(user=user, photo=self.photos[0], selection=Vote.GOOD)
+        Vote.objects.create(user=users[0], photo=self.photos[1], selection=Vote.BAD)
+
+    def test_repair(self):
+        self.assertEqual(list(aggregates.find_drift()), [])
+        Photo.objects.filter(id=self.photos[0].id).update(votes=5, good=1)
+        Photo.objects.filter(id=self.photos[2].id).update(votes=1, total=3, average=3, okay=1)
+
+        drifted = aggregates.repair(dry_run=True)
+        self.assertEqual([photo_id for photo_id, _, _ in drifted], [self.photos[0].id, self.photos[2].id])
+        self.assertEqual(drifted[1][2], aggregates.EMPTY)
+        self.assertEqual(len(list(aggregates.find_drift())), 2)
+
+        aggregates.repair()
+        self.assertEqual(list(aggregates.find_drift()), [])
+        photo = Photo.objects.get(id=self.photos[0].id)
+        self.assertEqual((photo.votes, photo.total, photo.good, photo.average), (2, 10, 2, 5))
+
+
+@override_settings(**TEST_SETTINGS)
+class ExportTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.staff = self.create_user("staff", is_staff=True)
+        self.photo = self.create_photos(3)[0]
+        Vote.objects.create(user=self.staff, photo=self.photo, selection=Vote.GOOD)
+        self.client.force_login(self.staff)
+
+    def test_votes(self):
+        response = self.client.get(reverse("core:export", args=["votes"]))
+        self.assertEqual(
+            b"".join(response.streaming_content).decode().splitlines(),
+            ["user_id,username,photo_id,selection,score", "{},staff,{},GD,5".format(self.staff.id, self.photo.id)],
+        )
+
+    def test_ranking_rejects_user_filters(self):
+        url = reverse("core:export", args=["ranking"])
+        response = self.client.get(url, {"user_min": 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Rankings can only be filtered by photo"})
+        self.assertEqual(self.client.get(url, {"photo_min": 1}).status_code, 200)
+
+    def test_gzip(self):
+        response = self.client.get(reverse("core:export", args=["votes"]), {"format": "jsonl", "gzip": "1"})
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertIn('filename="votes.jsonl.gz"', response["Content-Disposition"])
+        rows = gzip.decompress(b"".join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(
+            [json.loads(row) for row in rows],
+            [dict(user_id=self.staff.id, username="staff", photo_id=self.photo.id, selection="GD", score=5)],
+        )
+
+    @mock.patch("core.exports.PHOTO_CHUNK_SIZE", 2)
+    def test_ranking_across_chunks(self):
+        rows = list(exports.iter_ranking(ranking.BAYESIAN, versions.get_versions().votes))
+        self.assertEqual([row[0] for row in rows], [1, 2, 3])
+        self.assertEqual(rows[0][1], self.photo.id)
+        photo_ids = Photo.objects.order_by("id").values_list("id", flat=True)
+        self.assertEqual(sorted(row[1] for row in rows), list(photo_ids))
+
+
+@override_settings(**TEST_SETTINGS)
+class BulkUpsertTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = self.create_users(3)
+        self.photos = self.create_photos(4)
+
+    def test_created_counts(self):
+        user, photo = self.users[0], self.photos[0]
+        self.assertEqual(votes.bulk_upsert([(user.id, photo.id, Vote.GOOD), (user.id, self.photos[1].id, Vote.BAD)]), 2)
+        # Updates are not created; later votes for the same photo win
+        rows = [(user.id, photo.id, Vote.BAD), (self.users[1].id, photo.id, Vote.OKAY), (user.id, photo.id, Vote.OKAY)]
+        self.assertEqual(votes.bulk_upsert(rows), 1)
+        self.assertEqual(Vote.objects.get(user=user, photo=photo).selection, Vote.OKAY)
+        photo.refresh_from_db()
+        self.assertEqual((photo.votes, photo.total, photo.okay), (2, 6, 2))
+
+    @mock.patch("core.votes.UPSERT_BATCH_SIZE", 2)
+    def test_created_counts_across_chunks(self):
+        # The second chunk looks up users 0 and 1 and photos 0 and 1, which also finds
+        # the votes inserted by the first chunk; they were still created by this call
+        (u0, u1, _), (p0, p1, _, _) = self.users, self.photos
+        rows = [
+            (u0.id, p0.id, Vote.GOOD),
+            (u1.id, p1.id, Vote.GOOD),
+            (u0.id, p1.id, Vote.BAD),
+            (u1.id, p0.id, Vote.BAD),
+        ]
+        self.assertEqual(votes.bulk_upsert(rows), 4)
+        self.assertEqual(votes.bulk_upsert(rows[:3]), 0)
+        self.assertEqual(Vote.objects.count(), 4)
+
+    @mock.patch("core.aggregates.BATCH_SIZE", 3)
+    def test_aggregates_are_recomputed_in_batches(self):
+        # Each query stays below SQLite's limit on parameters however many photos are voted on
+        rows = [(self.users[0].id, photo.id, Vote.GOOD) for photo in self.photos]
+        with mock.patch("core.aggregates.compute", wraps=aggregates.compute) as compute:
+            votes.bulk_upsert(rows)
+        self.assertEqual([len(call[0][0]) for call in compute.call_args_list], [3, 1])
+        self.assertEqual(list(Photo.objects.values_list("votes", flat=True)), [1] * 4)
+
+
+@override_settings(**TEST_SETTINGS)
+class BallotTests(FixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.photos = self.create_photos(2)
+
+    def test_parse(self):
+        lines = [
+            "username,photo_id,score\n",
+            "rater,{},5\n".format(self.photos[0].id),
+            "rater,{},ok\n".format(self.photos[1].id),
+            "nobody,{},3\n".format(self.photos[0].id),
+            "rater,x,3\n",
+            "rater,{},3\n".format(self.photos[1].id + 100),
+            "rater,{},4\n".format(self.photos[0].id),
+        ]
+        result = ballots.parse(lines)
+        self.assertEqual(result.rows, 6)
+        self.assertEqual(
+            result.votes, [(self.user.id, self.photos[0].id, Vote.GOOD), (self.user.id, self.photos[1].id, Vote.OKAY)]
+        )
+        self.assertEqual([line for line, _ in result.errors], [4, 5, 6, 7])
+        self.assertEqual(result.errors[0][1], "Unknown user 'nobody'")
+        self.assertEqual(result.errors[3][1], "Invalid selection '4'")
+
+    def test_missing_columns(self):
+        with self.assertRaises(ballots.BallotError):
+            ballots.parse(["user_id,selection\n", "1,GD\n"])
+
+    def test_import(self):
+        lines = ["user_id,photo_id,selection\n"] + [
+            "{},{},GD\n".format(self.user.id, photo.id) for photo in self.photos
+        ]
+        result = ballots.import_ballots(lines, dry_run=True)
+        self.assertEqual((len(result.votes), result.created), (2, 0))
+        self.assertFalse(Vote.objects.exists())
+        result = ballots.import_ballots(lines)
+        self.assertEqual(result.created, 2)
+        self.assertEqual(Vote.objects.filter(user=self.user, selection=Vote.GOOD).count(), 2)
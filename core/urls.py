@@ -8,7 +8,16 @@ app_name = "core"
 urlpatterns = [
     path("", LandingView.as_view(), name="landing"),
     path("photos/", PhotoListView.as_view(), name="photo-list"),
+    path("photos/feed/", PhotoFeedView.as_view(), name="photo-feed"),
+    path("photos/votes/", VoteApiView.as_view(), name="vote-api"),
+    path("photos/cache-stats/", CacheStatsView.as_view(), name="cache-stats"),
+    path("photos/sql-stats/", SQLStatsView.as_view(), name="sql-stats"),
+    path("photos/profiles/", ProfileReportsView.as_view(), name="profile-reports"),
+    path("photos/profiles/<str:name>/", ProfileReportView.as_view(), name="profile-report"),
+    path("photos/export/<slug:kind>/", ExportView.as_view(), name="export"),
+    path("photos/import/", BallotImportView.as_view(), name="ballot-import"),
     path("photos/<slug:slug>/", PhotoDetailView.as_view(), name="photo-detail"),
+    path("photos/<slug:slug>/data/", PhotoDataView.as_view(), name="photo-data"),
     path("index", IndexView.as_view(), name="index"),
 ]
 
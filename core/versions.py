@@ -0,0 +1,98 @@
+"""Vote and photo versions used to key cached pages and HTTP validators
+
+The global vote version changes whenever any vote, photo or user is written,
+the photo version whenever photos are added or removed, and each user's
+version whenever that user votes. Each version is stored with the time it last
+changed, which is used for Last-Modified.
+
+Versions are Version rows incremented with a single UPDATE, so processes that
+bump the same version at once each get a new value (cache backends such as
+the file-based one increment with a get and a set). Reading the versions of a
+request is one query. Missing versions are initialized from the clock so they
+never repeat a value that earlier pages were cached under, e.g. with a new
+database and an old cache.
+"""
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core import sqlite
+from core.models import Version
+
+VOTE_VERSION = "votes"
+PHOTO_VERSION = "photos"
+USER_VERSION = "user:{}"
+PHOTO_LIST_KEY = "photo-list:{sort}:{vote_version}:{user_id}:{user_version}"
+
+Versions = namedtuple("Versions", ["votes", "photos", "user", "modified"])
+
+
+def _initial_version():
+    return int(time.time() * 1000)
+
+
+def _bump(name):
+    now = timezone.now()
+    with sqlite.serialized_writes(), transaction.atomic():
+        if not Version.objects.filter(name=name).update(value=F("value") + 1, modified=now):
+            try:
+                with transaction.atomic():
+                    Version.objects.create(name=name, value=_initial_version(), modified=now)
+            except IntegrityError:
+                # Created by a concurrent bump
+                Version.objects.filter(name=name).update(value=F("value") + 1, modified=now)
+        return Version.objects.filter(name=name).values_list("value", flat=True).get()
+
+
+def get_versions(user_id=None):
+    """Return the Versions visible to the given user (user is None without a user)"""
+    names = [VOTE_VERSION, PHOTO_VERSION]
+    if user_id is not None:
+        names.append(USER_VERSION.format(user_id))
+    rows = Version.objects.filter(name__in=names).values_list("name", "value", "modified")
+    values = {name: (value, modified) for name, value, modified in rows}
+    missing = [name for name in names if name not in values]
+    if missing:
+        # Unknown, so anything cached before now may be stale
+        now = timezone.now()
+        Version.objects.bulk_create(
+            [Version(name=name, value=_initial_version(), modified=now) for name in missing], ignore_conflicts=True
+        )
+        rows = Version.objects.filter(name__in=missing).values_list("name", "value", "modified")
+        values.update((name, (value, modified)) for name, value, modified in rows)
+    modified = max(values[name][1] for name in names)
+    return Versions(
+        votes=values[VOTE_VERSION][0],
+        photos=values[PHOTO_VERSION][0],
+        user=values[names[2]][0] if user_id is not None else None,
+        modified=int(modified.timestamp()),
+    )
+
+
+def bump_votes(user_id=None):
+    """Bump the vote version and the user's; returns the new user version"""
+    _bump(VOTE_VERSION)
+    if user_id is not None:
+        return _bump(USER_VERSION.format(user_id))
+
+
+def bump_photos():
+    _bump(PHOTO_VERSION)
+    _bump(VOTE_VERSION)
+
+
+def get_photo_list(user_id, sort, versions):
+    """Return (cache key, cached page content or None)"""
+    key = PHOTO_LIST_KEY.format(
+        sort=sort, vote_version=versions.votes, user_id=user_id, user_version=versions.user
+    )
+    return key, cache.get(key)
+
+
+def set_photo_list(key, content):
+    cache.set(key, content, settings.PHOTO_LIST_CACHE_TIMEOUT)
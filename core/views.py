@@ -1,12 +1,33 @@
-from django.contrib.auth import get_user_model
+import io
+import json
+
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Count, Q, OuterRef, Subquery
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.urls import reverse
-from django.views.generic import TemplateView, ListView, DetailView, FormView, UpdateView
+from django.views.generic import TemplateView, ListView, DetailView, FormView, UpdateView, View
 from django.views.generic.detail import SingleObjectMixin
 
-from core.forms import VoteForm
-from core.models import Photo, Vote
+from base.mixins import StaffMemberRequiredMixin, SuperUserRequiredMixin
+from core import (
+    atlases,
+    ballots,
+    cache_stats,
+    exports,
+    feed,
+    ingest,
+    neighbors,
+    profiling,
+    scheduling,
+    sql_profiling,
+    stats,
+    versions,
+    voted,
+    votes,
+)
+from core.forms import BallotImportForm, VoteForm
+from core.mixins import ConditionalGetMixin, VersionsMixin
+from core.models import Counter, Photo, Vote
 
 
 class LandingView(TemplateView):
@@ -21,48 +42,151 @@ class IndexView(TemplateView):
     template_name = "core/index.html"
 
 
-class PhotoListView(LoginRequiredMixin, TemplateView):
+class PhotoListView(LoginRequiredMixin, ConditionalGetMixin, TemplateView):
+    """
+    Rendered pages are cached per user and sort order, keyed by the vote versions
+    (see core.versions), so a hit skips both the queries and the template.
+    """
     template_name = "core/photo_list.html"
+    conditional_name = "photo-list"
+    paginate_by = 48
+
+    def get_sort(self):
+        sort = self.request.GET.get("sort")
+        return sort if sort in feed.SORTS else feed.INDEX
+
+    def get_etag_parts(self):
+        return [self.get_versions().votes, self.get_sort()]
+
+    def get(self, request, *args, **kwargs):
+        key, content = versions.get_photo_list(request.user.id, self.get_sort(), self.get_versions())
+        if content is not None:
+            cache_stats.record_hit("photo-list-page")
+            return HttpResponse(content)
+        cache_stats.record_miss("photo-list-page")
+        response = super().get(request, *args, **kwargs)
+        response.add_post_render_callback(lambda r: versions.set_photo_list(key, r.content))
+        return response
 
     def get_photo_list(self):
-        photos = Photo.objects.all().annotate(bad=Count("vote", filter=Q(vote__selection=Vote.BAD)),
-                                              okay=Count("vote", filter=Q(vote__selection=Vote.OKAY)),
-                                              good=Count("vote", filter=Q(vote__selection=Vote.GOOD)))
-        if self.request.GET.get("sort") == "rank":
-            photos = photos.order_by("-average")
-        votes = Vote.objects.filter(user=self.request.user).all()
-        votes_by_photo = {vote.photo_id: vote for vote in votes}
-        for photo in photos:
-            photo.vote = votes_by_photo.get(photo.id)
-        return photos
+        """First page of photos; the rest are loaded from PhotoFeedView while scrolling"""
+        versions = self.get_versions()
+        return feed.get_photo_page(
+            self.request.user,
+            self.get_sort(),
+            limit=self.paginate_by,
+            version=versions.votes,
+            user_version=versions.user,
+        )
 
     def get_context_data(self, **kwargs):
-        User = get_user_model()
         context = super().get_context_data(**kwargs)
-        max_votes = Photo.objects.count() * User.objects.count()
-        context["photo_list"] = self.get_photo_list()
-        context["total_votes"] = Vote.objects.count()
+        progress = stats.get_progress()
+        max_votes = progress[Counter.PHOTOS] * progress[Counter.USERS]
+        context["photo_list"], context["next_cursor"] = self.get_photo_list()
+        context["total_votes"] = progress[Counter.VOTES]
         context["max_votes"] = max_votes
-        context["progress"] = Vote.objects.count() / max_votes * 100
-        context["users"] = User.objects.annotate(Count("vote")).order_by("-vote__count")
-        context["sort_by_rank"] = self.request.GET.get("sort") == "rank"
+        context["progress"] = progress[Counter.VOTES] / max_votes * 100 if max_votes else 0
+        context["user_counters"] = progress["user_counters"]
+        context["sort"] = self.get_sort()
+        context["atlas_stylesheet"] = atlases.get_stylesheet_url()
         return context
 
 
-class PhotoDetailView(LoginRequiredMixin, SingleObjectMixin, FormView):
+class PhotoFeedView(LoginRequiredMixin, ConditionalGetMixin, View):
+    """
+    JSON pages of photos for infinite scrolling on the photo list. Pass the `next`
+    cursor of a page as `cursor` to get the following page.
+    """
+    conditional_name = "photo-feed"
+    paginate_by = 48
+    max_paginate_by = 200
+
+    def get_sort(self):
+        sort = self.request.GET.get("sort")
+        return sort if sort in feed.SORTS else feed.INDEX
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.GET.get("limit", self.paginate_by))
+        except ValueError:
+            limit = self.paginate_by
+        return max(1, min(limit, self.max_paginate_by))
+
+    def get_etag_parts(self):
+        versions = self.get_versions()
+        return [versions.votes, self.get_sort(), self.get_limit(), self.request.GET.get("cursor", "")]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            photos, next_cursor = feed.get_photo_page(
+                request.user,
+                self.get_sort(),
+                request.GET.get("cursor"),
+                self.get_limit(),
+                version=self.get_versions().votes,
+                user_version=self.get_versions().user,
+            )
+        except feed.InvalidCursor:
+            return JsonResponse({"error": "Invalid cursor"}, status=400)
+        return JsonResponse(dict(photos=[feed.serialize_photo(p) for p in photos], next=next_cursor))
+
+
+class PhotoObjectMixin(SingleObjectMixin):
     """
     self.object = Photo {
-        next: next photo
-        previous: previous photo
+        next: next photo id
+        previous: previous photo id
+        next_unvoted: id of the photo the current user should vote on next (see
+            core.scheduling), else the next one they have not voted on
+        remaining: number of photos the current user has not voted on
+        duplicates: ids of the other photos of its near-duplicate cluster
         vote: current user's vote on photo
     }
     """
-    template_name = "core/photo_detail.html"
     model = Photo
     slug_url_kwarg = "slug"
     slug_field = "id"
     context_object_name = "photo"
+
+    def get_object(self, queryset=None):
+        object = super().get_object(queryset)
+        object.vote = object.vote_set.filter(user=self.request.user).first()
+        pending = ingest.get_pending(self.request.user.id).get(object.id)
+        if pending:
+            object.vote = object.vote or Vote(user=self.request.user, photo=object)
+            object.vote.selection = pending
+        versions = self.get_versions()
+        object.previous, object.next = neighbors.get_neighbors(object.id, versions.photos)
+        voted_bits = voted.get_voted(self.request.user.id, versions.user)
+        photo_bits = voted.get_photos(versions.photos)
+        if settings.VOTE_SCHEDULING:
+            # Photos that are not to be voted on count as voted
+            object.next_unvoted = scheduling.next_photo(voted_bits | ~photo_bits, versions.photos, exclude=object.id)
+        else:
+            object.next_unvoted = voted.next_unvoted(voted_bits, photo_bits, object.id)
+        object.remaining = voted.remaining(voted_bits, photo_bits)
+        object.duplicates = []
+        if object.cluster is not None:
+            duplicates = Photo.objects.filter(cluster=object.cluster).exclude(id=object.id).order_by("id")
+            object.duplicates = list(duplicates.values_list("id", flat=True))
+        return object
+
+    def get_queryset(self):
+        return Photo.objects.all()
+
+    def get_etag_parts(self):
+        parts = [self.get_versions().photos, self.kwargs.get(self.slug_url_kwarg)]
+        if settings.VOTE_SCHEDULING:
+            # next_unvoted depends on everyone's votes
+            parts.append(self.get_versions().votes)
+        return parts
+
+
+class PhotoDetailView(LoginRequiredMixin, ConditionalGetMixin, PhotoObjectMixin, FormView):
+    template_name = "core/photo_detail.html"
     form_class = VoteForm
+    conditional_name = "photo-detail"
 
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()
@@ -76,42 +200,163 @@ class PhotoDetailView(LoginRequiredMixin, SingleObjectMixin, FormView):
         else:
             return self.form_invalid(form)
 
-    def get_object(self, queryset=None):
-        object = super().get_object(queryset)
-        object.vote = object.vote_set.filter(user=self.request.user).first()
-        return object
-
-    def get_queryset(self):
-        next_photo = Photo.objects.filter(id__gt=OuterRef("id")).order_by("id").values("id")[:1]
-        previous_photo = Photo.objects.filter(id__lt=OuterRef("id")).order_by("-id").values("id")[:1]
-        return Photo.objects.all().annotate().annotate(next=Subquery(next_photo)).annotate(
-            previous=Subquery(previous_photo))
-
-    def get_initial(self):
-        initial = super().get_initial()
-        initial["photo"] = self.object.id
-        initial["user"] = self.request.user.id
-        return initial
-
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         if self.object.vote:
             kwargs.update({'instance': self.object.vote})
+        else:
+            kwargs.update({'instance': Vote(user=self.request.user, photo=self.object)})
         return kwargs
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["next_id"] = self.object.next
         context["previous_id"] = self.object.previous
+        context["next_unvoted_id"] = self.object.next_unvoted
+        context["remaining"] = self.object.remaining
         return context
 
     def form_valid(self, form):
-        form.save()
-        self.object.update()
+        if settings.VOTE_WRITE_BEHIND:
+            ingest.enqueue(self.request.user.id, self.object.id, form.cleaned_data["selection"])
+        else:
+            # Photo aggregates are updated by Vote.save()
+            form.save()
         return super().form_valid(form)
 
     def get_success_url(self):
-        if self.object.next:
-            return reverse("core:photo-detail", args=[self.object.next])
+        # Skip photos the user has already voted on, once all are voted go through them in order
+        next_id = self.object.next_unvoted or self.object.next
+        if next_id:
+            return reverse("core:photo-detail", args=[next_id])
         else:
             return reverse("core:photo-list")
+
+
+class PhotoDataView(LoginRequiredMixin, ConditionalGetMixin, PhotoObjectMixin, View):
+    """JSON version of PhotoDetailView, used to prefetch the next photo"""
+    conditional_name = "photo-data"
+    raise_exception = True
+
+    def get(self, request, *args, **kwargs):
+        photo = self.get_object()
+        return JsonResponse(
+            dict(
+                id=photo.id,
+                name=photo.name,
+                src=photo.src,
+                sources=photo.sources,
+                width=photo.width,
+                height=photo.height,
+                placeholder=photo.placeholder,
+                url=reverse("core:photo-detail", args=[photo.id]),
+                vote=photo.vote.selection if photo.vote else None,
+                previous_id=photo.previous,
+                next_id=photo.next,
+                next_unvoted_id=photo.next_unvoted,
+                remaining=photo.remaining,
+                duplicates=photo.duplicates,
+            )
+        )
+
+
+class VoteApiView(LoginRequiredMixin, View):
+    """
+    Submit one vote `{"photo": 1, "selection": "GD"}` or a batch
+    `{"votes": [{"photo": 1, "selection": "GD"}, ...]}` as JSON. Responds with the
+    updated aggregates of the voted photos.
+    """
+    raise_exception = True
+
+    def post(self, request, *args, **kwargs):
+        try:
+            data = json.loads(request.body.decode("utf-8"))
+            photos = votes.submit_votes(request.user, votes.parse_votes(data))
+        except ValueError as e:
+            # Includes VoteError and malformed JSON
+            return JsonResponse({"error": str(e)}, status=400)
+        return JsonResponse(dict(photos=[votes.serialize_aggregates(photo) for photo in photos]))
+
+
+class CacheStatsView(StaffMemberRequiredMixin, View):
+    """Hit rates of the photo list page cache and of conditional GETs"""
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(cache_stats.get_hit_rates())
+
+
+class SQLStatsView(StaffMemberRequiredMixin, View):
+    """Rolling per-view query counts and timings of this process (see core.sql_profiling)"""
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(sql_profiling.get_summary())
+
+
+class ProfileReportsView(SuperUserRequiredMixin, View):
+    """Stored request profiles (see core.profiling), newest first"""
+
+    def get(self, request, *args, **kwargs):
+        reports = profiling.list_reports()
+        for report in reports:
+            report["url"] = reverse("core:profile-report", args=[report["name"]])
+        return JsonResponse(dict(reports=reports))
+
+
+class ProfileReportView(SuperUserRequiredMixin, View):
+    """Download a stored request profile"""
+
+    def get(self, request, name, *args, **kwargs):
+        path = profiling.get_report_path(name)
+        if path is None:
+            raise Http404("No such profile")
+        return FileResponse(open(path, "rb"), as_attachment=True, filename=name)
+
+
+class ExportView(StaffMemberRequiredMixin, VersionsMixin, View):
+    """
+    Stream the votes or a ranking (see core.exports) as a file download.
+    Query parameters: format (csv or jsonl), gzip=1, method (rankings), and
+    user_min/user_max/photo_min/photo_max to export id ranges (rankings only
+    by photo). The rows are queried while the body is sent, after the
+    middleware has returned, so SQL profiling does not cover them.
+    """
+
+    RANGE_PARAMETERS = ["user_min", "user_max", "photo_min", "photo_max"]
+
+    def get(self, request, kind, *args, **kwargs):
+        format = request.GET.get("format", exports.CSV)
+        compress = request.GET.get("gzip") == "1"
+        method = request.GET.get("method", exports.DEFAULT_METHOD)
+        try:
+            if format not in exports.FORMATS:
+                raise ValueError("Unknown export format {!r}".format(format))
+            filters = {
+                name: int(request.GET[name]) for name in self.RANGE_PARAMETERS if request.GET.get(name, "") != ""
+            }
+            content = exports.export(kind, format, compress, method, self.get_versions().votes, **filters)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        response = StreamingHttpResponse(
+            content, content_type="application/gzip" if compress else exports.CONTENT_TYPES[format]
+        )
+        response["Content-Disposition"] = 'attachment; filename="{}"'.format(
+            exports.file_name(kind, format, compress, method)
+        )
+        return response
+
+
+class BallotImportView(StaffMemberRequiredMixin, FormView):
+    """Upload a CSV of offline ballots (see core.ballots) and show the per-row report"""
+    template_name = "core/ballot_import.html"
+    form_class = BallotImportForm
+
+    def form_valid(self, form):
+        lines = io.TextIOWrapper(form.cleaned_data["file"].file, encoding="utf-8-sig", newline="")
+        try:
+            result = ballots.import_ballots(lines, form.cleaned_data["dry_run"])
+        except (ballots.BallotError, UnicodeDecodeError) as e:
+            form.add_error("file", str(e))
+            return self.form_invalid(form)
+        return self.render_to_response(
+            self.get_context_data(form=form, result=result, dry_run=form.cleaned_data["dry_run"])
+        )
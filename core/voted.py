@@ -0,0 +1,113 @@
+"""Per-user bitsets of voted photos
+
+Bit i of a user's bitset is set if the user has voted on the photo with id i,
+so "has voted", "next unvoted photo after id X" and "photos left to vote on"
+are a few integer operations instead of queries against the vote table.
+
+Each user's bitset is stored in the default cache under one key, together with
+the user's vote version it is valid for (see core.versions). Writing a vote
+bumps the version and stores the new bits only if the stored bitset is the one
+of the previous version. If another vote came in between, or the bitset was
+evicted, nothing is stored and the next read rebuilds it from the vote table
+(one query, including votes queued by write-behind ingestion). A concurrent
+write can therefore only leave a bitset of an older version behind, which is
+never used. The bitset of all photos to vote on is kept per
+process and rebuilt when the photo version changes; with VOTE_SKIP_DUPLICATES
+it leaves out all but the first photo of each near-duplicate cluster (see
+core.duplicates).
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from core import neighbors, versions
+from core.models import Photo, Vote
+
+VOTED_KEY = "voted:{}"
+# Bitsets of inactive users expire
+TIMEOUT = 24 * 60 * 60
+
+_lock = threading.Lock()
+_photos = (None, 0)
+
+
+def to_bits(photo_ids):
+    photo_ids = list(photo_ids)
+    if not photo_ids:
+        return 0
+    data = bytearray(max(photo_ids) // 8 + 1)
+    for photo_id in photo_ids:
+        data[photo_id >> 3] |= 1 << (photo_id & 7)
+    return int.from_bytes(data, "little")
+
+
+def _lowest(bits):
+    """Index of the lowest set bit"""
+    return (bits & -bits).bit_length() - 1
+
+
+def _load(user_id):
+    from core import ingest
+
+    photo_ids = set(Vote.objects.filter(user_id=user_id).values_list("photo_id", flat=True))
+    photo_ids.update(photo_id for photo_id, selection in ingest.get_pending(user_id).items() if selection)
+    return to_bits(photo_ids)
+
+
+def get_voted(user_id, user_version=None):
+    """Return the bitset of photos the user has voted on"""
+    if user_version is None:
+        user_version = versions.get_versions(user_id).user
+    key = VOTED_KEY.format(user_id)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == user_version:
+        return cached[1]
+    bits = _load(user_id)
+    cache.set(key, (user_version, bits), TIMEOUT)
+    return bits
+
+
+def mark(user_id, user_version, photo_ids, voted=True):
+    """Store the bitset of user_version: the previous version's with photo_ids set (or cleared)"""
+    key = VOTED_KEY.format(user_id)
+    cached = cache.get(key)
+    if cached is None or cached[0] != user_version - 1:
+        return
+    changed = to_bits(photo_ids)
+    bits = cached[1] | changed if voted else cached[1] & ~changed
+    cache.set(key, (user_version, bits), TIMEOUT)
+
+
+def get_photos(photo_version):
+    """Return the bitset of all photos to vote on"""
+    global _photos
+    if _photos[0] != photo_version:
+        with _lock:
+            if _photos[0] != photo_version:
+                bits = to_bits(neighbors.get_ids(photo_version))
+                if settings.VOTE_SKIP_DUPLICATES:
+                    duplicates = Photo.objects.exclude(cluster=None).exclude(cluster=F("id"))
+                    bits &= ~to_bits(duplicates.values_list("id", flat=True))
+                _photos = (photo_version, bits)
+    return _photos[1]
+
+
+def has_voted(bits, photo_id):
+    return bool(bits >> photo_id & 1)
+
+
+def remaining(voted, photos):
+    """Number of photos not voted on"""
+    return bin(photos & ~voted).count("1")
+
+
+def next_unvoted(voted, photos, photo_id):
+    """Id of the first unvoted photo after photo_id, wrapping around; None if there is none"""
+    unvoted = photos & ~voted
+    after = unvoted >> (photo_id + 1)
+    if after:
+        return photo_id + 1 + _lowest(after)
+    before = unvoted & ((1 << photo_id) - 1)
+    return _lowest(before) if before else None
@@ -0,0 +1,147 @@
+"""Submitting votes outside of VoteForm (JSON API, batches, bulk upserts)"""
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from core import aggregates
+from core.models import Photo, Vote
+
+MAX_BATCH_SIZE = 500
+# Rows per INSERT, keeping the number of SQL parameters below SQLite's limit
+UPSERT_BATCH_SIZE = 240
+
+# Sent by bulk_upsert(), which bypasses Vote.save() and post_save.
+# votes: [(user_id, photo_id, selection)], created: [(user_id, photo_id)]
+votes_bulk_saved = Signal(providing_args=["votes", "created"])
+
+
+class VoteError(ValueError):
+    pass
+
+
+def parse_votes(data):
+    """Return [(photo_id, selection), ...] from `{"photo", "selection"}` or
+    `{"votes": [{"photo", "selection"}, ...]}`
+    """
+    if not isinstance(data, dict):
+        raise VoteError("Expected a JSON object")
+    items = data["votes"] if "votes" in data else [data]
+    if not isinstance(items, list) or not items:
+        raise VoteError("Expected a non-empty list of votes")
+    if len(items) > MAX_BATCH_SIZE:
+        raise VoteError("At most {} votes can be submitted at once".format(MAX_BATCH_SIZE))
+
+    selections = dict(Vote.selection_choices)
+    votes = []
+    for item in items:
+        try:
+            photo_id = int(item["photo"])
+            selection = item["selection"]
+        except (KeyError, TypeError, ValueError):
+            raise VoteError("Each vote needs a photo id and a selection")
+        # Lists and dicts are unhashable, so check the type before the lookup
+        if not isinstance(selection, str) or selection not in selections:
+            raise VoteError("Invalid selection {!r}".format(selection))
+        votes.append((photo_id, selection))
+    return votes
+
+
+def submit_votes(user, votes):
+    """Create or update the user's votes in a single transaction
+
+    Later votes for the same photo override earlier ones. Returns the updated
+    photos. With VOTE_WRITE_BEHIND, the votes are queued instead (see
+    core.ingest) and the returned aggregates do not include them yet.
+    """
+    photo_ids = {photo_id for photo_id, _ in votes}
+    found = set(Photo.objects.filter(id__in=photo_ids).values_list("id", flat=True))
+    if found != photo_ids:
+        raise VoteError("Unknown photos {}".format(sorted(photo_ids - found)))
+    if settings.VOTE_WRITE_BEHIND:
+        from core import ingest
+
+        for photo_id, selection in votes:
+            ingest.enqueue(user.id, photo_id, selection)
+        return list(Photo.objects.filter(id__in=photo_ids).order_by("id"))
+
+    with transaction.atomic():
+        existing = {vote.photo_id: vote for vote in Vote.objects.filter(user=user, photo_id__in=photo_ids)}
+        for photo_id, selection in votes:
+            vote = existing.get(photo_id)
+            if vote is None:
+                vote = existing[photo_id] = Vote(user=user, photo_id=photo_id)
+            elif vote.selection == selection:
+                continue
+            vote.selection = selection
+            vote.save()
+    return list(Photo.objects.filter(id__in=photo_ids).order_by("id"))
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _upsert(rows):
+    table = connection.ops.quote_name(Vote._meta.db_table)
+    placeholders = ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+    sql = (
+        "INSERT INTO {table} (user_id, photo_id, selection, modified) VALUES {placeholders} "
+        "ON CONFLICT (user_id, photo_id) DO UPDATE SET selection = excluded.selection, modified = excluded.modified"
+    ).format(table=table, placeholders=placeholders)
+    params = []
+    for user_id, photo_id, selection, modified in rows:
+        params.extend([user_id, photo_id, selection, connection.ops.adapt_datetimefield_value(modified)])
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def bulk_upsert(votes):
+    """Insert or update many votes using the user_photo_unique constraint
+
+    votes is an iterable of (user_id, photo_id, selection) or (user_id,
+    photo_id, selection, modified) when the vote was cast earlier than now;
+    later votes for the same user and photo win. Aggregates of the affected
+    photos are recomputed once at the end. Returns the number of votes created.
+    """
+    now = timezone.now()
+    latest = OrderedDict()
+    modified = {}
+    for user_id, photo_id, selection, *cast in votes:
+        latest[(user_id, photo_id)] = selection
+        modified[(user_id, photo_id)] = cast[0] if cast else now
+    keys = list(latest)
+
+    with transaction.atomic():
+        existing = set()
+        for chunk in _chunks(keys, UPSERT_BATCH_SIZE):
+            user_ids = {user_id for user_id, _ in chunk}
+            photo_ids = {photo_id for _, photo_id in chunk}
+            found = Vote.objects.filter(user_id__in=user_ids, photo_id__in=photo_ids)
+            # Not the votes inserted by earlier chunks
+            keys_in_chunk = set(chunk)
+            existing.update(key for key in found.values_list("user_id", "photo_id") if key in keys_in_chunk)
+            _upsert([key + (latest[key], modified[key]) for key in chunk])
+        aggregates.recompute({photo_id for _, photo_id in keys})
+        created = [key for key in keys if key not in existing]
+        votes_bulk_saved.send(
+            sender=Vote,
+            votes=[(user_id, photo_id, selection) for (user_id, photo_id), selection in latest.items()],
+            created=created,
+        )
+    return len(created)
+
+
+def serialize_aggregates(photo):
+    return dict(
+        id=photo.id,
+        votes=photo.votes,
+        total=photo.total,
+        average=photo.average,
+        bad=photo.bad,
+        okay=photo.okay,
+        good=photo.good,
+    )